@@ -6,6 +6,7 @@ mkdir -p /ui_files/matrix
 if [ -d "/ui_build" ]; then
     echo "Copying UI files from /ui_build → /ui_files/matrix ..."
     cp -r /ui_build/* /ui_files/matrix/
+    matrixrmapi precompress /ui_files/matrix || echo "Precompressing UI files failed, serving them as they are"
 else
     echo "No UI found at /ui_build, skipping copy."
 fi
@@ -13,7 +14,8 @@ fi
 set -e
 if [ "$#" -eq 0 ]; then
   # FIXME: can we know the traefik/nginx internal docker ip easily ?
-  exec gunicorn "matrixrmapi.app:get_app()" --bind 0.0.0.0:8012 --forwarded-allow-ips='*' -w 4 -k uvicorn.workers.UvicornWorker
+  # --preload builds the app (and the OpenAPI document) once in the master, workers fork with it ready
+  exec gunicorn "matrixrmapi.app:get_app()" -c python:matrixrmapi.gunicorn_conf --preload --bind 0.0.0.0:8012 --forwarded-allow-ips='*' -w 4 -k uvicorn.workers.UvicornWorker
 else
   exec "$@"
 fi
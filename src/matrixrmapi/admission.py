@@ -0,0 +1,235 @@
+"""Admission control so bursts of heavy requests can't starve the RASENMAEHER lifecycle calls.
+
+Every client certificate gets a token bucket, every route class a concurrency limit with a short queue where
+RASENMAEHER goes first. When the queue is full or the event loop lags we answer 503 right away instead of letting
+the latency of everything grow."""
+
+from typing import Deque, Dict, Optional, Pattern, Tuple
+from collections import Counter, OrderedDict, deque
+import asyncio
+import functools
+import logging
+import math
+import re
+import time
+
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .auth import DN_HEADER, get_authorizer
+from .config import (
+    ADMISSION_RATE,
+    ADMISSION_BURST,
+    ADMISSION_CLIENTS,
+    ADMISSION_LIFECYCLE_CONCURRENCY,
+    ADMISSION_HEAVY_CONCURRENCY,
+    ADMISSION_DEFAULT_CONCURRENCY,
+    ADMISSION_QUEUE_SIZE,
+    ADMISSION_QUEUE_TIMEOUT,
+    ADMISSION_MAX_LOOP_LAG,
+    ADMISSION_RETRY_AFTER,
+)
+from .health import get_health_monitor
+from .metrics import get_metrics_store
+
+LOGGER = logging.getLogger(__name__)
+# First match wins, None means not limited: probes, metrics, the long-lived change feed, docs and the UI files
+ROUTE_CLASSES: Tuple[Tuple[Pattern[str], Optional[str]], ...] = (
+    (re.compile(r"^/api/v\d+/users/"), "lifecycle"),
+    (re.compile(r"^/api/v\d+/clients/"), "heavy"),  # Bundles, zip and base64 work
+    (re.compile(r"^/api/(v\d+/(healthcheck|changes)|metrics|docs|openapi\.json)(/|$)"), None),
+    (re.compile(r"^/api/"), "default"),
+)
+
+
+def route_class(path: str) -> Optional[str]:
+    """Which limit the path falls under, None if it is not limited"""
+    for pattern, name in ROUTE_CLASSES:
+        if pattern.match(path):
+            return name
+    return None
+
+
+class TokenBucket:  # pylint: disable=too-few-public-methods
+    """Allows burst requests at once and rate per second after that"""
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float, now: float) -> None:
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate: float, burst: float, now: float) -> float:
+        """Take a token, returns 0 if there was one and otherwise the seconds until there is"""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class RateLimiter:  # pylint: disable=too-few-public-methods
+    """Token bucket per client, the least recently seen clients are forgotten (which refills their bucket)"""
+
+    def __init__(self, rate: float, burst: int, max_clients: int = 10000) -> None:
+        self.rate = rate
+        self.burst = float(burst)
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def take(self, client: str) -> float:
+        """Take a token for the client, returns 0 if allowed and otherwise the seconds to wait"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.burst, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+        return bucket.take(self.rate, self.burst, now)
+
+
+class ConcurrencyLimiter:
+    """At most limit requests at once, the rest wait in a bounded queue with the priority ones first"""
+
+    def __init__(self, limit: int, max_queue: int = 64) -> None:
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        # Priority waiters, then the normal ones
+        self._waiters: Tuple[Deque["asyncio.Future[None]"], Deque["asyncio.Future[None]"]] = (deque(), deque())
+
+    @property
+    def depth(self) -> int:
+        """Requests waiting for a slot"""
+        return len(self._waiters[0]) + len(self._waiters[1])
+
+    async def acquire(self, priority: bool = False, timeout: float = 5.0) -> bool:
+        """Wait for a slot, False if the queue is full or the wait timed out. Priority requests skip the queue limit"""
+        if self.active < self.limit and not self.depth:
+            self.active += 1
+            return True
+        if not priority and self.depth >= self.max_queue:
+            return False
+        queue = self._waiters[0 if priority else 1]
+        waiter: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            # The slot may have been handed to us in the same loop iteration the timeout expired
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            return False
+        except asyncio.CancelledError:
+            # The slot may have been handed to us just before the cancel
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in queue:
+                queue.remove(waiter)
+        return True
+
+    def release(self) -> None:
+        """Hand the slot to the next waiter or free it"""
+        for queue in self._waiters:
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self.active -= 1
+
+
+class AdmissionController:
+    """The limits of this worker"""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        rate_limiter: RateLimiter,
+        limiters: Dict[str, ConcurrencyLimiter],
+        queue_timeout: float = 5.0,
+        max_loop_lag: float = 0.25,
+        retry_after: int = 1,
+    ) -> None:
+        self.rate_limiter = rate_limiter
+        self.limiters = limiters
+        self.queue_timeout = queue_timeout
+        self.max_loop_lag = max_loop_lag
+        self.retry_after = retry_after
+        # (route class, reason) -> count
+        self.rejected: "Counter[Tuple[str, str]]" = Counter()
+
+    def overloaded(self) -> bool:
+        """Is the event loop lagging so much that new work would just make everything later"""
+        return 0 < self.max_loop_lag < get_health_monitor().lag_monitor.lag
+
+    def reject(self, name: str, reason: str, retry_after: float) -> JSONResponse:
+        """Fast error response, 429 for rate limited clients and 503 when shedding load"""
+        key = (name, reason)
+        self.rejected[key] += 1
+        get_metrics_store().observe_rejection(name, reason)
+        if self.rejected[key] % 1000 == 1:  # Don't make the overload worse with logging
+            LOGGER.warning("Rejected {} {} requests, reason: {}".format(self.rejected[key], name, reason))
+        status = 429 if reason == "rate" else 503
+        return JSONResponse(
+            {"detail": "Too many requests" if status == 429 else "Service overloaded"},
+            status_code=status,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+
+class AdmissionMiddleware:  # pylint: disable=too-few-public-methods
+    """Pure ASGI so rejected requests cost next to nothing"""
+
+    def __init__(self, app: ASGIApp, controller: Optional[AdmissionController] = None) -> None:
+        self.app = app
+        self.controller = controller or get_admission_controller()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        name = route_class(scope["path"]) if scope["type"] == "http" else None
+        if name is None:
+            await self.app(scope, receive, send)
+            return
+        controller = self.controller
+        dn = Headers(scope=scope).get(DN_HEADER)
+        is_rm = (await get_authorizer().principal(dn)).is_rm if dn else False
+        if not is_rm:
+            if controller.overloaded():
+                await controller.reject(name, "lag", controller.retry_after)(scope, receive, send)
+                return
+            # Without a certificate the request gets a 403 soon enough, share one bucket for those
+            wait = controller.rate_limiter.take(dn or "")
+            if wait > 0:
+                await controller.reject(name, "rate", wait)(scope, receive, send)
+                return
+        limiter = controller.limiters[name]
+        if not await limiter.acquire(priority=is_rm, timeout=controller.queue_timeout):
+            await controller.reject(name, "queue", controller.retry_after)(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
+
+
+@functools.cache
+def get_admission_controller() -> AdmissionController:
+    """Get the admission controller for this process"""
+    return AdmissionController(
+        RateLimiter(ADMISSION_RATE, ADMISSION_BURST, ADMISSION_CLIENTS),
+        {
+            "lifecycle": ConcurrencyLimiter(ADMISSION_LIFECYCLE_CONCURRENCY, ADMISSION_QUEUE_SIZE),
+            "heavy": ConcurrencyLimiter(ADMISSION_HEAVY_CONCURRENCY, ADMISSION_QUEUE_SIZE),
+            "default": ConcurrencyLimiter(ADMISSION_DEFAULT_CONCURRENCY, ADMISSION_QUEUE_SIZE),
+        },
+        queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+        max_loop_lag=ADMISSION_MAX_LOOP_LAG,
+        retry_after=ADMISSION_RETRY_AFTER,
+    )
@@ -8,9 +8,11 @@ from .admininfo import router as admininfo_router
 from .healthcheck import router as healthcheck_router
 from .description import router as description_router
 from .instructions import router as instructions_router
+from .changes import router as changes_router
 
 from .description import router_v2 as description_router_v2
 from .userinfo import router as userinfo_router
+from .metrics import router as metrics_router
 
 
 all_routers = APIRouter()
@@ -20,6 +22,7 @@ all_routers.include_router(admininfo_router, prefix="/admins", tags=["admins"])
 all_routers.include_router(healthcheck_router, prefix="/healthcheck", tags=["healthcheck"])
 all_routers.include_router(description_router, prefix="/description", tags=["description"])
 all_routers.include_router(instructions_router, prefix="/instructions", tags=["instructions"])
+all_routers.include_router(changes_router, prefix="/changes", tags=["changes"])
 
 all_routers_v2 = APIRouter()
 all_routers_v2.include_router(description_router_v2, prefix="/description", tags=["description"])
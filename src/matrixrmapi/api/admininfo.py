@@ -1,23 +1,127 @@
 """Endpoints for information for the admin"""
 
+from typing import AsyncIterator, List, Literal, Optional
+import asyncio
+import csv
+import io
 import logging
 
-from fastapi import APIRouter, Depends
-from libpvarki.middleware import MTLSHeader
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from libpvarki.schemas.product import UserInstructionFragment
-from jinja2 import Environment, FileSystemLoader
+from pydantic import BaseModel, Field
 
-from ..config import TEMPLATES_PATH
+from ..auth import MTLSAuth, require_admin
+from ..config import EXPORT_PAGE_SIZE, PROFILE_MAX_SECONDS
+from ..httpcache import content_disposition
+from ..profiling import PROFILE_ID_HEADER, get_profiler
+from ..registry import UserFilter, UserRecord, get_registry
+from ..rendering import get_template_engine
+from ..serialization import ModelJSONRoute
 
 LOGGER = logging.getLogger(__name__)
 
-router = APIRouter(dependencies=[Depends(MTLSHeader(auto_error=True))])
+router = APIRouter(route_class=ModelJSONRoute, dependencies=[Depends(MTLSAuth(auto_error=True))])
+EXPORT_FIELDS = list(UserRecord.model_fields)
+
+
+class UserPage(BaseModel):  # pylint: disable=too-few-public-methods
+    """One page of users"""
+
+    users: List[UserRecord] = Field(description="Users in UUID order")
+    next_cursor: Optional[str] = Field(default=None, description="Pass as cursor to get the next page, null if done")
 
 
 @router.get("/fragment", deprecated=True)
 async def admin_instruction_fragment() -> UserInstructionFragment:
     """Return user instructions, we use POST because the integration layer might not keep
     track of callsigns and certs by UUID and will probably need both for the instructions"""
-    template = Environment(loader=FileSystemLoader(TEMPLATES_PATH), autoescape=True).get_template("admininfo.html")
-    result = UserInstructionFragment(html=template.render())
-    return result
+    return UserInstructionFragment(html=get_template_engine().render("admininfo.html"))
+
+
+@router.get("/users")
+async def list_users(
+    request: Request,
+    state: UserFilter = "all",
+    cursor: Optional[str] = Query(default=None, description="next_cursor of the previous page"),
+    limit: int = Query(default=100, ge=1, le=1000),
+) -> UserPage:
+    """Page through the users known to this product"""
+    require_admin(request)
+    users = await get_registry().page(state, cursor, limit)
+    return UserPage(users=users, next_cursor=users[-1].uuid if len(users) == limit else None)
+
+
+async def export_ndjson(state: UserFilter) -> AsyncIterator[bytes]:
+    """One UserRecord JSON object per line, a registry page per chunk"""
+    async for users in get_registry().iter_pages(state, EXPORT_PAGE_SIZE):
+        yield b"".join(user.model_dump_json().encode("utf-8") + b"\n" for user in users)
+
+
+async def export_csv(state: UserFilter) -> AsyncIterator[bytes]:
+    """Header row and one row per user, a registry page per chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    async for users in get_registry().iter_pages(state, EXPORT_PAGE_SIZE):
+        for user in users:
+            writer.writerow(
+                str(value).lower() if isinstance(value, bool) else value
+                for value in (getattr(user, name) for name in EXPORT_FIELDS)
+            )
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")  # Just the header, no users
+
+
+@router.get(
+    "/users/export",
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "content": {"application/x-ndjson": {}, "text/csv": {}},
+            "description": "One UserRecord per line (NDJSON) or row (CSV)",
+        }
+    },
+)
+async def export_users(
+    request: Request, state: UserFilter = "all", fmt: Literal["ndjson", "csv"] = Query(default="ndjson", alias="format")
+) -> StreamingResponse:
+    """Stream all matching users, memory use stays the same no matter how many there are"""
+    principal = require_admin(request)
+    LOGGER.info("{} exporting {} users as {}".format(principal.cn, state, fmt))
+    if fmt == "csv":
+        stream, media_type = export_csv(state), "text/csv; charset=utf-8"
+    else:
+        stream, media_type = export_ndjson(state), "application/x-ndjson"
+    return StreamingResponse(
+        stream,
+        media_type=media_type,
+        headers={"Content-Disposition": content_disposition(f"users-{state}.{fmt}"), "Cache-Control": "no-store"},
+    )
+
+
+@router.post("/profiles", response_class=PlainTextResponse)
+async def take_profile(
+    request: Request, seconds: float = Query(default=10.0, gt=0, le=PROFILE_MAX_SECONDS)
+) -> PlainTextResponse:
+    """Sample the CPU of the worker that gets this request for the given time, returns the stacks in the folded
+    format flamegraph tools take. Send "X-Profile: 1" with any request to profile just that one instead"""
+    principal = require_admin(request)
+    LOGGER.info("{} profiling for {}s".format(principal.cn, seconds))
+    profiler = get_profiler()
+    profile = await profiler.sample(seconds)
+    await asyncio.to_thread(profiler.save, profile)
+    return PlainTextResponse(profile.folded(), headers={PROFILE_ID_HEADER: profile.id, "Cache-Control": "no-store"})
+
+
+@router.get("/profiles/{profile_id}", response_class=PlainTextResponse)
+async def get_profile(request: Request, profile_id: str) -> PlainTextResponse:
+    """Saved profile by the X-Profile-Id header of the profiled response, from any worker"""
+    require_admin(request)
+    folded = await asyncio.to_thread(get_profiler().load, profile_id)
+    if folded is None:
+        raise HTTPException(status_code=404)
+    return PlainTextResponse(folded, headers={"Cache-Control": "no-store"})
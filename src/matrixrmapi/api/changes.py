@@ -0,0 +1,81 @@
+"""Change feed so clients don't have to poll the fragment, description and info endpoints"""
+
+from typing import Any, Callable, Dict, List, Optional
+import logging
+
+from fastapi import APIRouter, Depends, Header, Query, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+
+from ..auth import MTLSAuth, Principal, get_principal
+from ..changes import ChangeEvent, get_change_feed
+from ..serialization import ModelJSONRoute
+
+LOGGER = logging.getLogger(__name__)
+
+router = APIRouter(route_class=ModelJSONRoute, dependencies=[Depends(MTLSAuth(auto_error=True))])
+
+
+class ChangeItem(BaseModel):  # pylint: disable=too-few-public-methods
+    """One change"""
+
+    id: int = Field(description="Event id, same in every worker")
+    kind: str = Field(description="user or manifest")
+    data: Dict[str, Any] = Field(description="user: event, uuid and callsign. manifest: deployment and digest")
+
+
+class ChangePage(BaseModel):  # pylint: disable=too-few-public-methods
+    """Changes since the given id"""
+
+    events: List[ChangeItem] = Field(description="Oldest first, empty if nothing happened before the timeout")
+    last_event_id: int = Field(description="Pass as after to get the next changes")
+    reset: bool = Field(default=False, description="Changes were lost, refetch everything before continuing")
+
+
+def visible_to(principal: Principal) -> Callable[[ChangeEvent], bool]:
+    """Filter for the events the principal may see, users only see what happens to themselves"""
+    everything = principal.is_rm or principal.is_admin
+
+    def _visible(event: ChangeEvent) -> bool:
+        return everything or event.subject is None or event.subject == principal.cn
+
+    return _visible
+
+
+@router.get(
+    "",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"text/event-stream": {}}, "description": "user, manifest and reset events"}},
+)
+async def change_stream(
+    request: Request,
+    last_event_id: Optional[int] = Header(default=None),
+    after: Optional[int] = Query(default=None, description="For the first connect, browsers send Last-Event-ID"),
+) -> StreamingResponse:
+    """Server-sent events for every change from now, or from the given event id on.
+
+    A reset event means the changes since that id are not available anymore and the client should refetch."""
+    principal = get_principal(request)
+    resume = last_event_id if last_event_id is not None else after
+    return StreamingResponse(
+        get_change_feed().stream(resume, visible_to(principal)),
+        media_type="text/event-stream",
+        # Tell nginx not to buffer it
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/poll")
+async def change_poll(
+    request: Request,
+    after: Optional[int] = Query(default=None, description="last_event_id of the previous response"),
+    timeout: float = Query(default=25.0, ge=0, le=60, description="Seconds to wait for changes"),
+) -> ChangePage:
+    """Long-poll alternative to the event stream"""
+    visible = visible_to(get_principal(request))
+    events, last_event_id, reset = await get_change_feed().wait(after, timeout)
+    return ChangePage(
+        events=[ChangeItem.model_validate(event.to_dict()) for event in events if visible(event)],
+        last_event_id=last_event_id,
+        reset=reset,
+    )
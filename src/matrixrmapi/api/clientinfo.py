@@ -1,44 +1,82 @@
 """Endpoints for information for the end-user"""
 
 from typing import List, Dict
+import hashlib
 import logging
-import io
-import zipfile
-import base64
 
-from fastapi import APIRouter, Depends
-from libpvarki.middleware import MTLSHeader
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import Response
 from libpvarki.schemas.product import UserCRUDRequest
 
+from ..auth import MTLSAuth, get_principal
+from ..bundles import bundle_key, get_bundle_cache
+from ..httpcache import bytes_response, content_disposition, quote_etag
+from ..registry import get_registry
+from ..serialization import ModelJSONRoute
+
 LOGGER = logging.getLogger(__name__)
 
-router = APIRouter(dependencies=[Depends(MTLSHeader(auto_error=True))])
+router = APIRouter(route_class=ModelJSONRoute, dependencies=[Depends(MTLSAuth(auto_error=True))])
+
+
+def bundle_url(uuid: str, filename: str) -> str:
+    """Path for downloading a bundle file"""
+    return f"/api/v1/clients/bundle/{uuid}/{filename}"
+
 
+async def bundle_files(user: UserCRUDRequest, inline: bool = True) -> List[Dict[str, str]]:
+    """Title, data, filename and url of the bundle files, with inline=False the data is the url"""
+    bundle = await get_bundle_cache().get(user.callsign, user.x509cert)
+    result = []
+    for item in bundle.fragment:
+        url = bundle_url(user.uuid, item["filename"])
+        result.append({**item, "url": url} if inline else {**item, "data": url, "url": url})
+    return result
 
-def zip_pem(pem: str, filename: str) -> bytes:
-    """in-memory zip of the pem"""
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-        zip_file.writestr(filename, pem)
-    return zip_buffer.getvalue()
+
+def fragment_etag(user: UserCRUDRequest, inline: bool) -> str:
+    """The fragment is the same for the same user, certificate and inline, so is its compressed form"""
+    key = bundle_key(user.callsign, user.x509cert)
+    return quote_etag(hashlib.sha256(f"{key}\0{user.uuid}\0{inline:d}".encode("utf-8")).hexdigest()[:32])
 
 
 @router.post("/fragment", deprecated=True)
-async def client_instruction_fragment(user: UserCRUDRequest) -> List[Dict[str, str]]:
+async def client_instruction_fragment(
+    user: UserCRUDRequest, response: Response, inline: bool = True
+) -> List[Dict[str, str]]:
     """Return user instructions, we use POST because the integration layer might not keep
-    track of callsigns and certs by UUID and will probably need both for the instructions"""
-    zip1_bytes = zip_pem(user.x509cert, f"{user.callsign}_1.pem")
-    zip2_bytes = zip_pem(user.x509cert, f"{user.callsign}_2.pem")
-
-    return [
-        {
-            "title": "iMatrix",
-            "data": f"data:application/zip;base64,{base64.b64encode(zip1_bytes).decode('ascii')}",
-            "filename": f"{user.callsign}_1.zip",
-        },
-        {
-            "title": "aMatrix",
-            "data": f"data:application/zip;base64,{base64.b64encode(zip2_bytes).decode('ascii')}",
-            "filename": f"{user.callsign}_2.zip",
-        },
-    ]
+    track of callsigns and certs by UUID and will probably need both for the instructions.
+
+    With inline=false the data is the download URL instead of a data URI"""
+    files = await bundle_files(user, inline)
+    # Lets the compression middleware compress it once
+    response.headers["ETag"] = fragment_etag(user, inline)
+    return files
+
+
+@router.get(
+    "/bundle/{uuid}/{filename}",
+    response_class=Response,
+    responses={200: {"content": {"application/zip": {}}}, 206: {}, 304: {}, 416: {}},
+)
+async def client_bundle_download(uuid: str, filename: str, request: Request) -> Response:
+    """Download onboarding zip, supports If-None-Match and Range"""
+    user = await get_registry().get_by_uuid(uuid)
+    if user is None or user.revoked:
+        raise HTTPException(status_code=404, detail="No such user")
+    principal = get_principal(request)
+    if not (principal.is_rm or principal.cn == user.callsign):
+        LOGGER.error("{} tried to download bundle of {}".format(principal.cn, user.callsign))
+        raise HTTPException(status_code=403, detail="Not your bundle")
+    bundle = await get_bundle_cache().get(user.callsign, user.x509cert)
+    item = bundle.file(filename)
+    if item is None:
+        raise HTTPException(status_code=404, detail="No such file")
+    return bytes_response(
+        request,
+        item.data,
+        quote_etag(item.etag),
+        media_type="application/zip",
+        headers={"Content-Disposition": content_disposition(item.filename), "Cache-Control": "private, no-cache"},
+        ranges=True,
+    )
@@ -1,17 +1,23 @@
 """Descriptions API"""
 
 from typing import Literal, Optional
+import functools
 import logging
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
 from pydantic import BaseModel, Field, Extra
 from libpvarki.schemas.product import ProductDescription
 
+from ..descriptions import DescriptionRegistry, SerializedDescription
+from ..httpcache import bytes_response
+from ..serialization import ModelJSONRoute
+
 
 LOGGER = logging.getLogger(__name__)
 
-router = APIRouter()  # These endpoints are public
-router_v2 = APIRouter()
+router = APIRouter(route_class=ModelJSONRoute)  # These endpoints are public
+router_v2 = APIRouter(route_class=ModelJSONRoute)
 
 
 PRODUCT_SHORTNAME = "matrix"
@@ -41,67 +47,83 @@ class ProductDescriptionExtended(BaseModel):  # pylint: disable=too-few-public-m
         extra = Extra.forbid
 
 
+DOCS_URL = "https://pvarki.github.io/Docusaurus-docs/docs/android/deployapp/home/"
+# language -> (v1 title, v2 title, description)
+TEXTS = {
+    "fi": ("Matrix", "Feikkituote", """"tuote" integraatioiden testaamiseen"""),
+    "en": ("Matrix", "Matrix", "Matrix messaging service"),
+    "sv": ("Matrix", "Falsk produkt", "Falsk produkt för integrationstestning och exempel"),
+}
+V1_LANGUAGES = ("fi", "en")
+
+
+@functools.cache
+def get_description_registry() -> DescriptionRegistry:
+    """Build all the descriptions once"""
+    component = ProductComponent(type="component", ref=f"/ui/{PRODUCT_SHORTNAME}/remoteEntry.js")
+    return DescriptionRegistry(
+        {
+            "v1": {
+                language: ProductDescription(
+                    shortname=PRODUCT_SHORTNAME, title=title, icon=None, description=description, language=language
+                )
+                for language, (title, _, description) in TEXTS.items()
+                if language in V1_LANGUAGES
+            },
+            "v2": {
+                language: ProductDescriptionExtended(
+                    shortname=PRODUCT_SHORTNAME,
+                    title=title,
+                    icon=f"ui/{PRODUCT_SHORTNAME}/matrixlogo.svg",
+                    description=description,
+                    language=language,
+                    docs=DOCS_URL,
+                    component=component,
+                )
+                for language, (_, title, description) in TEXTS.items()
+            },
+        }
+    )
+
+
+def description_response(request: Request, description: SerializedDescription) -> Response:
+    """Send the pre-serialized body, or 304"""
+    return bytes_response(
+        request,
+        description.body,
+        description.etag,
+        media_type="application/json",
+        headers={
+            "Content-Language": description.language,
+            "Vary": "Accept-Language",
+            "Cache-Control": "public, max-age=300",
+        },
+    )
+
+
 @router.get(
     "/{language}",
-    response_model=ProductDescription,
+    response_class=Response,
+    responses={200: {"model": ProductDescription}, 304: {}, 404: {}},
 )
-async def return_product_description(language: str) -> ProductDescription:
+async def return_product_description(language: str, request: Request) -> Response:
     """Fetch description from each product in manifest"""
-    LOGGER.debug("Got language: {}".format(language))
-    if language == "fi":
-        return ProductDescription(
-            shortname=PRODUCT_SHORTNAME,
-            title="Matrix",
-            icon=None,
-            description=""""tuote" integraatioiden testaamiseen""",
-            language="fi",
-        )
-    if language == "en":
-        return ProductDescription(
-            shortname=PRODUCT_SHORTNAME,
-            title="Matrix",
-            icon=None,
-            description="Matrix messaging service",
-            language="en",
-        )
     # NOTE: Generally should return just the default language but this is for testing purposes
-    raise HTTPException(status_code=404)
+    description = get_description_registry().get("v1", language, request.headers.get("accept-language"), fallback=False)
+    if description is None:
+        raise HTTPException(status_code=404)
+    return description_response(request, description)
 
 
 @router_v2.get(
     "/{language}",
-    response_model=ProductDescriptionExtended,
+    response_class=Response,
+    responses={200: {"model": ProductDescriptionExtended}, 304: {}},
 )
-async def return_product_description_extended(language: str) -> ProductDescriptionExtended:
-    """Fetch description from each product in manifest"""
-    docs_url = "https://pvarki.github.io/Docusaurus-docs/docs/android/deployapp/home/"
-
-    if language == "fi":
-        return ProductDescriptionExtended(
-            shortname=PRODUCT_SHORTNAME,
-            title="Feikkituote",
-            icon=f"ui/{PRODUCT_SHORTNAME}/matrixlogo.svg",
-            description=""""tuote" integraatioiden testaamiseen""",
-            language=language,
-            docs=docs_url,
-            component=ProductComponent(type="component", ref=f"/ui/{PRODUCT_SHORTNAME}/remoteEntry.js"),
-        )
-    if language == "sv":
-        return ProductDescriptionExtended(
-            shortname=PRODUCT_SHORTNAME,
-            title="Falsk produkt",
-            icon=f"ui/{PRODUCT_SHORTNAME}/matrixlogo.svg",
-            description="Falsk produkt för integrationstestning och exempel",
-            language=language,
-            docs=docs_url,
-            component=ProductComponent(type="component", ref=f"/ui/{PRODUCT_SHORTNAME}/remoteEntry.js"),
-        )
-    return ProductDescriptionExtended(
-        shortname=PRODUCT_SHORTNAME,
-        title="Matrix",
-        icon=f"ui/{PRODUCT_SHORTNAME}/matrixlogo.svg",
-        description="Matrix messaging service",
-        language=language,
-        docs=docs_url,
-        component=ProductComponent(type="component", ref=f"/ui/{PRODUCT_SHORTNAME}/remoteEntry.js"),
-    )
+async def return_product_description_extended(language: str, request: Request) -> Response:
+    """Fetch description from each product in manifest, unknown languages get the best match from
+    Accept-Language or English"""
+    description = get_description_registry().get("v2", language, request.headers.get("accept-language"))
+    if description is None:
+        raise HTTPException(status_code=404)
+    return description_response(request, description)
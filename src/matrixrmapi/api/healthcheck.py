@@ -3,16 +3,19 @@
 import logging
 
 from fastapi import APIRouter, Depends
-from libpvarki.middleware import MTLSHeader
 from libpvarki.schemas.product import ProductHealthCheckResponse
 
+from ..auth import MTLSAuth
+from ..health import get_health_monitor
+from ..serialization import ModelJSONRoute
+
 
 LOGGER = logging.getLogger(__name__)
 
-router = APIRouter(dependencies=[Depends(MTLSHeader(auto_error=True))])
+router = APIRouter(route_class=ModelJSONRoute, dependencies=[Depends(MTLSAuth(auto_error=True))])
 
 
 @router.get("")
 async def request_healthcheck() -> ProductHealthCheckResponse:
-    """Check that we are healthy, return accordingly"""
-    return ProductHealthCheckResponse(healthy=True, extra="Dummy, nothing actually checked")
+    """Check that we are healthy, return accordingly, the probes run in the background"""
+    return get_health_monitor().response
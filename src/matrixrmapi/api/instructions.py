@@ -4,19 +4,27 @@ from typing import Dict
 import logging
 
 from fastapi import APIRouter, Depends
-from libpvarki.middleware import MTLSHeader
 from libpvarki.schemas.product import UserCRUDRequest
 
+from ..auth import MTLSAuth
+from ..catalog import get_catalog
+from ..config import get_manifest
+from ..serialization import ModelJSONRoute
+
 LOGGER = logging.getLogger(__name__)
 
-router = APIRouter(dependencies=[Depends(MTLSHeader(auto_error=True))])
+router = APIRouter(route_class=ModelJSONRoute, dependencies=[Depends(MTLSAuth(auto_error=True))])
 
 
 @router.post("/{language}")
-async def user_intructions(user: UserCRUDRequest) -> Dict[str, str]:
+async def user_intructions(language: str, user: UserCRUDRequest) -> Dict[str, str]:
     """return user instructions"""
+    catalog = get_catalog()
+    language = catalog.resolve("instructions", language)
     return {
         "callsign": user.callsign,
-        "instructions": "FIXME: Return something sane",
-        "language": "en",
+        "instructions": catalog.render(
+            "instructions", language, user.callsign, str(get_manifest().get("deployment")), user.uuid
+        ),
+        "language": language,
     }
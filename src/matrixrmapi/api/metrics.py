@@ -0,0 +1,20 @@
+"""Prometheus metrics endpoint"""
+
+import asyncio
+import logging
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from ..metrics import get_metrics_store
+
+LOGGER = logging.getLogger(__name__)
+
+router = APIRouter()  # Scraped from inside the deployment network without client certs
+
+
+@router.get("", response_class=PlainTextResponse)
+async def get_metrics() -> PlainTextResponse:
+    """Metrics of all the workers in Prometheus text format"""
+    text = await asyncio.to_thread(get_metrics_store().render)
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4; charset=utf-8")
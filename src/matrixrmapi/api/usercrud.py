@@ -1,37 +1,52 @@
 """ "User actions"""
 
+from typing import AsyncIterator, List, Tuple
 import logging
+import tempfile
 
-from fastapi import APIRouter, Depends, Request, HTTPException
-from libpvarki.middleware import MTLSHeader
+from fastapi import APIRouter, Depends, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 from libpvarki.schemas.product import UserCRUDRequest
 from libpvarki.schemas.generic import OperationResultResponse
 
-from ..config import get_manifest
+from ..auth import MTLSAuth, require_rm
+from ..config import BATCH_CHUNK_SIZE, BATCH_MAX_LINE_BYTES, BATCH_SPOOL_BYTES
+from ..lifecycle import EventType, LifecycleEvent, BatchItemResult, apply_event_once, apply_events, iter_ndjson_lines
+from ..idempotency import IDEMPOTENCY_HEADER, event_key
+from ..reconcile import Reconciler, ReconcileResult
+from ..serialization import ModelJSONRoute
 
 LOGGER = logging.getLogger(__name__)
 
-router = APIRouter(dependencies=[Depends(MTLSHeader(auto_error=True))])
+router = APIRouter(route_class=ModelJSONRoute, dependencies=[Depends(MTLSAuth(auto_error=True))])
 
 
 def comes_from_rm(request: Request) -> None:
     """Check the CN, raises 403 if not"""
-    payload = request.state.mtlsdn
-    manifest = get_manifest()
-    if payload.get("CN") != manifest["rasenmaeher"]["certcn"]:
-        raise HTTPException(status_code=403)
+    require_rm(request)
+
+
+async def handle_event(
+    event: EventType, user: UserCRUDRequest, request: Request, response: Response
+) -> OperationResultResponse:
+    """Check the caller and apply single event unless it's a retry of one we already did"""
+    comes_from_rm(request)
+    key = event_key(event, user, request.headers.get(IDEMPOTENCY_HEADER))
+    result, replayed = await apply_event_once(LifecycleEvent(event=event, user=user), key)
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
 
 
 @router.post("/created")
 async def user_created(
     user: UserCRUDRequest,
     request: Request,
+    response: Response,
 ) -> OperationResultResponse:
     """New device cert was created"""
-    comes_from_rm(request)
-    _ = user  # TODO: should we validate the cert at this point ??
-    result = OperationResultResponse(success=True)
-    return result
+    return await handle_event("created", user, request, response)
 
 
 # While delete would be semantically better it takes no body and definitely forces the
@@ -40,45 +55,151 @@ async def user_created(
 async def user_revoked(
     user: UserCRUDRequest,
     request: Request,
+    response: Response,
 ) -> OperationResultResponse:
     """Device cert was revoked"""
-    comes_from_rm(request)
-    _ = user
-    result = OperationResultResponse(success=True)
-    return result
+    return await handle_event("revoked", user, request, response)
 
 
 @router.post("/promoted")
 async def user_promoted(
     user: UserCRUDRequest,
     request: Request,
+    response: Response,
 ) -> OperationResultResponse:
     """Device cert was promoted to admin privileges"""
-    comes_from_rm(request)
-    _ = user
-    result = OperationResultResponse(success=True)
-    return result
+    return await handle_event("promoted", user, request, response)
 
 
 @router.post("/demoted")
 async def user_demoted(
     user: UserCRUDRequest,
     request: Request,
+    response: Response,
 ) -> OperationResultResponse:
     """Device cert was demoted to standard privileges"""
-    comes_from_rm(request)
-    _ = user
-    result = OperationResultResponse(success=True)
-    return result
+    return await handle_event("demoted", user, request, response)
 
 
 @router.put("/updated")
 async def user_updated(
     user: UserCRUDRequest,
     request: Request,
+    response: Response,
 ) -> OperationResultResponse:
     """Device callsign updated"""
+    return await handle_event("updated", user, request, response)
+
+
+async def _apply_chunk(chunk: List[Tuple[int, LifecycleEvent]]) -> List[BatchItemResult]:
+    """Apply parsed events and pair the results with line numbers"""
+    results = await apply_events([event for _, event in chunk])
+    return [
+        BatchItemResult(
+            index=index,
+            event=event.event,
+            uuid=event.user.uuid,
+            success=result.success,
+            error=result.error,
+        )
+        for (index, event), result in zip(chunk, results)
+    ]
+
+
+@router.post(
+    "/batch",
+    response_class=StreamingResponse,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/x-ndjson": {
+                    "schema": {"type": "string", "description": "One LifecycleEvent JSON object per line"}
+                }
+            },
+        }
+    },
+    responses={200: {"content": {"application/x-ndjson": {}}, "description": "One BatchItemResult per line"}},
+)
+async def users_batch(request: Request) -> StreamingResponse:
+    """Apply an ordered stream of lifecycle events (NDJSON), caller is checked once.
+
+    Events are applied in chunks as they are read, results are spooled (to disk if there are many of them)
+    and streamed back one per line in the same order."""
+    comes_from_rm(request)
+    spool = tempfile.SpooledTemporaryFile(max_size=BATCH_SPOOL_BYTES)  # pylint: disable=consider-using-with
+    total, failed = 0, 0
+    chunk: List[Tuple[int, LifecycleEvent]] = []
+
+    def write(results: List[BatchItemResult]) -> None:
+        nonlocal failed
+        for result in results:
+            failed += int(not result.success)
+            spool.write(result.model_dump_json().encode("utf-8") + b"\n")
+
+    try:
+        async for index, line in iter_ndjson_lines(request.stream(), BATCH_MAX_LINE_BYTES):
+            total += 1
+            if not line:
+                write([BatchItemResult(index=index, success=False, error="Line too long")])
+                continue
+            try:
+                chunk.append((index, LifecycleEvent.model_validate_json(line)))
+            except ValidationError as exc:
+                # Results must stay in request order so flush whatever was parsed before this line
+                if chunk:
+                    write(await _apply_chunk(chunk))
+                    chunk = []
+                write([BatchItemResult(index=index, success=False, error=f"Invalid event: {exc.error_count()} errors")])
+                continue
+            if len(chunk) >= BATCH_CHUNK_SIZE:
+                write(await _apply_chunk(chunk))
+                chunk = []
+        if chunk:
+            write(await _apply_chunk(chunk))
+    except BaseException:
+        # Client went away or the registry failed, stream_results is never going to close it
+        spool.close()
+        raise
+    LOGGER.info("Batch of {} events applied, {} failed".format(total, failed))
+
+    async def stream_results() -> AsyncIterator[bytes]:
+        """Stream the spooled results back"""
+        try:
+            spool.seek(0)
+            while data := spool.read(65536):
+                yield data
+        finally:
+            spool.close()
+
+    return StreamingResponse(
+        stream_results(),
+        media_type="application/x-ndjson",
+        headers={"X-Batch-Total": str(total), "X-Batch-Failed": str(failed)},
+    )
+
+
+@router.post(
+    "/reconcile",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/x-ndjson": {
+                    "schema": {"type": "string", "description": "One SnapshotRecord JSON object per line"}
+                }
+            },
+        }
+    },
+)
+async def users_reconcile(request: Request, dry_run: bool = False, allow_empty: bool = False) -> ReconcileResult:
+    """Sync with full snapshot of users (NDJSON), users missing from the snapshot get revoked.
+
+    Only the differences are applied, through the same path as the single events. An empty snapshot revokes no one
+    unless allow_empty is set."""
     comes_from_rm(request)
-    _ = user
-    result = OperationResultResponse(success=True)
+    result = await Reconciler(dry_run=dry_run, allow_empty=allow_empty).run(
+        iter_ndjson_lines(request.stream(), BATCH_MAX_LINE_BYTES)
+    )
+    LOGGER.info("Reconcile done: {}".format(result.model_dump_json()))
     return result
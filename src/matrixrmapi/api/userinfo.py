@@ -4,15 +4,19 @@ import logging
 
 from fastapi import APIRouter, Depends, Request
 from fastapi.responses import PlainTextResponse
-from libpvarki.middleware import MTLSHeader
-from libpvarki.schemas.product import UserCRUDRequest
+from libpvarki.schemas.product import UserCRUDRequest, UserInstructionFragment
 
+from ..auth import MTLSAuth
 from ..config import get_manifest
+from ..catalog import get_catalog
+from ..rendering import get_template_engine
+from ..serialization import ModelJSONRoute
+from .clientinfo import bundle_files
 from .usercrud import comes_from_rm
 
 LOGGER = logging.getLogger(__name__)
 
-router = APIRouter(dependencies=[Depends(MTLSHeader(auto_error=True))])
+router = APIRouter(route_class=ModelJSONRoute, dependencies=[Depends(MTLSAuth(auto_error=True))])
 
 
 def get_callsign(request: Request) -> str:
@@ -29,24 +33,14 @@ async def get_info(
 ) -> str:
     """Return customized markdown"""
     comes_from_rm(request)
-    callsign = user.callsign
-    manifest = get_manifest()
-    dname = manifest.get("deployment")
-    if language == "fi":
-        return f"""
-## Feikkituote
+    return get_catalog().render("info", language, user.callsign, str(get_manifest().get("deployment")), user.uuid)
 
-Terve {callsign}! Tämä on esimerkki tuoteintegraatioiden kehittäjille.
 
-Pyörii deploymentissa "{dname}"
-
-        """
-    # TODO: Add Swedish
-    # Fall-back to english
-    return f"""
-## Matrix product
-
-Hello {callsign}! This is a minimal example integration for integration developers' reference.
-
-Running on deployment "{dname}"
-"""
+@router.post("/fragment")
+async def client_html_fragment(user: UserCRUDRequest, request: Request) -> UserInstructionFragment:
+    """Return the download links as HTML"""
+    comes_from_rm(request)
+    files = await bundle_files(user, inline=False)
+    return UserInstructionFragment(
+        html=get_template_engine().render("clientinfo.html", callsign=user.callsign, files=files)
+    )
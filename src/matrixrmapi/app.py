@@ -1,36 +1,168 @@
 """ "factory for the fastpi app"""
 
+from typing import Any, AsyncGenerator, Dict
+from contextlib import asynccontextmanager
+import asyncio
 import logging
+import re
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from libpvarki.logging import init_logging
 
 from matrixrmapi import __version__
-from .config import LOG_LEVEL, get_manifest
+from .config import (
+    LOG_LEVEL,
+    AUTH_REFRESH_INTERVAL,
+    ADMISSION_ENABLED,
+    PROVISIONING_DRAIN_TIMEOUT,
+    get_manifest_provider,
+)
+from .auth import keep_roles_fresh, refresh_roles
 from .api import all_routers, all_routers_v2
+from .api.metrics import router as metrics_router
+from .api.description import PRODUCT_SHORTNAME, get_description_registry
+from .registry import get_registry
+from .provisioning import get_provisioning
+from .coalesce import get_coalescer
+from .certs import get_certificate_service
+from .bundles import get_bundle_cache
+from .rendering import get_template_engine
+from .catalog import get_catalog
+from .health import get_health_monitor
+from .metrics import MetricsMiddleware, get_metrics_store
+from .openapi import install_openapi
+from .compression import CompressionMiddleware
+from .serialization import ModelJSONResponse
+from .static import get_asset_index
+from .changes import get_change_feed
+from .admission import AdmissionMiddleware
+from .profiling import TracingMiddleware
 
 LOGGER = logging.getLogger(__name__)
 
 
+@asynccontextmanager
+async def app_lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
+    """Start and stop the per-worker services"""
+    _ = app
+    manifest = get_manifest_provider()
+    await manifest.start()
+    registry = get_registry()
+    provisioning = get_provisioning()
+    get_template_engine().warm()
+    get_description_registry()
+    get_catalog()
+    await asyncio.to_thread(get_asset_index().build)
+    await registry.open()
+    feed = get_change_feed()
+    await feed.start()
+    unhook_feed = feed.close_on_exit()
+    await refresh_roles()
+    await provisioning.start()
+    roles_task = asyncio.create_task(keep_roles_fresh(AUTH_REFRESH_INTERVAL))
+    health = get_health_monitor()
+    await health.start()
+    metrics = get_metrics_store()
+    await metrics.start()
+    try:
+        yield
+    finally:
+        await metrics.stop()
+        await health.stop()
+        roles_task.cancel()
+        await asyncio.gather(roles_task, return_exceptions=True)
+        await get_bundle_cache().close()
+        # Both wait for the queued jobs, up to the drain timeout
+        await get_coalescer().close(PROVISIONING_DRAIN_TIMEOUT)
+        await provisioning.stop()
+        unhook_feed()
+        await feed.stop()
+        await registry.close()
+        get_certificate_service().close()
+        await manifest.stop()
+
+
+def deployment_domain_regex(manifest: Dict[str, Any]) -> str:
+    """Origins under the deployment domain"""
+    rm_base = manifest["rasenmaeher"]["init"]["base_uri"]
+    regex = str(rm_base).replace(".", r"\.").replace("https://", r"https://(.*\.)?")
+    LOGGER.info("deployment_domain_regex={}".format(regex))
+    return regex
+
+
+class DeploymentCORSMiddleware(CORSMiddleware):
+    """CORS for the deployment domain, recompiled when the manifest changes.
+
+    The pattern is read from the manifest on the first request, after the lifespan has loaded it, and the
+    subscription to changes ends with the lifespan"""
+
+    def __init__(self, app: ASGIApp, /, **kwargs: Any) -> None:
+        super().__init__(app, **kwargs)
+        self._subscribed = False
+
+    def manifest_changed(self, manifest: Dict[str, Any]) -> None:
+        """Swap the matcher"""
+        self.allow_origin_regex = re.compile(deployment_domain_regex(manifest))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan":
+
+            async def _receive() -> Message:
+                message = await receive()
+                if message["type"] == "lifespan.shutdown" and self._subscribed:
+                    get_manifest_provider().unsubscribe(self.manifest_changed)
+                    self._subscribed = False
+                return message
+
+            await self.app(scope, _receive, send)
+            return
+        if scope["type"] == "http" and not self._subscribed:
+            provider = get_manifest_provider()
+            self.manifest_changed(provider.current)
+            provider.subscribe(self.manifest_changed)
+            self._subscribed = True
+        await super().__call__(scope, receive, send)
+
+
 def get_app() -> FastAPI:
     """Returns the FastAPI application."""
     init_logging(LOG_LEVEL)
-    manifest = get_manifest()
-    rm_base = manifest["rasenmaeher"]["init"]["base_uri"]
-    deployment_domain_regex = rm_base.replace(".", r"\.").replace("https://", r"https://(.*\.)?")
-    LOGGER.info("deployment_domain_regex={}".format(deployment_domain_regex))
 
-    app = FastAPI(docs_url="/api/docs", openapi_url="/api/openapi.json", version=__version__)
+    app = FastAPI(
+        docs_url="/api/docs",
+        openapi_url="/api/openapi.json",
+        version=__version__,
+        lifespan=app_lifespan,
+        default_response_class=ModelJSONResponse,
+    )
+    if ADMISSION_ENABLED:
+        # Innermost so the 429 and 503 answers get CORS headers and browsers can read them
+        app.add_middleware(AdmissionMiddleware)
     app.add_middleware(
-        CORSMiddleware,
-        allow_origin_regex=deployment_domain_regex,
+        DeploymentCORSMiddleware,
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
     )
     app.include_router(router=all_routers, prefix="/api/v1")
     app.include_router(router=all_routers_v2, prefix="/api/v2")
+    app.include_router(router=metrics_router, prefix="/api/metrics", tags=["metrics"])
+    # The description points the UI here
+    app.add_route(
+        f"/ui/{PRODUCT_SHORTNAME}/{{path:path}}",
+        get_asset_index().endpoint,
+        methods=["GET", "HEAD"],
+        include_in_schema=False,
+    )
+    app.add_middleware(CompressionMiddleware)
+    # Outside admission control so time spent waiting for a slot shows up, and outside compression for the send span
+    app.add_middleware(TracingMiddleware)
+    # Added last so it's the outermost and sees the full time, the CORS responses and the bytes on the wire
+    app.add_middleware(MetricsMiddleware)
+    # With gunicorn --preload this happens once in the master and the workers inherit the bytes
+    install_openapi(app)
 
     LOGGER.info("API init done, setting log verbosity to '{}'.".format(logging.getLevelName(LOG_LEVEL)))
 
@@ -0,0 +1,224 @@
+"""mTLS client identity from the DN header NGinx sets, parsed by libpvarki once per distinct DN"""
+
+from typing import Dict, List, Mapping, Optional, Tuple
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+import asyncio
+import functools
+import json
+import logging
+import sqlite3
+import time
+
+from fastapi import HTTPException, Request
+from libpvarki.middleware import MTLSHeader
+
+from .changes import ChangeEvent, get_change_feed
+from .config import AUTH_CACHE_SIZE, get_manifest, get_manifest_provider
+from .registry import get_registry
+from .tracing import record
+
+LOGGER = logging.getLogger(__name__)
+DN_HEADER = "X-ClientCert-DN"
+# Lifecycle event -> new admin status, None keeps the old one
+ADMIN_CHANGES = {"promoted": True, "demoted": False}
+DN_PARSER = MTLSHeader(auto_error=False)
+
+
+@dataclass(frozen=True)
+class Principal:
+    """Who is calling"""
+
+    dn: str
+    cn: Optional[str]
+    attributes: Dict[str, str] = field(hash=False)
+    is_rm: bool = False
+
+    @property
+    def is_user(self) -> bool:
+        """Is an active user, changes with lifecycle events so not cached with the DN"""
+        return self.cn is not None and get_authorizer().is_user(self.cn)
+
+    @property
+    def is_admin(self) -> bool:
+        """Has admin privileges, changes with lifecycle events so not cached with the DN"""
+        return self.cn is not None and get_authorizer().is_admin(self.cn)
+
+
+async def parse_dn(dn: str) -> Dict[str, str]:
+    """Parse the "CN=foo,O=bar" style string NGinx gives us the way libpvarki's MTLSHeader does, empty if it can't"""
+    request = Request({"type": "http", "headers": [(DN_HEADER.lower().encode("latin-1"), dn.encode("latin-1"))]})
+    try:
+        await DN_PARSER(request)
+    except (ValueError, HTTPException):
+        LOGGER.warning("Could not parse DN {}".format(dn))
+        return {}
+    return dict(getattr(request.state, "mtlsdn", None) or {})
+
+
+def decrement(counter: "Counter[str]", key: str) -> None:
+    """Decrement and drop at zero so membership checks work"""
+    counter[key] -= 1
+    if counter[key] <= 0:
+        del counter[key]
+
+
+class Authorizer:  # pylint: disable=too-many-instance-attributes
+    """LRU of parsed DNs and the sets role checks are done against"""
+
+    def __init__(self, rm_cn: str, cache_size: int = 1024) -> None:
+        self.rm_cn = rm_cn
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[str, Principal]" = OrderedDict()
+        # uuid -> (callsign, admin) for active users, and how many active users/admins have each callsign
+        self._users: Dict[str, Tuple[str, bool]] = {}
+        self._user_callsigns: "Counter[str]" = Counter()
+        self._admin_callsigns: "Counter[str]" = Counter()
+        # Bumped by every update so a load of older data does not undo them
+        self.generation = 0
+
+    def set_rm_cn(self, rm_cn: str) -> None:
+        """RASENMAEHER CN changed, cached principals have the old decision"""
+        if rm_cn != self.rm_cn:
+            LOGGER.info("RASENMAEHER CN changed from {} to {}".format(self.rm_cn, rm_cn))
+            self.rm_cn = rm_cn
+            self._cache.clear()
+
+    def load(self, users: Mapping[str, Tuple[str, bool]], generation: Optional[int] = None) -> bool:
+        """Replace the role data with uuid -> (callsign, admin) of active users. With generation, skipped if there
+        have been updates since the generation was read as the data may not have them, returns was it loaded"""
+        if generation is not None and generation != self.generation:
+            return False
+        self._users = dict(users)
+        self._user_callsigns = Counter(callsign for callsign, _ in self._users.values())
+        self._admin_callsigns = Counter(callsign for callsign, admin in self._users.values() if admin)
+        return True
+
+    def update(self, uuid: str, callsign: Optional[str], admin: Optional[bool] = None) -> None:
+        """User changed, callsign None means revoked, admin None keeps the old status"""
+        self.generation += 1
+        previous = self._users.pop(uuid, None)
+        if previous is not None:
+            decrement(self._user_callsigns, previous[0])
+            if previous[1]:
+                decrement(self._admin_callsigns, previous[0])
+            if admin is None:
+                admin = previous[1]
+        if callsign is None:
+            return
+        admin = bool(admin)
+        self._users[uuid] = (callsign, admin)
+        self._user_callsigns[callsign] += 1
+        if admin:
+            self._admin_callsigns[callsign] += 1
+
+    def apply_changes(self, events: List[ChangeEvent]) -> None:
+        """Apply the user events of the change feed, so role changes handled by other workers take effect within
+        the feed poll interval. Replaying the events this worker already applied does not change anything"""
+        for event in events:
+            if event.kind != "user":
+                continue
+            data = json.loads(event.data)
+            if data["event"] == "revoked":
+                self.update(data["uuid"], None)
+            else:
+                self.update(data["uuid"], data["callsign"], ADMIN_CHANGES.get(data["event"]))
+
+    def is_user(self, callsign: str) -> bool:
+        """Is the callsign an active user"""
+        return callsign in self._user_callsigns
+
+    def is_admin(self, callsign: str) -> bool:
+        """Is the callsign an active admin"""
+        return callsign in self._admin_callsigns
+
+    async def principal(self, dn: str) -> Principal:
+        """Parsed principal for the DN"""
+        principal = self._cache.get(dn)
+        if principal is not None:
+            self.hits += 1
+            self._cache.move_to_end(dn)
+            return principal
+        self.misses += 1
+        attributes = await parse_dn(dn)
+        cn = attributes.get("CN")
+        principal = Principal(dn, cn, attributes, is_rm=cn is not None and cn == self.rm_cn)
+        self._cache[dn] = principal
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return principal
+
+
+@functools.cache
+def get_authorizer() -> Authorizer:
+    """Get the authorizer for this process"""
+    authorizer = Authorizer(get_manifest()["rasenmaeher"]["certcn"], AUTH_CACHE_SIZE)
+    get_manifest_provider().subscribe(lambda manifest: authorizer.set_rm_cn(manifest["rasenmaeher"]["certcn"]))
+    get_change_feed().subscribe(authorizer.apply_changes)
+    return authorizer
+
+
+async def refresh_roles() -> None:
+    """Reload the role data from the registry, it's the only thing shared by all the workers"""
+    authorizer = get_authorizer()
+    generation = authorizer.generation
+    if not authorizer.load(await get_registry().active_users(), generation):
+        LOGGER.debug("Roles changed while reading them, refreshing next time")
+
+
+async def keep_roles_fresh(interval: float) -> None:
+    """Reload role data periodically, the change feed applies the lifecycle events other workers handled right
+    away but it only has the latest events"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh_roles()
+        except sqlite3.Error:
+            LOGGER.exception("Could not refresh roles")
+
+
+class MTLSAuth(MTLSHeader):  # pylint: disable=too-few-public-methods
+    """libpvarki's MTLSHeader that parses each distinct DN only once, and puts the principal to request.state
+    next to the parsed DN"""
+
+    def __init__(self, auto_error: bool = True) -> None:
+        super().__init__(auto_error=auto_error)
+        self.scheme_name = MTLSHeader.__name__  # The OpenAPI security scheme stays libpvarki's
+
+    async def __call__(self, request: Request) -> Optional[Principal]:  # type: ignore[override]
+        started = time.perf_counter()
+        dn = request.headers.get(DN_HEADER)
+        if not dn:
+            await super().__call__(request)  # Raises 403 unless auto_error is off
+            return None
+        principal = await get_authorizer().principal(dn)
+        request.state.principal = principal
+        request.state.mtlsdn = principal.attributes
+        record("auth", started)
+        return principal
+
+
+def get_principal(request: Request) -> Principal:
+    """Principal set by MTLSAuth"""
+    principal = getattr(request.state, "principal", None)
+    if principal is None:
+        raise HTTPException(status_code=403)
+    return principal  # type: ignore[no-any-return]
+
+
+def require_rm(request: Request) -> Principal:
+    """Only RASENMAEHER is allowed, raises 403 if not"""
+    principal = get_principal(request)
+    if not principal.is_rm:
+        raise HTTPException(status_code=403)
+    return principal
+
+
+def require_admin(request: Request) -> Principal:
+    """RASENMAEHER or an admin user, raises 403 if not"""
+    principal = get_principal(request)
+    if not (principal.is_rm or principal.is_admin):
+        raise HTTPException(status_code=403)
+    return principal
@@ -0,0 +1,409 @@
+"""Benchmarks, either in-process through ASGI or against a running server"""
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+from dataclasses import dataclass, field
+from pathlib import Path
+import asyncio
+import json
+import logging
+import math
+import os
+import subprocess  # nosec B404
+import sys
+import tempfile
+import time
+import uuid as uuidlib
+
+from starlette.types import ASGIApp, Message
+
+LOGGER = logging.getLogger(__name__)
+DN_HEADER = "X-ClientCert-DN"
+# Runs in a fresh interpreter so nothing is imported yet, prints the phase timings as JSON
+STARTUP_SCRIPT = """
+import asyncio, json, time
+started = time.perf_counter()
+import matrixrmapi.app
+from matrixrmapi.bench import ASGITransport
+phases = {"import": time.perf_counter() - started}
+mark = time.perf_counter()
+app = matrixrmapi.app.get_app()
+phases["get_app"] = time.perf_counter() - mark
+
+async def main():
+    mark = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        phases["lifespan_startup"] = time.perf_counter() - mark
+        mark = time.perf_counter()
+        await ASGITransport(app).request("GET", app.openapi_url, b"", {"accept-encoding": "gzip"})
+        phases["first_openapi"] = time.perf_counter() - mark
+        mark = time.perf_counter()
+    phases["lifespan_shutdown"] = time.perf_counter() - mark
+
+asyncio.run(main())
+phases["total"] = time.perf_counter() - started
+print(json.dumps({key: round(value * 1000, 3) for key, value in phases.items()}))
+"""
+# Same, runs the benchmark with the options given as JSON in argv
+BENCH_SCRIPT = """
+import asyncio, json, sys
+from matrixrmapi.app import get_app
+from matrixrmapi.bench import bench_app
+print(json.dumps(asyncio.run(bench_app(get_app(), **json.loads(sys.argv[1])))))
+"""
+
+
+@dataclass
+class BenchRequest:
+    """One request, name groups the results so it should be the route template"""
+
+    name: str
+    method: str
+    path: str
+    body: Optional[Any] = None
+    headers: Dict[str, str] = field(default_factory=dict)
+
+
+class ASGITransport:  # pylint: disable=too-few-public-methods
+    """Calls the app directly, no sockets or HTTP parsing involved"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def request(self, method: str, path: str, body: bytes, headers: Dict[str, str]) -> Tuple[int, int]:
+        """Returns status and response size"""
+        path, _, query = path.partition("?")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0", "spec_version": "2.3"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode("utf-8"),
+            "query_string": query.encode("utf-8"),
+            "root_path": "",
+            "headers": [(b"host", b"bench")]
+            + [(key.lower().encode("latin-1"), value.encode("latin-1")) for key, value in headers.items()],
+            "client": ("127.0.0.1", 0),
+            "server": ("bench", 80),
+        }
+        done = asyncio.Event()
+        sent_body = False
+        status = 0
+        size = 0
+
+        async def receive() -> Message:
+            nonlocal sent_body
+            if not sent_body:
+                sent_body = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # Streaming responses listen for disconnects, don't disconnect before they are done
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message: Message) -> None:
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+                if not message.get("more_body", False):
+                    done.set()
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            done.set()
+        return status, size
+
+
+class HTTPTransport:
+    """Real HTTP against a server, the DN header must reach the app as is (no NGinx in between)"""
+
+    def __init__(self, base_url: str, concurrency: int) -> None:
+        # pylint: disable=import-outside-toplevel
+        import aiohttp
+
+        self.base_url = base_url.rstrip("/")
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency))
+
+    async def request(self, method: str, path: str, body: bytes, headers: Dict[str, str]) -> Tuple[int, int]:
+        """Returns status and response size"""
+        async with self._session.request(method, self.base_url + path, data=body or None, headers=headers) as resp:
+            return resp.status, len(await resp.read())
+
+    async def close(self) -> None:
+        """Close the session"""
+        await self._session.close()
+
+
+Transport = Callable[[str, str, bytes, Dict[str, str]], Awaitable[Tuple[int, int]]]
+
+
+def make_cert(callsign: str) -> str:
+    """Self-signed certificate so the certificate checks have real work to do"""
+    # pylint: disable=import-outside-toplevel
+    from datetime import datetime, timedelta, timezone
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, callsign)])
+    now = datetime.now(timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=30))
+        .sign(key, hashes.SHA256())
+    )
+    return cert.public_bytes(serialization.Encoding.PEM).decode("ascii")
+
+
+class Scenarios:
+    """Request flows, one iteration of a scenario is a list of requests done in sequence"""
+
+    def __init__(self, rm_cn: str, users: int = 100) -> None:
+        self.rm_headers = {DN_HEADER: f"CN={rm_cn},O=bench"}
+        self.users = [
+            {"uuid": str(uuidlib.uuid4()), "callsign": f"BENCH{idx:04d}a", "x509cert": ""} for idx in range(users)
+        ]
+        self._cert = ""
+
+    def setup(self) -> List[BenchRequest]:
+        """Requests to run before the scenarios, creates the users fragments are fetched for"""
+        if not self._cert:
+            self._cert = make_cert("BENCH")
+            for user in self.users:
+                user["x509cert"] = self._cert
+        return [BenchRequest("setup", "POST", "/api/v1/users/created", user, self.rm_headers) for user in self.users]
+
+    def crud(self, iteration: int) -> List[BenchRequest]:
+        """Lifecycle of a new user"""
+        user = {"uuid": str(uuidlib.uuid4()), "callsign": f"CRUD{iteration:06d}a", "x509cert": self._cert}
+        return [
+            BenchRequest(f"{method} /api/v1/users/{event}", method, f"/api/v1/users/{event}", user, self.rm_headers)
+            for method, event in (
+                ("POST", "created"),
+                ("POST", "promoted"),
+                ("PUT", "updated"),
+                ("POST", "demoted"),
+                ("POST", "revoked"),
+            )
+        ]
+
+    def fragment(self, iteration: int) -> List[BenchRequest]:
+        """Get the fragment and download one of the zips"""
+        user = self.users[iteration % len(self.users)]
+        return [
+            BenchRequest("POST /api/v1/clients/fragment", "POST", "/api/v1/clients/fragment", user, self.rm_headers),
+            BenchRequest(
+                "GET /api/v1/clients/bundle/{uuid}/{filename}",
+                "GET",
+                f"/api/v1/clients/bundle/{user['uuid']}/{user['callsign']}_1.zip",
+                headers=self.rm_headers,
+            ),
+        ]
+
+    def description(self, iteration: int) -> List[BenchRequest]:
+        """What RASENMAEHER UI does on every load"""
+        language = ("en", "fi", "sv")[iteration % 3]
+        v1_language = ("en", "fi")[iteration % 2]
+        return [
+            BenchRequest("GET /api/v1/description/{language}", "GET", f"/api/v1/description/{v1_language}"),
+            BenchRequest("GET /api/v2/description/{language}", "GET", f"/api/v2/description/{language}"),
+        ]
+
+    def info(self, iteration: int) -> List[BenchRequest]:
+        """Per-user markdown"""
+        user = self.users[iteration % len(self.users)]
+        language = ("en", "fi", "sv")[iteration % 3]
+        return [
+            BenchRequest(
+                "POST /api/v2/clients/{language}/info.md",
+                "POST",
+                f"/api/v2/clients/{language}/info.md",
+                user,
+                self.rm_headers,
+            )
+        ]
+
+
+SCENARIOS = ("crud", "fragment", "description", "info")
+
+
+def percentile(values: Sequence[float], fraction: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+def summarize(latencies: Dict[str, List[float]], errors: Dict[str, int], duration: float) -> Dict[str, Any]:
+    """Per-endpoint statistics"""
+    endpoints: Dict[str, Any] = {}
+    for name, values in sorted(latencies.items()):
+        values.sort()
+        endpoints[name] = {
+            "requests": len(values),
+            "errors": errors.get(name, 0),
+            "throughput_rps": round(len(values) / duration, 2) if duration else 0.0,
+            "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+            "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+        }
+    total = sum(len(values) for values in latencies.values())
+    return {
+        "duration_s": round(duration, 3),
+        "requests": total,
+        "errors": sum(errors.values()),
+        "throughput_rps": round(total / duration, 2) if duration else 0.0,
+        "endpoints": endpoints,
+    }
+
+
+async def run_flows(
+    transport: Transport, flows: Callable[[int], List[BenchRequest]], iterations: int, concurrency: int
+) -> Dict[str, Any]:
+    """Run iterations of the flow with given number of them in flight, returns the summary"""
+    latencies: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    counter = iter(range(iterations))
+
+    async def worker() -> None:
+        for iteration in counter:
+            for request in flows(iteration):
+                body = json.dumps(request.body).encode("utf-8") if request.body is not None else b""
+                headers = dict(request.headers)
+                if body:
+                    headers["Content-Type"] = "application/json"
+                started = time.perf_counter()
+                try:
+                    status, _ = await transport(request.method, request.path, body, headers)
+                except Exception as exc:  # pylint: disable=broad-exception-caught
+                    LOGGER.debug("{} failed: {!r}".format(request.name, exc))
+                    status = 0
+                latencies.setdefault(request.name, []).append(time.perf_counter() - started)
+                if not 200 <= status < 400:
+                    errors[request.name] = errors.get(request.name, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+async def run_benchmark(  # pylint: disable=too-many-arguments
+    transport: Transport,
+    *,
+    target: str,
+    rm_cn: str,
+    scenarios: Sequence[str] = SCENARIOS,
+    iterations: int = 1000,
+    concurrency: int = 16,
+    users: int = 100,
+) -> Dict[str, Any]:
+    """Run the scenarios one after another"""
+    flows = Scenarios(rm_cn, users)
+    setup = flows.setup()
+    setup_result = await run_flows(transport, lambda iteration: [setup[iteration]], len(setup), concurrency)
+    if setup_result["errors"]:
+        LOGGER.warning("{} setup requests failed".format(setup_result["errors"]))
+    results: Dict[str, Any] = {}
+    for name in scenarios:
+        LOGGER.info("Running {} x{} with concurrency {}".format(name, iterations, concurrency))
+        results[name] = await run_flows(transport, getattr(flows, name), iterations, concurrency)
+    return {"target": target, "iterations": iterations, "concurrency": concurrency, "scenarios": results}
+
+
+async def bench_app(app: Any, **kwargs: Any) -> Dict[str, Any]:
+    """Run in-process against the FastAPI app, with its lifespan"""
+    # pylint: disable=import-outside-toplevel
+    from .config import get_manifest
+
+    transport = ASGITransport(app)
+    async with app.router.lifespan_context(app):
+        return await run_benchmark(
+            transport.request, target="asgi", rm_cn=get_manifest()["rasenmaeher"]["certcn"], **kwargs
+        )
+
+
+def parse_importtime(output: str, top: int = 20) -> List[Dict[str, Any]]:
+    """Import time per top level package from python -X importtime output, slowest first"""
+    packages: Dict[str, List[int]] = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, _, name = line[len("import time:") :].split("|")
+        package = packages.setdefault(name.strip().split(".")[0], [0, 0])
+        package[0] += int(own)
+        package[1] += 1
+    ranked = sorted(packages.items(), key=lambda item: item[1][0], reverse=True)[:top]
+    return [{"package": name, "ms": micros / 1000, "modules": count} for name, (micros, count) in ranked]
+
+
+def isolated_env(directory: Path, homeserver_url: str = "") -> Dict[str, str]:
+    """Environment for an app that only writes under directory, provisioning is disabled without homeserver_url"""
+    return {
+        **os.environ,
+        "USER_REGISTRY_PATH": str(directory / "users.db"),
+        "METRICS_DIR": str(directory / "metrics"),
+        "PROFILE_DIR": str(directory / "profiles"),
+        "MATRIX_HOMESERVER_URL": homeserver_url,
+        "MATRIX_ADMIN_TOKEN": "",
+    }
+
+
+def measure_startup(top: int = 20) -> Dict[str, Any]:
+    """Import, app creation, lifespan and first request times in a fresh interpreter, in milliseconds"""
+    with tempfile.TemporaryDirectory(prefix="matrixrmapi_startup") as directory:
+        proc = subprocess.run(  # nosec B603
+            [sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT],
+            capture_output=True,
+            text=True,
+            check=True,
+            env=isolated_env(Path(directory)),
+        )
+    return {"phases_ms": json.loads(proc.stdout.splitlines()[-1]), "imports": parse_importtime(proc.stderr, top)}
+
+
+async def bench_isolated(**kwargs: Any) -> Dict[str, Any]:
+    """Run in-process in a fresh interpreter with a throwaway registry, provisioning to a stub homeserver, so the
+    configured registry and homeserver are never touched"""
+    # pylint: disable=import-outside-toplevel
+    from .stubhomeserver import StubHomeserver
+
+    stub = StubHomeserver()
+    url = await stub.start()
+    try:
+        with tempfile.TemporaryDirectory(prefix="matrixrmapi_bench") as directory:
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable,
+                "-c",
+                BENCH_SCRIPT,
+                json.dumps(kwargs),
+                env=isolated_env(Path(directory), url),
+                stdout=asyncio.subprocess.PIPE,
+            )
+            stdout, _ = await proc.communicate()
+    finally:
+        await stub.stop()
+    if proc.returncode:
+        raise RuntimeError(f"Benchmark exited with {proc.returncode}")
+    results: Dict[str, Any] = json.loads(stdout.decode("utf-8").splitlines()[-1])
+    return results
+
+
+async def bench_url(url: str, rm_cn: str, **kwargs: Any) -> Dict[str, Any]:
+    """Run against a running server"""
+    transport = HTTPTransport(url, kwargs.get("concurrency", 16))
+    try:
+        return await run_benchmark(transport.request, target=url, rm_cn=rm_cn, **kwargs)
+    finally:
+        await transport.close()
@@ -0,0 +1,182 @@
+"""Client onboarding bundles, built once per cert and callsign and kept in a size bounded LRU"""
+
+from typing import Dict, List, Optional, Set, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import asyncio
+import base64
+import functools
+import hashlib
+import io
+import logging
+
+from .config import BUNDLE_CACHE_BYTES, BUNDLE_PREWARM_MAX
+
+LOGGER = logging.getLogger(__name__)
+# Fixed timestamp so the same input always gives the same bytes (and ETag)
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# (title, file suffix)
+BUNDLE_VARIANTS = (("iMatrix", "_1"), ("aMatrix", "_2"))
+
+
+def zip_pem(pem: str, filename: str) -> bytes:
+    """in-memory zip of the pem"""
+    import zipfile  # pylint: disable=import-outside-toplevel
+
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
+        info = zipfile.ZipInfo(filename, date_time=ZIP_DATE_TIME)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        zip_file.writestr(info, pem)
+    return zip_buffer.getvalue()
+
+
+def bundle_key(callsign: str, pem: str) -> str:
+    """Content address for the bundle"""
+    return hashlib.sha256(f"{callsign}\0{pem}".encode("utf-8")).hexdigest()
+
+
+@dataclass(frozen=True)
+class BundleFile:
+    """One downloadable zip"""
+
+    title: str
+    filename: str
+    data: bytes
+    etag: str
+
+
+@dataclass(frozen=True)
+class ClientBundle:
+    """Everything the client fragment needs for one user"""
+
+    key: str
+    callsign: str
+    files: Tuple[BundleFile, ...]
+    fragment: List[Dict[str, str]] = field(hash=False)
+
+    @property
+    def size(self) -> int:
+        """Approximate memory use"""
+        return sum(len(item.data) for item in self.files) + sum(len(item["data"]) for item in self.fragment)
+
+    def file(self, filename: str) -> Optional[BundleFile]:
+        """Get file by name"""
+        for item in self.files:
+            if item.filename == filename:
+                return item
+        return None
+
+
+def build_bundle(callsign: str, pem: str) -> ClientBundle:
+    """Build the zips and their data URIs"""
+    files = []
+    for title, suffix in BUNDLE_VARIANTS:
+        data = zip_pem(pem, f"{callsign}{suffix}.pem")
+        files.append(BundleFile(title, f"{callsign}{suffix}.zip", data, hashlib.sha256(data).hexdigest()))
+    fragment = [
+        {
+            "title": item.title,
+            "data": f"data:application/zip;base64,{base64.b64encode(item.data).decode('ascii')}",
+            "filename": item.filename,
+        }
+        for item in files
+    ]
+    return ClientBundle(bundle_key(callsign, pem), callsign, tuple(files), fragment)
+
+
+class BundleCache:  # pylint: disable=too-many-instance-attributes
+    """LRU with a byte budget, concurrent requests for the same bundle share one build"""
+
+    def __init__(self, max_bytes: int = 67108864, prewarm_max: int = 100) -> None:
+        self.max_bytes = max_bytes
+        self.prewarm_max = prewarm_max
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._cache: "OrderedDict[str, ClientBundle]" = OrderedDict()
+        self._building: Dict[str, "asyncio.Future[ClientBundle]"] = {}
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    @property
+    def total_bytes(self) -> int:
+        """Bytes in cache"""
+        return self._bytes
+
+    def _store(self, bundle: ClientBundle) -> None:
+        """Add to cache and evict as needed"""
+        if bundle.key in self._cache or bundle.size > self.max_bytes:
+            return
+        self._cache[bundle.key] = bundle
+        self._bytes += bundle.size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self._bytes -= evicted.size
+
+    def lookup(self, key: str) -> Optional[ClientBundle]:
+        """Cached bundle by content address"""
+        bundle = self._cache.get(key)
+        if bundle is not None:
+            self._cache.move_to_end(key)
+        return bundle
+
+    async def get(self, callsign: str, pem: str) -> ClientBundle:
+        """Get bundle, building it in a thread if needed"""
+        key = bundle_key(callsign, pem)
+        bundle = self.lookup(key)
+        if bundle is not None:
+            self.hits += 1
+            return bundle
+        future = self._building.get(key)
+        if future is not None:
+            self.hits += 1
+            return await asyncio.shield(future)
+        self.misses += 1
+        # A task of its own so a cancelled first caller does not cancel the build the others wait for
+        future = asyncio.ensure_future(self._build(key, callsign, pem))
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())  # Raised to the callers
+        self._building[key] = future
+        return await asyncio.shield(future)
+
+    async def _build(self, key: str, callsign: str, pem: str) -> ClientBundle:
+        """Build in a thread and cache"""
+        try:
+            bundle = await asyncio.get_running_loop().run_in_executor(None, build_bundle, callsign, pem)
+            self._store(bundle)
+            return bundle
+        finally:
+            del self._building[key]
+
+    def prewarm(self, users: List[Tuple[str, str]]) -> None:
+        """Build bundles for (callsign, pem) pairs in the background.
+
+        Skipped for bulk changes, building all of them would push the bundles people are using out of the cache"""
+        if not users:
+            return
+        if len(users) > self.prewarm_max:
+            LOGGER.debug("Not prewarming {} bundles".format(len(users)))
+            return
+
+        async def _prewarm() -> None:
+            try:
+                for callsign, pem in users:
+                    await self.get(callsign, pem)
+            except Exception:  # pylint: disable=broad-exception-caught
+                LOGGER.exception("Prewarming bundles failed")
+
+        task = asyncio.create_task(_prewarm())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def close(self) -> None:
+        """Cancel unfinished prewarming"""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+@functools.cache
+def get_bundle_cache() -> BundleCache:
+    """Get the bundle cache for this process"""
+    return BundleCache(BUNDLE_CACHE_BYTES, BUNDLE_PREWARM_MAX)
@@ -0,0 +1,104 @@
+"""Localized user facing texts, rendered once per language, callsign and deployment.
+
+The sources are templates named {kind}.{language}.md, adding a language is just adding the files."""
+
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+from collections import OrderedDict
+import functools
+import logging
+import re
+
+from .config import CATALOG_CACHE_SIZE
+from .rendering import TemplateEngine, get_template_engine
+
+if TYPE_CHECKING:
+    from jinja2 import Template
+
+LOGGER = logging.getLogger(__name__)
+SOURCE_RE = re.compile(r"^(?P<kind>[a-z_]+)\.(?P<language>[a-z]{2,3})\.md$")
+# (kind, language, callsign, deployment)
+RenderKey = Tuple[str, str, str, str]
+
+
+class MessageCatalog:  # pylint: disable=too-many-instance-attributes
+    """Finds the sources once and keeps an LRU of the renders"""
+
+    def __init__(self, engine: TemplateEngine, default: str = "en", cache_size: int = 10000) -> None:
+        self.engine = engine
+        self.default = default
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._sources: Dict[str, Dict[str, str]] = {}
+        for name in engine.env.list_templates():
+            match = SOURCE_RE.match(name)
+            if match:
+                self._sources.setdefault(match.group("kind"), {})[match.group("language")] = name
+                engine.get_template(name)  # Compile now rather than on first request
+        self._cache: "OrderedDict[RenderKey, Tuple[Template, str]]" = OrderedDict()
+        self._by_callsign: Dict[str, Set[RenderKey]] = {}
+        # uuid -> callsign seen in renders, as many as there are renders as forgetting one only leaves stale renders
+        # to the LRU
+        self._callsigns: "OrderedDict[str, str]" = OrderedDict()
+
+    def languages(self, kind: str) -> List[str]:
+        """Languages we have for this kind of text"""
+        return sorted(self._sources.get(kind, {}))
+
+    def resolve(self, kind: str, language: str) -> str:
+        """Best language we have, exact or primary tag match, default otherwise"""
+        sources = self._sources[kind]
+        for candidate in (language, language.lower().split("-")[0]):
+            if candidate in sources:
+                return candidate
+        return self.default
+
+    def render(self, kind: str, language: str, callsign: str, deployment: str, uuid: Optional[str] = None) -> str:
+        """Rendered text, uuid is used to know whose renders to drop if the callsign changes"""
+        language = self.resolve(kind, language)
+        template = self.engine.get_template(self._sources[kind][language])
+        key = (kind, language, callsign, deployment)
+        if uuid is not None:
+            self._callsigns[uuid] = callsign
+            self._callsigns.move_to_end(uuid)
+            if len(self._callsigns) > self.cache_size:
+                self._callsigns.popitem(last=False)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] is template:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return cached[1]
+        self.misses += 1
+        result = template.render(callsign=callsign, deployment=deployment, language=language)
+        self._cache[key] = (template, result)
+        self._by_callsign.setdefault(callsign, set()).add(key)
+        while len(self._cache) > self.cache_size:
+            evicted, _ = self._cache.popitem(last=False)
+            self._discard_index(evicted)
+        return result
+
+    def _discard_index(self, key: RenderKey) -> None:
+        """Remove key from the callsign index"""
+        keys = self._by_callsign.get(key[2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_callsign[key[2]]
+
+    def invalidate(self, uuid: str, callsign: Optional[str] = None) -> None:
+        """Drop renders for the user's previous callsign if it changed (or if callsign is None)"""
+        previous = self._callsigns.get(uuid)
+        if previous is None or previous == callsign:
+            return
+        for key in self._by_callsign.pop(previous, set()):
+            self._cache.pop(key, None)
+        if callsign is None:
+            del self._callsigns[uuid]
+        else:
+            self._callsigns[uuid] = callsign
+
+
+@functools.cache
+def get_catalog() -> MessageCatalog:
+    """Get the message catalog for this process"""
+    return MessageCatalog(get_template_engine(), cache_size=CATALOG_CACHE_SIZE)
@@ -0,0 +1,170 @@
+"""Certificate parsing and validation off the event loop, with results cached by certificate hash"""
+
+from typing import Any, Dict, List, Optional, Sequence
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+import asyncio
+import functools
+import hashlib
+import logging
+import multiprocessing
+
+from pydantic import BaseModel, Field
+
+from .config import CERT_POOL_KIND, CERT_POOL_WORKERS, CERT_CACHE_SIZE, CERT_CA_PATH
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CertificateInfo(BaseModel):  # pylint: disable=too-few-public-methods
+    """What we know about a certificate"""
+
+    fingerprint: str = Field(description="SHA256 of the DER encoding, empty if the PEM could not be parsed")
+    subject: str = Field(default="", description="Subject DN as RFC4514 string")
+    not_before: Optional[datetime] = Field(default=None)
+    not_after: Optional[datetime] = Field(default=None)
+    signature_ok: bool = Field(default=False, description="Signed by our CA, or True if there is no CA to check")
+    error: Optional[str] = Field(default=None, description="Why it could not be parsed or verified")
+
+    def is_valid(self, now: Optional[datetime] = None) -> bool:
+        """Parsed, signed and within validity period, evaluated at call time so cached entries can expire"""
+        if self.error or not self.not_before or not self.not_after:
+            return False
+        now = now or datetime.now(timezone.utc)
+        return self.signature_ok and self.not_before <= now <= self.not_after
+
+
+def pem_hash(pem: str) -> str:
+    """Cache key for the PEM"""
+    return hashlib.sha256(pem.encode("utf-8")).hexdigest()
+
+
+def parse_pems(pems: Sequence[str], ca_pem: Optional[bytes]) -> List[Dict[str, Any]]:
+    """Parse and verify certificates, runs in the pool so must be importable and return picklable data"""
+    # pylint: disable=import-outside-toplevel
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+
+    issuer = x509.load_pem_x509_certificate(ca_pem) if ca_pem else None
+    results: List[Dict[str, Any]] = []
+    for pem in pems:
+        try:
+            cert = x509.load_pem_x509_certificate(pem.encode("utf-8"))
+        except ValueError as exc:
+            results.append({"fingerprint": "", "error": f"Could not parse: {exc}"})
+            continue
+        result: Dict[str, Any] = {
+            "fingerprint": cert.fingerprint(hashes.SHA256()).hex(),
+            "subject": cert.subject.rfc4514_string(),
+            "not_before": cert.not_valid_before_utc,
+            "not_after": cert.not_valid_after_utc,
+            "signature_ok": True,
+        }
+        if issuer is not None:
+            try:
+                cert.verify_directly_issued_by(issuer)
+            except (InvalidSignature, ValueError, TypeError) as exc:
+                result["signature_ok"] = False
+                result["error"] = f"Not issued by our CA: {exc!r}"
+        results.append(result)
+    return results
+
+
+class CertificateService:  # pylint: disable=too-many-instance-attributes
+    """Pool of workers for the CPU heavy bits and an LRU of the results"""
+
+    def __init__(
+        self, kind: str = "process", workers: int = 2, cache_size: int = 10000, ca_path: Optional[Path] = None
+    ) -> None:
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.cache_size = cache_size
+        self.ca_path = ca_path
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[str, CertificateInfo]" = OrderedDict()
+        self._executor: Optional[Executor] = None
+        self._ca_pem: Optional[bytes] = None
+
+    def _get_executor(self) -> Executor:
+        """Create the pool on first use"""
+        if self._executor is None:
+            if self.kind == "process":
+                # spawn because forking a process that has threads running is asking for trouble
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            else:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="certs")
+            if self.ca_path and self.ca_path.exists():
+                self._ca_pem = self.ca_path.read_bytes()
+            LOGGER.info("Certificate {} pool with {} workers started".format(self.kind, self.workers))
+        return self._executor
+
+    def close(self) -> None:
+        """Shut down the pool"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _remember(self, key: str, info: CertificateInfo) -> None:
+        """Add to LRU"""
+        self._cache[key] = info
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def cached(self, pem: str) -> Optional[CertificateInfo]:
+        """Cached info without parsing"""
+        key = pem_hash(pem)
+        info = self._cache.get(key)
+        if info is not None:
+            self._cache.move_to_end(key)
+        return info
+
+    async def inspect(self, pem: str) -> CertificateInfo:
+        """Parse and verify single certificate"""
+        return (await self.inspect_many([pem]))[0]
+
+    async def _parse(self, todo: Dict[str, str]) -> Dict[str, CertificateInfo]:
+        """Parse and verify the PEMs keyed by their hash split across the pool, and remember the results"""
+        executor = self._get_executor()
+        loop = asyncio.get_running_loop()
+        items = list(todo.items())
+        size = -(-len(items) // self.workers)
+        chunks = [items[start : start + size] for start in range(0, len(items), size)]
+        parsed = await asyncio.gather(
+            *(loop.run_in_executor(executor, parse_pems, [pem for _, pem in chunk], self._ca_pem) for chunk in chunks)
+        )
+        found: Dict[str, CertificateInfo] = {}
+        for chunk, results in zip(chunks, parsed):
+            for (key, _), result in zip(chunk, results):
+                found[key] = CertificateInfo.model_validate(result)
+                self._remember(key, found[key])
+        return found
+
+    async def inspect_many(self, pems: Sequence[str]) -> List[CertificateInfo]:
+        """Parse and verify certificates, the uncached ones are split across the pool"""
+        keys = [pem_hash(pem) for pem in pems]
+        found: Dict[str, CertificateInfo] = {}
+        todo: Dict[str, str] = {}
+        for key, pem in zip(keys, pems):
+            if key in found or key in todo:
+                continue
+            info = self._cache.get(key)
+            if info is None:
+                self.misses += 1
+                todo[key] = pem
+                continue
+            self._cache.move_to_end(key)
+            self.hits += 1
+            found[key] = info
+        if todo:
+            found.update(await self._parse(todo))
+        return [found[key] for key in keys]
+
+
+@functools.cache
+def get_certificate_service() -> CertificateService:
+    """Get the certificate service for this process"""
+    return CertificateService(CERT_POOL_KIND, CERT_POOL_WORKERS, CERT_CACHE_SIZE, CERT_CA_PATH)
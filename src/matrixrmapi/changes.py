@@ -0,0 +1,241 @@
+"""Change feed for the UI and dashboards.
+
+The events are logged to the registry database, so they have the same ids in every worker and a client can resume
+from any of them. Each worker tails the log into a ring buffer that its subscribers are served from."""
+
+from typing import Any, AsyncGenerator, Callable, Deque, Dict, List, Optional, Set, Tuple
+from collections import deque
+from dataclasses import dataclass
+from types import FrameType
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import signal
+import sqlite3
+import threading
+
+from .config import FEED_BUFFER_SIZE, FEED_POLL_INTERVAL, FEED_KEEPALIVE, FEED_STREAM_MAX_AGE, get_manifest_provider
+from .registry import get_registry
+
+LOGGER = logging.getLogger(__name__)
+ChangeCallback = Callable[[List["ChangeEvent"]], None]
+# Milliseconds browsers wait before reconnecting
+RETRY_MS = 2000
+# The server waits for open connections before it shuts the app down, so streams have to end when it's told to exit
+EXIT_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+@dataclass(frozen=True)
+class ChangeEvent:
+    """One logged change"""
+
+    id: int
+    kind: str
+    subject: Optional[str]  # Callsign for user events, only admins see other peoples events
+    data: str  # JSON
+
+    def encode(self) -> bytes:
+        """As a server-sent event"""
+        return f"id: {self.id}\nevent: {self.kind}\ndata: {self.data}\n\n".encode("utf-8")
+
+    def to_dict(self) -> Dict[str, Any]:
+        """For the long-poll response"""
+        return {"id": self.id, "kind": self.kind, "data": json.loads(self.data)}
+
+
+class ChangeFeed:  # pylint: disable=too-many-instance-attributes
+    """Ring buffer of the latest events, kept up to date from the registry"""
+
+    def __init__(
+        self, buffer_size: int = 1000, poll_interval: float = 0.5, keepalive: float = 15.0, max_age: float = 300.0
+    ) -> None:
+        self.buffer: Deque[ChangeEvent] = deque(maxlen=buffer_size)
+        self.poll_interval = poll_interval
+        self.keepalive = keepalive
+        self.max_age = max_age
+        self.last_id = 0
+        self._changed = asyncio.Event()
+        self._poke = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._started = 0
+        self._manifest_digest: Optional[str] = None
+        self._tasks: Set["asyncio.Task[None]"] = set()
+        self._callbacks: List[ChangeCallback] = []
+
+    async def start(self) -> None:
+        """Fill the buffer with the latest events and start tailing the log"""
+        self._started += 1
+        if self._task is not None:
+            return
+        # Bound to the loop they are first used in
+        self._changed, self._poke, self._closing = asyncio.Event(), asyncio.Event(), asyncio.Event()
+        last_id = await get_registry().last_event_id()
+        self.last_id = max(0, last_id - (self.buffer.maxlen or 0))
+        await self.poll()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop tailing once every start() has been matched"""
+        self._started -= 1
+        if self._started > 0:
+            return
+        self.close()
+        for task in [self._task, *self._tasks]:
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(*(task for task in [self._task, *self._tasks] if task is not None), return_exceptions=True)
+        self._task = None
+
+    def close(self) -> None:
+        """End the waits and streams, clients reconnect to another worker"""
+        self._closing.set()
+        self._changed.set()
+
+    def close_on_exit(self) -> Callable[[], None]:
+        """Close when the server is told to exit, returns the function that unhooks this.
+
+        Chains to the handlers the server installed, without one (tests, not the main thread) nothing is hooked"""
+        if threading.current_thread() is not threading.main_thread():
+            return lambda: None
+        loop = asyncio.get_running_loop()
+        previous: Dict[int, Callable[[int, Optional[FrameType]], Any]] = {}
+
+        def _handler(signum: int, frame: Optional[FrameType]) -> None:
+            loop.call_soon_threadsafe(self.close)
+            previous[signum](signum, frame)
+
+        for signum in EXIT_SIGNALS:
+            handler = signal.getsignal(signum)
+            if callable(handler):
+                previous[signum] = handler
+                signal.signal(signum, _handler)
+
+        def _unhook() -> None:
+            for signum, handler in previous.items():
+                if signal.getsignal(signum) is _handler:
+                    signal.signal(signum, handler)
+
+        return _unhook
+
+    def subscribe(self, callback: ChangeCallback) -> None:
+        """Call callback with the new events, in log order, every time some are read from the log"""
+        self._callbacks.append(callback)
+
+    def poke(self) -> None:
+        """Check the log right away, for events this worker just wrote"""
+        self._poke.set()
+
+    async def poll(self) -> int:
+        """Read new events from the log, returns how many there were"""
+        rows = await get_registry().events_after(self.last_id, self.buffer.maxlen or 1000)
+        events = [ChangeEvent(*row) for row in rows]
+        self.buffer.extend(events)
+        for callback in self._callbacks if events else ():
+            try:
+                callback(events)
+            except Exception:  # pylint: disable=broad-exception-caught
+                LOGGER.exception("Change subscriber {} failed".format(callback))
+        if rows:
+            self.last_id = rows[-1][0]
+            changed, self._changed = self._changed, asyncio.Event()
+            changed.set()
+        return len(rows)
+
+    async def _run(self) -> None:
+        """Tail the log"""
+        while True:
+            try:
+                await asyncio.wait_for(self._poke.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._poke.clear()
+            try:
+                # Keep reading while there are full pages
+                while await self.poll() == self.buffer.maxlen:
+                    pass
+            except sqlite3.Error:
+                LOGGER.exception("Could not read change events")
+
+    def can_resume(self, last_id: int) -> bool:
+        """Do we still have every event after last_id"""
+        return not self.buffer or last_id >= self.buffer[0].id - 1
+
+    def since(self, last_id: int) -> List[ChangeEvent]:
+        """Buffered events after last_id, oldest first"""
+        newer: List[ChangeEvent] = []
+        for event in reversed(self.buffer):
+            if event.id <= last_id:
+                break
+            newer.append(event)
+        newer.reverse()
+        return newer
+
+    async def wait(self, last_id: Optional[int], timeout: float) -> Tuple[List[ChangeEvent], int, bool]:
+        """Events after last_id, waiting up to timeout for some to appear.
+
+        Returns the events, the id to continue from and whether events were lost (client should refetch)"""
+        if last_id is not None and last_id > self.last_id:
+            await self.poll()  # Another worker may have served it newer events than we have seen yet
+        if last_id is None or last_id > self.last_id:
+            last_id = self.last_id
+        if not self.can_resume(last_id):
+            return [], self.last_id, True
+        events = self.since(last_id)
+        if not events and timeout > 0 and not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return [], last_id, False
+            return await self.wait(last_id, 0)
+        return events, events[-1].id if events else last_id, False
+
+    async def stream(
+        self, last_id: Optional[int], visible: Callable[[ChangeEvent], bool]
+    ) -> AsyncGenerator[bytes, None]:
+        """Server-sent events from last_id on until the feed is closed or max_age is up, then clients reconnect"""
+        yield f"retry: {RETRY_MS}\n\n".encode("utf-8")
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_age
+        while not self._closing.is_set() and loop.time() < deadline:
+            events, next_id, reset = await self.wait(last_id, min(self.keepalive, deadline - loop.time()))
+            if reset:
+                yield f"id: {next_id}\nevent: reset\ndata: {{}}\n\n".encode("utf-8")
+            elif not events and next_id == last_id:
+                yield b": keepalive\n\n"
+            chunk = b"".join(event.encode() for event in events if visible(event))
+            if chunk:
+                yield chunk
+            last_id = next_id
+
+    def manifest_changed(self, manifest: Dict[str, Any]) -> None:
+        """Log manifest changes, every worker notices them but only the first one gets logged"""
+        digest = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        previous, self._manifest_digest = self._manifest_digest, digest
+        if previous is None or previous == digest:
+            return
+        # The manifest has secrets in it, tell just that it changed
+        data = json.dumps({"deployment": manifest.get("deployment"), "digest": digest})
+        task = asyncio.create_task(self._log_manifest(data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _log_manifest(self, data: str) -> None:
+        """Write the manifest event"""
+        try:
+            await get_registry().add_event("manifest", data)
+            self.poke()
+        except sqlite3.Error:
+            LOGGER.exception("Could not log manifest change")
+
+
+@functools.cache
+def get_change_feed() -> ChangeFeed:
+    """Get the change feed of this process"""
+    feed = ChangeFeed(FEED_BUFFER_SIZE, FEED_POLL_INTERVAL, FEED_KEEPALIVE, FEED_STREAM_MAX_AGE)
+    provider = get_manifest_provider()
+    feed.manifest_changed(provider.current)
+    provider.subscribe(feed.manifest_changed)
+    return feed
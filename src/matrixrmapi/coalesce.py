@@ -0,0 +1,104 @@
+"""Coalesce bursts of lifecycle events per user before they become homeserver work"""
+
+from typing import Dict, Sequence, Tuple
+import asyncio
+import functools
+import logging
+
+from .config import COALESCE_WINDOW, COALESCE_MAX_PENDING
+from .provisioning import ProvisioningJob, ProvisioningQueue, get_provisioning
+
+LOGGER = logging.getLogger(__name__)
+
+
+class EventCoalescer:
+    """Holds jobs per UUID for a short window and passes on only the net change"""
+
+    def __init__(self, queue: ProvisioningQueue, window: float = 0.5, max_pending: int = 10000) -> None:
+        self.queue = queue
+        self.window = window
+        self.max_pending = max_pending
+        self.received = 0
+        self.emitted = 0
+        self.dropped = 0
+        self._pending: Dict[str, Tuple[ProvisioningJob, asyncio.TimerHandle]] = {}
+
+    @property
+    def pending(self) -> int:
+        """Number of users with changes waiting for their window to close"""
+        return len(self._pending)
+
+    def has_room(self, uuids: Sequence[str]) -> bool:
+        """Would jobs for all of these users be accepted right now"""
+        if not self.queue.enabled:
+            return True
+        if self.window <= 0:
+            return self.queue.has_room(uuids)
+        return len(self._pending) + len(set(uuids).difference(self._pending)) <= self.max_pending
+
+    def submit(self, job: ProvisioningJob) -> bool:
+        """Merge the job with whatever is pending for the user, returns False if we are full"""
+        if not self.queue.enabled:
+            return True
+        self.received += 1
+        if self.window <= 0:
+            return self._emit(job)
+        if job.uuid not in self._pending:
+            if len(self._pending) >= self.max_pending:
+                LOGGER.error("Too many pending users, rejecting job for {}".format(job.uuid))
+                self.dropped += 1
+                return False
+            handle = asyncio.get_running_loop().call_later(self.window, self._flush, job.uuid)
+            self._pending[job.uuid] = (job, handle)
+            return True
+        pending, handle = self._pending[job.uuid]
+        merged = pending.merge(job)
+        if merged is None:
+            LOGGER.debug("Changes for {} cancelled out".format(job.uuid))
+            handle.cancel()
+            del self._pending[job.uuid]
+            return True
+        self._pending[job.uuid] = (merged, handle)
+        return True
+
+    def _emit(self, job: ProvisioningJob) -> bool:
+        """Pass the job on to the queue"""
+        if not self.queue.submit(job):
+            return False
+        self.emitted += 1
+        return True
+
+    def _flush(self, uuid: str) -> None:
+        """Window for the user closed, if the queue is full keep the job and try again after another window"""
+        job, _ = self._pending[uuid]
+        if self._emit(job):
+            del self._pending[uuid]
+            return
+        LOGGER.warning("Provisioning queue full, retrying changes for {} later".format(uuid))
+        self._pending[uuid] = (job, asyncio.get_running_loop().call_later(self.window, self._flush, uuid))
+
+    def flush_all(self) -> int:
+        """Emit everything that fits in the queue now, returns how many are still pending"""
+        for uuid, (job, handle) in list(self._pending.items()):
+            if self._emit(job):
+                handle.cancel()
+                del self._pending[uuid]
+        return len(self._pending)
+
+    async def close(self, timeout: float) -> None:
+        """Emit everything on shutdown, waiting up to timeout for room in the queue"""
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self.flush_all() and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.1)
+        if self._pending:
+            LOGGER.error("Dropping provisioning changes of {} users on shutdown".format(len(self._pending)))
+            self.dropped += len(self._pending)
+            for _, handle in self._pending.values():
+                handle.cancel()
+            self._pending.clear()
+
+
+@functools.cache
+def get_coalescer() -> EventCoalescer:
+    """Get the coalescer for this process"""
+    return EventCoalescer(get_provisioning(), window=COALESCE_WINDOW, max_pending=COALESCE_MAX_PENDING)
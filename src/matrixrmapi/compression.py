@@ -0,0 +1,191 @@
+"""Response compression negotiated from Accept-Encoding, variants of responses with ETags are compressed only once"""
+
+from typing import Dict, Optional, Tuple
+from collections import OrderedDict
+import asyncio
+import functools
+import gzip
+import logging
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .config import COMPRESSION_MIN_SIZE, COMPRESSION_CACHE_BYTES, COMPRESSION_THREAD_SIZE
+
+try:
+    import brotli  # type: ignore[import-untyped]
+except ImportError:  # pragma: no cover
+    brotli = None
+
+LOGGER = logging.getLogger(__name__)
+# Preferred first
+ENCODINGS: Tuple[str, ...] = ("br", "gzip") if brotli is not None else ("gzip",)
+# Text-like types, everything else (zips, images) is either compressed already or not worth it
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "application/x-ndjson",
+    "image/svg+xml",
+)
+
+
+@functools.lru_cache(maxsize=256)
+def accepted_encodings(header: str) -> Tuple[str, ...]:
+    """Encodings we support that Accept-Encoding allows, best first"""
+    weights: Dict[str, float] = {}
+    for part in header.lower().split(","):
+        name, *params = part.split(";")
+        weight: Optional[float] = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = None
+        if weight is not None:
+            weights[name.strip()] = weight
+    default = weights.get("*", 0.0)
+    accepted = [encoding for encoding in ENCODINGS if weights.get(encoding, default) > 0]
+    # Stable sort keeps our preference order for equal weights
+    return tuple(sorted(accepted, key=lambda encoding: -weights.get(encoding, default)))
+
+
+def negotiate_encoding(header: str) -> Optional[str]:
+    """Best encoding we support from Accept-Encoding, None for identity"""
+    accepted = accepted_encodings(header)
+    return accepted[0] if accepted else None
+
+
+def compress(data: bytes, encoding: str, best: bool = False) -> bytes:
+    """Compress with the given encoding, best spends more CPU for fewer bytes"""
+    if encoding == "br":
+        return bytes(brotli.compress(data, quality=11 if best else 5))
+    return gzip.compress(data, compresslevel=9 if best else 6, mtime=0)
+
+
+async def compress_async(data: bytes, encoding: str, best: bool = False, thread_size: int = 65536) -> bytes:
+    """Like compress but in a thread when the data is big enough to hold up the event loop"""
+    if len(data) < thread_size:
+        return compress(data, encoding, best)
+    return await asyncio.to_thread(compress, data, encoding, best)
+
+
+def is_compressible(headers: Headers) -> bool:
+    """Worth compressing based on the headers"""
+    if "content-encoding" in headers or "content-range" in headers:
+        return False
+    if "no-transform" in headers.get("cache-control", ""):
+        return False
+    return headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+
+
+def weak_etag(etag: str) -> str:
+    """Compressed variants are not byte for byte the same, but semantically they are"""
+    return etag if etag.startswith("W/") else f"W/{etag}"
+
+
+class CompressionCache:
+    """LRU with a byte budget for compressed variants, keyed by (ETag, encoding)"""
+
+    def __init__(self, max_bytes: int = 16777216, thread_size: int = 65536) -> None:
+        self.max_bytes = max_bytes
+        self.thread_size = thread_size
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._cache: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+
+    @property
+    def total_bytes(self) -> int:
+        """Bytes in cache"""
+        return self._bytes
+
+    async def get(self, etag: str, encoding: str, data: bytes) -> bytes:
+        """Compressed data, from cache if we have compressed it before, big misses are compressed in a thread"""
+        key = (etag, encoding)
+        compressed = self._cache.get(key)
+        if compressed is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return compressed
+        self.misses += 1
+        compressed = await compress_async(data, encoding, best=True, thread_size=self.thread_size)
+        if key in self._cache:  # Another request compressed it meanwhile
+            return self._cache[key]
+        if len(compressed) <= self.max_bytes:
+            self._cache[key] = compressed
+            self._bytes += len(compressed)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._bytes -= len(evicted)
+        return compressed
+
+
+class CompressionMiddleware:  # pylint: disable=too-few-public-methods
+    """Pure ASGI, compresses complete text-like bodies, streamed responses are passed through as they are"""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MIN_SIZE) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.cache = get_compression_cache()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        start: Optional[Message] = None
+        passthrough = False
+
+        async def wrapped_send(message: Message) -> None:
+            nonlocal start, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            assert start is not None
+            passthrough = True
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=list(start["headers"]))
+            if (
+                message["type"] != "http.response.body"
+                or message.get("more_body", False)
+                or start["status"] == 206
+                or len(body) < self.minimum_size
+                or not is_compressible(headers)
+            ):
+                await send(start)
+                await send(message)
+                return
+            etag = headers.get("etag")
+            if etag:
+                compressed = await self.cache.get(etag, encoding, body)
+            else:
+                compressed = await compress_async(body, encoding, thread_size=self.cache.thread_size)
+            headers.add_vary_header("Accept-Encoding")
+            if len(compressed) >= len(body):
+                await send({**start, "headers": headers.raw})
+                await send(message)
+                return
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            if etag:
+                headers["ETag"] = weak_etag(etag)
+            await send({**start, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": compressed, "more_body": False})
+
+        await self.app(scope, receive, wrapped_send)
+
+
+@functools.cache
+def get_compression_cache() -> CompressionCache:
+    """Get the compressed variants cache for this process"""
+    return CompressionCache(COMPRESSION_CACHE_BYTES, COMPRESSION_THREAD_SIZE)
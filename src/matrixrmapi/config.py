@@ -1,35 +1,117 @@
 """Configurations with .env support"""
 
-from typing import Dict, Any, cast
+from typing import Dict, Any, Optional
 from pathlib import Path
-import json
+import os
+import stat
+import tempfile
 import functools
 
 from starlette.config import Config
 
+from .manifest import ManifestProvider
+
 cfg = Config()  # not supporting .env files anymore because https://github.com/encode/starlette/discussions/2446
 
 LOG_LEVEL: int = cfg("LOG_LEVEL", default=20, cast=int)
+MANIFEST_PATH: Path = cfg("MANIFEST_PATH", cast=Path, default=Path("/pvarki/kraftwerk-init.json"))
+MANIFEST_POLL_INTERVAL: float = cfg("MANIFEST_POLL_INTERVAL", default=5.0, cast=float)  # If inotify can't be used
 TEMPLATES_PATH: Path = cfg("TEMPLATES_PATH", cast=Path, default=Path(__file__).parent / "templates")
+# Compiled template bytecode gets executed, by default Jinja picks a per-user directory it checks the owner of
+TEMPLATES_CACHE_PATH: Optional[Path] = cfg("TEMPLATES_CACHE_PATH", cast=Path, default=None)
+# Seconds between checking if template files have changed
+TEMPLATES_CHECK_INTERVAL: float = cfg("TEMPLATES_CHECK_INTERVAL", default=2.0, cast=float)
+CATALOG_CACHE_SIZE: int = cfg("CATALOG_CACHE_SIZE", default=10000, cast=int)
+AUTH_CACHE_SIZE: int = cfg("AUTH_CACHE_SIZE", default=1024, cast=int)
+AUTH_REFRESH_INTERVAL: float = cfg("AUTH_REFRESH_INTERVAL", default=60.0, cast=float)
+USER_REGISTRY_PATH: Path = cfg("USER_REGISTRY_PATH", cast=Path, default=Path("/data/persistent/matrixrmapi.db"))
+BATCH_CHUNK_SIZE: int = cfg("BATCH_CHUNK_SIZE", default=500, cast=int)
+BATCH_MAX_LINE_BYTES: int = cfg("BATCH_MAX_LINE_BYTES", default=65536, cast=int)
+BATCH_SPOOL_BYTES: int = cfg("BATCH_SPOOL_BYTES", default=1048576, cast=int)
+MATRIX_HOMESERVER_URL: str = cfg("MATRIX_HOMESERVER_URL", default="")  # Provisioning is disabled if empty
+MATRIX_ADMIN_TOKEN: str = cfg("MATRIX_ADMIN_TOKEN", default="")
+MATRIX_SERVER_NAME: str = cfg("MATRIX_SERVER_NAME", default="")  # Defaults to product dns from manifest
+PROVISIONING_WORKERS: int = cfg("PROVISIONING_WORKERS", default=4, cast=int)
+PROVISIONING_QUEUE_SIZE: int = cfg("PROVISIONING_QUEUE_SIZE", default=10000, cast=int)
+PROVISIONING_RETRIES: int = cfg("PROVISIONING_RETRIES", default=5, cast=int)
+PROVISIONING_BACKOFF: float = cfg("PROVISIONING_BACKOFF", default=0.5, cast=float)
+PROVISIONING_BACKOFF_MAX: float = cfg("PROVISIONING_BACKOFF_MAX", default=30.0, cast=float)
+PROVISIONING_TIMEOUT: float = cfg("PROVISIONING_TIMEOUT", default=10.0, cast=float)
+# Seconds to wait for queued jobs on shutdown, gunicorn's graceful timeout is 30s
+PROVISIONING_DRAIN_TIMEOUT: float = cfg("PROVISIONING_DRAIN_TIMEOUT", default=10.0, cast=float)
+HOMESERVER_CONCURRENCY: int = cfg("HOMESERVER_CONCURRENCY", default=8, cast=int)
+COALESCE_WINDOW: float = cfg("COALESCE_WINDOW", default=0.5, cast=float)  # Seconds, 0 disables coalescing
+COALESCE_MAX_PENDING: int = cfg("COALESCE_MAX_PENDING", default=10000, cast=int)
+IDEMPOTENCY_TTL: float = cfg("IDEMPOTENCY_TTL", default=600.0, cast=float)
+IDEMPOTENCY_CACHE_BYTES: int = cfg("IDEMPOTENCY_CACHE_BYTES", default=16777216, cast=int)
+CERT_POOL_KIND: str = cfg("CERT_POOL_KIND", default="process")  # "process" or "thread"
+CERT_POOL_WORKERS: int = cfg("CERT_POOL_WORKERS", default=2, cast=int)
+CERT_CACHE_SIZE: int = cfg("CERT_CACHE_SIZE", default=10000, cast=int)
+CERT_CA_PATH: Optional[Path] = cfg("CERT_CA_PATH", cast=Path, default=None)  # Signatures are not checked if unset
+BUNDLE_CACHE_BYTES: int = cfg("BUNDLE_CACHE_BYTES", default=67108864, cast=int)
+BUNDLE_PREWARM_MAX: int = cfg("BUNDLE_PREWARM_MAX", default=100, cast=int)  # Bigger batches are not prewarmed
+CERT_VALIDATION_ENFORCE: bool = cfg("CERT_VALIDATION_ENFORCE", default=False, cast=bool)
+# Shared by the workers of one gunicorn master, gunicorn_conf sets it for them
+METRICS_DIR: Path = cfg(
+    "METRICS_DIR", cast=Path, default=Path(tempfile.gettempdir()) / f"matrixrmapi_metrics_{os.getpid()}"
+)
+METRICS_FLUSH_INTERVAL: float = cfg("METRICS_FLUSH_INTERVAL", default=5.0, cast=float)
+HEALTH_INTERVAL: float = cfg("HEALTH_INTERVAL", default=10.0, cast=float)  # Seconds between probe rounds
+HEALTH_TIMEOUT: float = cfg("HEALTH_TIMEOUT", default=5.0, cast=float)
+HEALTH_MAX_LOOP_LAG: float = cfg("HEALTH_MAX_LOOP_LAG", default=0.5, cast=float)
+HEALTH_MAX_QUEUE_FILL: float = cfg("HEALTH_MAX_QUEUE_FILL", default=0.9, cast=float)  # Fraction of queue capacity
+COMPRESSION_MIN_SIZE: int = cfg("COMPRESSION_MIN_SIZE", default=512, cast=int)  # Bytes, smaller bodies are sent as is
+COMPRESSION_CACHE_BYTES: int = cfg("COMPRESSION_CACHE_BYTES", default=16777216, cast=int)
+# Bytes, bigger bodies are compressed in a thread so the event loop keeps serving others
+COMPRESSION_THREAD_SIZE: int = cfg("COMPRESSION_THREAD_SIZE", default=65536, cast=int)
+UI_PATH: Path = cfg("UI_PATH", cast=Path, default=Path("/ui_files/matrix"))  # docker/entrypoint.sh copies it there
+EXPORT_PAGE_SIZE: int = cfg("EXPORT_PAGE_SIZE", default=1000, cast=int)  # Users read from the registry at a time
+FEED_BUFFER_SIZE: int = cfg("FEED_BUFFER_SIZE", default=1000, cast=int)  # Events kept in memory for resuming
+FEED_RETENTION: int = cfg("FEED_RETENTION", default=10000, cast=int)  # Events kept in the registry
+FEED_POLL_INTERVAL: float = cfg("FEED_POLL_INTERVAL", default=0.5, cast=float)  # For events from other workers
+FEED_KEEPALIVE: float = cfg("FEED_KEEPALIVE", default=15.0, cast=float)
+# Seconds, then the client reconnects so streams move over to new workers
+FEED_STREAM_MAX_AGE: float = cfg("FEED_STREAM_MAX_AGE", default=300.0, cast=float)
+ADMISSION_ENABLED: bool = cfg("ADMISSION_ENABLED", default=True, cast=bool)
+ADMISSION_RATE: float = cfg("ADMISSION_RATE", default=20.0, cast=float)  # Requests per second per client, 0 disables
+ADMISSION_BURST: int = cfg("ADMISSION_BURST", default=100, cast=int)
+ADMISSION_CLIENTS: int = cfg("ADMISSION_CLIENTS", default=10000, cast=int)  # Token buckets kept in memory
+# Requests processed at once per worker, by route class
+ADMISSION_LIFECYCLE_CONCURRENCY: int = cfg("ADMISSION_LIFECYCLE_CONCURRENCY", default=32, cast=int)
+ADMISSION_HEAVY_CONCURRENCY: int = cfg("ADMISSION_HEAVY_CONCURRENCY", default=4, cast=int)
+ADMISSION_DEFAULT_CONCURRENCY: int = cfg("ADMISSION_DEFAULT_CONCURRENCY", default=32, cast=int)
+ADMISSION_QUEUE_SIZE: int = cfg("ADMISSION_QUEUE_SIZE", default=64, cast=int)  # Per route class, RM can go past it
+ADMISSION_QUEUE_TIMEOUT: float = cfg("ADMISSION_QUEUE_TIMEOUT", default=5.0, cast=float)
+ADMISSION_MAX_LOOP_LAG: float = cfg("ADMISSION_MAX_LOOP_LAG", default=0.25, cast=float)  # Seconds, 0 disables
+ADMISSION_RETRY_AFTER: int = cfg("ADMISSION_RETRY_AFTER", default=1, cast=int)  # Seconds, for 503
+# Seconds, slower requests are logged with their timing spans, 0 disables tracing
+TRACE_SLOW_THRESHOLD: float = cfg("TRACE_SLOW_THRESHOLD", default=1.0, cast=float)
+# Shared by the workers of one gunicorn master so any of them can serve a profile, gunicorn_conf sets it for them
+PROFILE_DIR: Path = cfg(
+    "PROFILE_DIR", cast=Path, default=Path(tempfile.gettempdir()) / f"matrixrmapi_profiles_{os.getpid()}"
+)
+PROFILE_INTERVAL: float = cfg("PROFILE_INTERVAL", default=0.005, cast=float)  # Seconds between stack samples
+PROFILE_MAX_SECONDS: float = cfg("PROFILE_MAX_SECONDS", default=60.0, cast=float)
+PROFILE_KEEP: int = cfg("PROFILE_KEEP", default=50, cast=int)  # Saved profiles, the oldest are deleted
+
+
+def private_directory(path: Path) -> Path:
+    """Create the directory only we can use, refuse one someone else could have put files in.
+
+    The default paths are in the world-writable temp directory where anyone could create them first"""
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    info = path.lstat()
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise RuntimeError(f"{path} must be a directory owned by uid {os.getuid()} and accessible only to it")
+    return path
 
 
 @functools.cache
+def get_manifest_provider() -> ManifestProvider:
+    """Get the manifest provider for this process"""
+    return ManifestProvider(MANIFEST_PATH, MANIFEST_POLL_INTERVAL)
+
+
 def get_manifest() -> Dict[str, Any]:
     """Get manifest contents"""
-    pth = Path("/pvarki/kraftwerk-init.json")
-    if not pth.exists():
-        return {
-            "deployment": "manifest_notfound",
-            "rasenmaeher": {
-                "init": {"base_uri": "https://localmaeher.dev.pvarki.fi:4439/", "csr_jwt": ""},
-                "mtls": {"base_uri": "https://mtls.localmaeher.dev.pvarki.fi:4439/"},
-                "certcn": "rasenmaeher",
-            },
-            "product": {
-                "dns": "matrix.localmaeher.dev.pvarki.fi",
-                "api": "https://matrix.localmaeher.dev.pvarki.fi:4626/",
-                "uri": "https://matrix.localmaeher.dev.pvarki.fi:4626/",
-            },
-        }
-    data = json.loads(pth.read_text(encoding="utf-8"))
-    return cast(Dict[str, Any], data)
+    return get_manifest_provider().current
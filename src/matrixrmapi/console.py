@@ -1,5 +1,7 @@
 """CLI entrypoints for matrix product integration api"""
 
+from typing import Optional, TextIO, Tuple
+from pathlib import Path
 import asyncio
 import logging
 import json
@@ -10,6 +12,10 @@ import aiohttp
 
 from matrixrmapi import __version__
 from matrixrmapi.app import get_app
+from matrixrmapi.bench import SCENARIOS, bench_isolated, bench_url, measure_startup
+from matrixrmapi.config import UI_PATH
+from matrixrmapi.static import precompress
+from matrixrmapi.stubhomeserver import StubHomeserver
 
 
 LOGGER = logging.getLogger(__name__)
@@ -60,16 +66,112 @@ def do_http_healthcheck(ctx: click.Context, host: str, port: int, timeout: float
 
 
 @cli_group.command(name="openapi")
+@click.option("-o", "--output", type=click.File("w"), default="-", help="Where to write the spec")
 @click.pass_context
-def dump_openapi(ctx: click.Context) -> None:
+def dump_openapi(ctx: click.Context, output: TextIO) -> None:
     """
     Dump autogenerate openapi spec as JSON
     """
     app = get_app()
-    click.echo(json.dumps(app.openapi()))
+    output.write(json.dumps(app.openapi()) + "\n")
     ctx.exit(0)
 
 
+@cli_group.command(name="startup-time")
+@click.option("--top", default=20, help="How many of the slowest packages to list")
+@click.pass_context
+def dump_startup_time(ctx: click.Context, top: int) -> None:
+    """
+    Measure import, app creation, lifespan and first request times in a fresh interpreter, print as JSON
+    """
+    click.echo(json.dumps(measure_startup(top), indent=2))
+    ctx.exit(0)
+
+
+@cli_group.command(name="precompress")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False, path_type=Path), default=UI_PATH)
+@click.pass_context
+def run_precompress(ctx: click.Context, directory: Path) -> None:
+    """
+    Write .br and .gz variants of the UI files so they can be served without compressing on the fly
+    """
+    click.echo("Wrote {} compressed files".format(precompress(directory)))
+    ctx.exit(0)
+
+
+@cli_group.command(name="stubhomeserver")
+@click.option("--host", default="127.0.0.1", help="The host to bind to")
+@click.option("--port", default=8008, help="The port to bind to")
+@click.option("--delay", default=0.0, help="Seconds to wait before answering each request")
+@click.pass_context
+def run_stub_homeserver(ctx: click.Context, host: str, port: int, delay: float) -> None:
+    """
+    Run a stub homeserver admin API for local testing and benchmarks
+    """
+
+    async def doit() -> None:
+        """The actual work"""
+        stub = StubHomeserver(delay=delay)
+        click.echo(await stub.start(host, port))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await stub.stop()
+
+    try:
+        asyncio.run(doit())
+    except KeyboardInterrupt:
+        pass
+    ctx.exit(0)
+
+
+@cli_group.command(name="bench")
+@click.option("--url", default=None, help="Server to benchmark, in-process through ASGI if not given")
+@click.option("--rm-cn", default="rasenmaeher", help="RASENMAEHER CN to send in the DN header when using --url")
+@click.option(
+    "-s",
+    "--scenario",
+    "scenarios",
+    multiple=True,
+    type=click.Choice(SCENARIOS),
+    help="Scenario to run, can be repeated, default is all of them",
+)
+@click.option("-n", "--iterations", default=1000, help="Iterations per scenario")
+@click.option("-c", "--concurrency", default=16, help="Iterations in flight at the same time")
+@click.option("--users", default=100, help="Users created for the fragment and info scenarios")
+@click.option("-o", "--output", type=click.File("w"), default="-", help="Where to write the JSON results")
+@click.pass_context
+def run_bench(  # pylint: disable=too-many-arguments
+    ctx: click.Context,
+    *,
+    url: Optional[str],
+    rm_cn: str,
+    scenarios: Tuple[str, ...],
+    iterations: int,
+    concurrency: int,
+    users: int,
+    output: TextIO,
+) -> None:
+    """
+    Benchmark the API and print throughput and latency percentiles per endpoint as JSON.
+
+    In-process mode runs in a fresh interpreter with a throwaway registry and a stub homeserver.
+    """
+    kwargs = {
+        "scenarios": scenarios or SCENARIOS,
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "users": users,
+    }
+    if url:
+        results = asyncio.run(bench_url(url, rm_cn, **kwargs))
+    else:
+        results = asyncio.run(bench_isolated(**kwargs))
+    output.write(json.dumps(results, indent=2) + "\n")
+    failed = sum(scenario["errors"] for scenario in results["scenarios"].values())
+    ctx.exit(1 if failed else 0)
+
+
 def matrixrmapi_cli() -> None:
     """matrixrmapi"""
     init_logging(logging.WARNING)
@@ -0,0 +1,78 @@
+"""Product descriptions pre-serialized per API version and language"""
+
+from typing import Dict, Mapping, Optional, Sequence, Tuple
+from dataclasses import dataclass
+import functools
+import hashlib
+import logging
+
+from pydantic import BaseModel
+
+from .httpcache import quote_etag
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SerializedDescription:
+    """Ready to send response body"""
+
+    language: str
+    body: bytes
+    etag: str
+
+
+@functools.lru_cache(maxsize=256)
+def parse_accept_language(header: str) -> Tuple[str, ...]:
+    """Primary language tags in order of preference, browsers send the same few headers over and over"""
+    weighted = []
+    for position, part in enumerate(header.split(",")):
+        tag, _, params = part.strip().partition(";")
+        tag = tag.strip().lower().split("-")[0]
+        if not tag:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        if quality > 0:
+            weighted.append((-quality, position, tag))
+    return tuple(dict.fromkeys(tag for _, _, tag in sorted(weighted)))
+
+
+class DescriptionRegistry:
+    """Serializes every description once, serving one is a dict lookup"""
+
+    def __init__(self, versions: Mapping[str, Mapping[str, BaseModel]], default: str = "en") -> None:
+        self.default = default
+        self._entries: Dict[str, Dict[str, SerializedDescription]] = {}
+        for version, languages in versions.items():
+            self._entries[version] = {}
+            for language, model in languages.items():
+                body = model.model_dump_json().encode("utf-8")
+                etag = quote_etag(hashlib.sha256(body).hexdigest()[:32])
+                self._entries[version][language] = SerializedDescription(language, body, etag)
+        LOGGER.debug("Description languages: {}".format({key: list(val) for key, val in self._entries.items()}))
+
+    def languages(self, version: str) -> Sequence[str]:
+        """Available languages"""
+        return list(self._entries.get(version, {}))
+
+    def get(
+        self, version: str, language: str, accept_language: Optional[str] = None, fallback: bool = True
+    ) -> Optional[SerializedDescription]:
+        """Exact language if we have it, then the best match from Accept-Language, then the default"""
+        entries = self._entries[version]
+        found = entries.get(language) or entries.get(language.lower().split("-")[0])
+        if found is not None:
+            return found
+        if accept_language:
+            for candidate in parse_accept_language(accept_language):
+                if candidate in entries:
+                    return entries[candidate]
+        if fallback:
+            return entries.get(self.default)
+        return None
@@ -0,0 +1,38 @@
+"""Gunicorn hooks, use with "gunicorn -c python:matrixrmapi.gunicorn_conf".
+
+The master owns the directories the workers share: it picks them before the app is loaded (so --preload gets
+the same ones), empties them when it starts and archives the metrics of each worker that exits."""
+
+from typing import Any
+from pathlib import Path
+import os
+import shutil
+import tempfile
+
+# Keyed by the master so workers of another master on the same host don't mix in
+os.environ.setdefault("METRICS_DIR", str(Path(tempfile.gettempdir()) / f"matrixrmapi_metrics_{os.getpid()}"))
+os.environ.setdefault("PROFILE_DIR", str(Path(tempfile.gettempdir()) / f"matrixrmapi_profiles_{os.getpid()}"))
+
+
+def on_starting(server: Any) -> None:
+    """Drop whatever an earlier master with the same pid left behind"""
+    from .config import METRICS_DIR, PROFILE_DIR, private_directory  # pylint: disable=import-outside-toplevel
+
+    for directory in (METRICS_DIR, PROFILE_DIR):
+        server.log.info("Clearing {}".format(directory))
+        shutil.rmtree(directory, ignore_errors=True)
+        # Fails if someone else owns it
+        private_directory(directory)
+
+
+def child_exit(server: Any, worker: Any) -> None:
+    """The worker is gone, keep its counters so the totals don't go backwards"""
+    from .config import METRICS_DIR  # pylint: disable=import-outside-toplevel
+    from .metrics import archive_worker  # pylint: disable=import-outside-toplevel
+
+    try:
+        archive_worker(METRICS_DIR, worker.pid)
+    except (OSError, ValueError) as exc:
+        server.log.warning("Could not archive metrics of worker {}: {}".format(worker.pid, exc))
+        return
+    server.log.debug("Archived metrics of worker {}".format(worker.pid))
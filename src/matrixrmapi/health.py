@@ -0,0 +1,192 @@
+"""Health probes run in the background, the endpoint only returns the latest verdict"""
+
+from typing import Awaitable, Callable, Dict, Optional
+import asyncio
+import functools
+import logging
+import time
+
+from pydantic import BaseModel, Field
+from libpvarki.schemas.product import ProductHealthCheckResponse
+
+from .config import (
+    HEALTH_INTERVAL,
+    HEALTH_TIMEOUT,
+    HEALTH_MAX_LOOP_LAG,
+    HEALTH_MAX_QUEUE_FILL,
+    get_manifest_provider,
+)
+from .coalesce import get_coalescer
+from .provisioning import get_provisioning
+from .registry import get_registry
+
+LOGGER = logging.getLogger(__name__)
+# Returns optional detail, raises if unhealthy
+Probe = Callable[[], Awaitable[Optional[str]]]
+
+
+class ComponentHealth(BaseModel):  # pylint: disable=too-few-public-methods
+    """Result of the last probe of one component"""
+
+    healthy: bool = Field(description="Did the probe pass")
+    latency_ms: float = Field(description="How long the probe took")
+    error: Optional[str] = Field(default=None, description="Why it failed")
+    detail: Optional[str] = Field(default=None)
+    checked: float = Field(description="Unix timestamp of the probe")
+
+
+class HealthVerdict(BaseModel):  # pylint: disable=too-few-public-methods
+    """Combined result"""
+
+    healthy: bool = Field(description="All components are healthy")
+    components: Dict[str, ComponentHealth] = Field(default_factory=dict)
+
+
+class LoopLagMonitor:
+    """Measures how late a sleep wakes up, a busy or blocked event loop shows up as lag"""
+
+    def __init__(self, interval: float = 0.5) -> None:
+        self.interval = interval
+        self.lag = 0.0
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def start(self) -> None:
+        """Start measuring"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop measuring"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        """Measure until cancelled"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - started - self.interval)
+
+
+class HealthMonitor:  # pylint: disable=too-many-instance-attributes
+    """Runs the probes on a schedule and keeps the verdict"""
+
+    def __init__(self, interval: float = 10.0, timeout: float = 5.0) -> None:
+        self.interval = interval
+        self.timeout = timeout
+        self.probes: Dict[str, Probe] = {}
+        self.lag_monitor = LoopLagMonitor()
+        self.verdict = HealthVerdict(healthy=False)
+        self.response = ProductHealthCheckResponse(healthy=False, extra="Not checked yet")
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._started = 0
+
+    def add_probe(self, name: str, probe: Probe) -> None:
+        """Register a probe"""
+        self.probes[name] = probe
+
+    async def _probe(self, probe: Probe) -> ComponentHealth:
+        """Run one probe with timeout"""
+        checked = time.time()
+        started = time.perf_counter()
+        try:
+            detail = await asyncio.wait_for(probe(), self.timeout)
+        except asyncio.TimeoutError:
+            error: Optional[str] = f"Timed out after {self.timeout}s"
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            error = repr(exc)
+        else:
+            error = None
+        latency_ms = (time.perf_counter() - started) * 1000
+        if error is not None:
+            return ComponentHealth(healthy=False, latency_ms=latency_ms, error=error, checked=checked)
+        return ComponentHealth(healthy=True, latency_ms=latency_ms, detail=detail, checked=checked)
+
+    async def check(self) -> HealthVerdict:
+        """Run all probes concurrently and store the verdict"""
+        names = list(self.probes)
+        results = await asyncio.gather(*(self._probe(self.probes[name]) for name in names))
+        components = dict(zip(names, results))
+        verdict = HealthVerdict(healthy=all(result.healthy for result in results), components=components)
+        if verdict.healthy != self.verdict.healthy:
+            failed = [name for name, result in components.items() if not result.healthy]
+            LOGGER.log(
+                logging.INFO if verdict.healthy else logging.ERROR,
+                "Health changed to {}, failing: {}".format(verdict.healthy, failed),
+            )
+        self.verdict = verdict
+        self.response = ProductHealthCheckResponse(healthy=verdict.healthy, extra=verdict.model_dump_json())
+        return verdict
+
+    async def start(self) -> None:
+        """Do the first check and keep checking in the background"""
+        self._started += 1
+        if self._task is None:
+            self.lag_monitor.start()
+            await self.check()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop checking once every start() has been matched"""
+        self._started -= 1
+        if self._task is not None and self._started <= 0:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            await self.lag_monitor.stop()
+
+    async def _run(self) -> None:
+        """Check until cancelled"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception:  # pylint: disable=broad-exception-caught
+                LOGGER.exception("Health check round failed")
+
+
+@functools.cache
+def get_health_monitor() -> HealthMonitor:
+    """Get the health monitor for this process with the standard probes"""
+    monitor = HealthMonitor(HEALTH_INTERVAL, HEALTH_TIMEOUT)
+
+    async def manifest() -> Optional[str]:
+        # Only looks, the provider does the reading and tells if it failed
+        provider = get_manifest_provider()
+        if provider.last_error is not None:
+            raise RuntimeError(provider.last_error)
+        deployment = str(provider.current.get("deployment"))
+        return deployment if await asyncio.to_thread(provider.stat) else f"{deployment} (defaults, no file)"
+
+    async def registry() -> Optional[str]:
+        counts = await get_registry().counts()
+        return f"{counts['active']} active users"
+
+    async def homeserver() -> Optional[str]:
+        provisioning = get_provisioning()
+        if not provisioning.enabled:
+            return "Provisioning disabled"
+        await provisioning.ping()
+        return provisioning.homeserver_url
+
+    async def queue() -> Optional[str]:
+        provisioning = get_provisioning()
+        coalescer = get_coalescer()
+        fill = max(provisioning.depth / max(1, provisioning.maxsize), coalescer.pending / max(1, coalescer.max_pending))
+        detail = f"{provisioning.depth} queued, {coalescer.pending} pending"
+        if fill >= HEALTH_MAX_QUEUE_FILL:
+            raise RuntimeError(f"Backlog at {fill:.0%}: {detail}")
+        return detail
+
+    async def event_loop() -> Optional[str]:
+        lag = monitor.lag_monitor.lag
+        if lag > HEALTH_MAX_LOOP_LAG:
+            raise RuntimeError(f"Event loop lag {lag:.3f}s")
+        return f"{lag * 1000:.1f}ms lag"
+
+    for probe in (manifest, registry, homeserver, queue, event_loop):
+        monitor.add_probe(probe.__name__, probe)
+    return monitor
@@ -0,0 +1,83 @@
+"""Conditional (ETag) and Range request handling for responses we have as bytes"""
+
+from typing import Mapping, Optional, Tuple
+from urllib.parse import quote
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+
+def quote_etag(value: str) -> str:
+    """Strong ETag header value"""
+    return f'"{value}"'
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """Does If-None-Match header match the (quoted) etag, weak comparison as the RFC says"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in header.split(","))
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse single "bytes=" range to inclusive (start, end), None if there is nothing to honor.
+
+    Raises ValueError if the range can not be satisfied."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None  # Multipart ranges are not worth the trouble for small files, send everything
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if first:
+            start, end = int(first), int(last) if last else size - 1
+        else:
+            suffix = int(last)
+            if suffix <= 0:
+                start, end = size, size  # Empty suffix, nothing to send
+            else:
+                start, end = max(0, size - suffix), size - 1
+    except ValueError:
+        return None  # Syntactically invalid ranges are ignored
+    if last and first and end < start:
+        return None  # So is last before first (RFC 9110 14.1.1)
+    if start >= size:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size - 1)
+
+
+def content_disposition(filename: str) -> str:
+    """Attachment header that works for non-ascii names too"""
+    fallback = filename.encode("ascii", "replace").decode("ascii").replace('"', "_")
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def bytes_response(  # pylint: disable=too-many-arguments
+    request: Request,
+    data: bytes,
+    etag: str,
+    *,
+    media_type: str,
+    headers: Optional[Mapping[str, str]] = None,
+    ranges: bool = False,
+) -> Response:
+    """Response for data with given (quoted) etag, 304 if client has it already, 206 if it asked for a range"""
+    common = {"ETag": etag, **(headers or {})}
+    if ranges:
+        common["Accept-Ranges"] = "bytes"
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=common)
+    if ranges and request.headers.get("if-range", etag) == etag:
+        try:
+            byte_range = parse_range(request.headers.get("range"), len(data))
+        except ValueError:
+            return Response(status_code=416, headers={**common, "Content-Range": f"bytes */{len(data)}"})
+        if byte_range is not None:
+            start, end = byte_range
+            return Response(
+                content=data[start : end + 1],
+                status_code=206,
+                media_type=media_type,
+                headers={**common, "Content-Range": f"bytes {start}-{end}/{len(data)}"},
+            )
+    return Response(content=data, media_type=media_type, headers=common)
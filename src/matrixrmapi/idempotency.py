@@ -0,0 +1,96 @@
+"""Recognize retried lifecycle calls and answer them without doing the work again.
+
+Only the latest event per user is remembered so a legitimate repeat (promote, demote, promote) is never
+mistaken for a retry. Entries live in the registry database so every worker sees them, the registry stores and
+clears them in the same transaction as the user changes so no other path can leave a stale one behind."""
+
+from typing import Optional
+import functools
+import hashlib
+import logging
+import sqlite3
+import time
+
+from libpvarki.schemas.product import UserCRUDRequest
+from libpvarki.schemas.generic import OperationResultResponse
+
+from .config import IDEMPOTENCY_TTL, IDEMPOTENCY_CACHE_BYTES
+from .registry import ReplayEntry, UserRegistry, get_registry
+
+LOGGER = logging.getLogger(__name__)
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+EVICT_EVERY = 100
+
+
+def event_key(event: str, user: UserCRUDRequest, header: Optional[str] = None) -> str:
+    """Key from the client supplied header, or hash of the event if there is none"""
+    if header:
+        return f"{event}:{header}"
+    return hashlib.sha256(f"{event}\n{user.model_dump_json()}".encode("utf-8")).hexdigest()
+
+
+class ReplayCache:
+    """TTL and size bounded store of the last response per user"""
+
+    def __init__(self, registry: UserRegistry, ttl: float = 600.0, max_bytes: int = 16777216) -> None:
+        self.registry = registry
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+
+    async def get(self, uuid: str, key: str) -> Optional[OperationResultResponse]:
+        """Stored response if key matches the latest event of the user, a quick check before the real one in
+        UserRegistry.apply"""
+
+        def _get(conn: sqlite3.Connection) -> Optional[str]:
+            row = conn.execute(
+                "SELECT response FROM replays WHERE uuid = ? AND key = ? AND expires > ?", (uuid, key, time.time())
+            ).fetchone()
+            return str(row[0]) if row else None
+
+        stored = await self.registry.read(_get)
+        if stored is None:
+            self.misses += 1
+            return None
+        return self.replayed(uuid, stored)
+
+    def replayed(self, uuid: str, stored: str) -> OperationResultResponse:
+        """Count the hit and parse the stored response"""
+        self.hits += 1
+        LOGGER.info("Replayed response for {}".format(uuid))
+        return OperationResultResponse.model_validate_json(stored)
+
+    def entry(self, key: str, result: OperationResultResponse) -> ReplayEntry:
+        """What UserRegistry.apply stores for the event"""
+        return (key, result.model_dump_json(), time.time() + self.ttl)
+
+    async def recorded(self) -> None:
+        """Called after an entry was stored, evicts old entries every now and then"""
+        self._writes += 1
+        if self._writes % EVICT_EVERY:
+            return
+
+        def _evict(conn: sqlite3.Connection) -> None:
+            with conn:
+                self._evict(conn, time.time())
+
+        await self.registry.write(_evict)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        """Drop expired entries and the oldest ones if over budget"""
+        conn.execute("DELETE FROM replays WHERE expires <= ?", (now,))
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM replays").fetchone()
+        if total <= self.max_bytes:
+            return
+        # Drop a bit more than the excess so we are not doing this on every write
+        drop = int(count * (total - self.max_bytes * 0.9) / total) + 1
+        conn.execute("DELETE FROM replays WHERE uuid IN (SELECT uuid FROM replays ORDER BY expires LIMIT ?)", (drop,))
+        LOGGER.debug("Evicted {} replay entries".format(drop))
+
+
+@functools.cache
+def get_replay_cache() -> ReplayCache:
+    """Get the replay cache for this process"""
+    return ReplayCache(get_registry(), ttl=IDEMPOTENCY_TTL, max_bytes=IDEMPOTENCY_CACHE_BYTES)
@@ -0,0 +1,159 @@
+"""User lifecycle events, shared by the single-event and batch endpoints"""
+
+from typing import AsyncIterator, Dict, List, Literal, Optional, Sequence, Tuple
+import logging
+import sqlite3
+
+from pydantic import BaseModel, Field
+from libpvarki.schemas.product import UserCRUDRequest
+from libpvarki.schemas.generic import OperationResultResponse
+
+from .config import CERT_VALIDATION_ENFORCE
+from .certs import get_certificate_service
+from .auth import ADMIN_CHANGES, get_authorizer
+from .bundles import get_bundle_cache
+from .catalog import get_catalog
+from .registry import ReplayEntry, get_registry
+from .idempotency import get_replay_cache
+from .provisioning import ProvisioningJob
+from .coalesce import get_coalescer
+from .changes import get_change_feed
+
+LOGGER = logging.getLogger(__name__)
+
+EventType = Literal["created", "revoked", "promoted", "demoted", "updated"]
+
+
+class LifecycleEvent(BaseModel):  # pylint: disable=too-few-public-methods
+    """Single typed lifecycle event"""
+
+    event: EventType = Field(description="What happened to the user")
+    user: UserCRUDRequest = Field(description="The user it happened to")
+
+
+class BatchItemResult(BaseModel):  # pylint: disable=too-few-public-methods
+    """Result for one line of a batch request"""
+
+    index: int = Field(description="Zero-based line number in the request, blank lines included")
+    event: Optional[EventType] = Field(default=None, description="Event type if the line could be parsed")
+    uuid: Optional[str] = Field(default=None, description="User UUID if the line could be parsed")
+    success: bool = Field(description="Was the event applied")
+    error: Optional[str] = Field(default=None, description="Reason for failure")
+
+
+async def check_certificates(events: Sequence[LifecycleEvent]) -> Dict[int, str]:
+    """Validate certs of created and updated events, returns errors by event index"""
+    indexes = [idx for idx, event in enumerate(events) if event.event in ("created", "updated")]
+    if not indexes:
+        return {}
+    infos = await get_certificate_service().inspect_many([events[idx].user.x509cert for idx in indexes])
+    errors: Dict[int, str] = {}
+    for idx, info in zip(indexes, infos):
+        if not info.is_valid():
+            LOGGER.warning("Invalid certificate for {}: {}".format(events[idx].user.uuid, info.error or "expired"))
+            errors[idx] = f"Invalid certificate: {info.error or 'expired'}"
+    return errors
+
+
+async def apply_events(events: Sequence[LifecycleEvent]) -> List[OperationResultResponse]:
+    """Apply events in order, returns one result per event"""
+    results, _ = await _apply_events(events)
+    return results
+
+
+async def apply_event_once(event: LifecycleEvent, key: str) -> Tuple[OperationResultResponse, bool]:
+    """Apply single event unless the latest event of the user had the same key, returns the result and whether it
+    is the stored result of that earlier event"""
+    replays = get_replay_cache()
+    stored = await replays.get(event.user.uuid, key)
+    if stored is not None:
+        return stored, True
+    results, replayed = await _apply_events([event], replays.entry(key, OperationResultResponse(success=True)))
+    if replayed is not None:  # A concurrent retry got there first
+        return replays.replayed(event.user.uuid, replayed), True
+    if results[0].success:
+        await replays.recorded()
+    return results[0], False
+
+
+async def _apply_events(
+    events: Sequence[LifecycleEvent], replay: Optional[ReplayEntry] = None
+) -> Tuple[List[OperationResultResponse], Optional[str]]:
+    """Apply events in order, with replay see UserRegistry.apply. Returns one result per event, or the stored
+    response if nothing was applied"""
+    # Parsing and verifying is the most expensive part of an event, not worth it if we would not reject
+    rejected = await check_certificates(events) if CERT_VALIDATION_ENFORCE else {}
+    accepted = [event for idx, event in enumerate(events) if idx not in rejected]
+    coalescer = get_coalescer()
+    # Checked before storing anything, RM retries failed events and must see them as not applied
+    if not coalescer.has_room([event.user.uuid for event in accepted]):
+        LOGGER.error("Provisioning backlog full, rejecting {} events".format(len(accepted)))
+        return [
+            OperationResultResponse(
+                success=False, error=rejected.get(idx, "Provisioning backlog full, try again later")
+            )
+            for idx in range(len(events))
+        ], None
+    try:
+        stored = await get_registry().apply(
+            [(event.event, event.user.uuid, event.user.callsign, event.user.x509cert) for event in accepted], replay
+        )
+    except sqlite3.Error as exc:
+        LOGGER.exception("Could not store {} events to registry".format(len(events)))
+        return [OperationResultResponse(success=False, error=f"Registry error: {exc}") for _ in events], None
+    if stored is not None:
+        return [], stored
+    # The registry logged them, let our change feed subscribers know without waiting for the next poll
+    get_change_feed().poke()
+    get_bundle_cache().prewarm(
+        [(event.user.callsign, event.user.x509cert) for event in accepted if event.event == "created"]
+    )
+    catalog = get_catalog()
+    authorizer = get_authorizer()
+    for event in accepted:
+        if event.event == "revoked":
+            catalog.invalidate(event.user.uuid)
+            authorizer.update(event.user.uuid, None)
+            continue
+        if event.event == "updated":
+            catalog.invalidate(event.user.uuid, event.user.callsign)
+        authorizer.update(event.user.uuid, event.user.callsign, ADMIN_CHANGES.get(event.event))
+    results: List[OperationResultResponse] = []
+    for idx, event in enumerate(events):
+        if idx in rejected:
+            results.append(OperationResultResponse(success=False, error=rejected[idx]))
+            continue
+        # Stored already so it is applied either way, the coalescer and queue log it if they lose the job
+        coalescer.submit(ProvisioningJob.from_event(event.event, event.user.uuid, event.user.callsign))
+        results.append(OperationResultResponse(success=True))
+    return results, None
+
+
+async def iter_ndjson_lines(stream: AsyncIterator[bytes], max_line_bytes: int) -> AsyncIterator[Tuple[int, bytes]]:
+    """Split a byte stream to lines without reading all of it, yields (zero-based line number, line).
+
+    Blank lines are skipped but counted so the numbers match the input, overlong lines are yielded empty"""
+    buffer = b""
+    skipping = False
+    number = 0
+    async for chunk in stream:
+        lines = (buffer + chunk).split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            if skipping:
+                # Rest of an overlong line, its number was already used
+                skipping = False
+                continue
+            if len(line) > max_line_bytes:
+                yield number, b""
+            elif line.strip():
+                yield number, line
+            number += 1
+        if len(buffer) > max_line_bytes:
+            if not skipping:
+                yield number, b""
+                number += 1
+            skipping = True
+            buffer = b""
+    if buffer.strip() and not skipping:
+        yield number, buffer
@@ -0,0 +1,154 @@
+"""The kraftwerk manifest, loaded off the event loop and swapped in when the file changes"""
+
+from typing import Any, Callable, Dict, List, Optional, Tuple, cast
+from pathlib import Path
+import asyncio
+import copy
+import json
+import logging
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_MANIFEST: Dict[str, Any] = {
+    "deployment": "manifest_notfound",
+    "rasenmaeher": {
+        "init": {"base_uri": "https://localmaeher.dev.pvarki.fi:4439/", "csr_jwt": ""},
+        "mtls": {"base_uri": "https://mtls.localmaeher.dev.pvarki.fi:4439/"},
+        "certcn": "rasenmaeher",
+    },
+    "product": {
+        "dns": "matrix.localmaeher.dev.pvarki.fi",
+        "api": "https://matrix.localmaeher.dev.pvarki.fi:4626/",
+        "uri": "https://matrix.localmaeher.dev.pvarki.fi:4626/",
+    },
+}
+# Paths that must be non-empty strings
+REQUIRED_KEYS = (
+    ("deployment",),
+    ("rasenmaeher", "certcn"),
+    ("rasenmaeher", "init", "base_uri"),
+    ("product", "dns"),
+)
+ManifestCallback = Callable[[Dict[str, Any]], None]
+
+
+def validate_manifest(data: Any) -> Dict[str, Any]:
+    """Check that the things we use are there, raises ValueError if not"""
+    if not isinstance(data, dict):
+        raise ValueError("Manifest is not an object")
+    for keys in REQUIRED_KEYS:
+        value: Any = data
+        for key in keys:
+            value = value.get(key) if isinstance(value, dict) else None
+        if not isinstance(value, str) or not value:
+            raise ValueError(f"Manifest is missing {'.'.join(keys)}")
+    return cast(Dict[str, Any], data)
+
+
+def read_manifest(path: Path) -> Dict[str, Any]:
+    """Read and validate, defaults if the file does not exist, blocking so run it in a thread"""
+    if not path.exists():
+        return copy.deepcopy(DEFAULT_MANIFEST)
+    return validate_manifest(json.loads(path.read_text(encoding="utf-8")))
+
+
+class ManifestProvider:  # pylint: disable=too-many-instance-attributes
+    """Holds the current manifest, watches the file and tells subscribers about changes"""
+
+    def __init__(self, path: Path, poll_interval: float = 5.0) -> None:
+        self.path = path
+        self.poll_interval = poll_interval
+        self.reloads = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None  # Why the latest reload failed, None if it did not
+        self._current: Optional[Dict[str, Any]] = None
+        self._callbacks: List[ManifestCallback] = []
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._started = 0
+
+    @property
+    def current(self) -> Dict[str, Any]:
+        """Current manifest, read synchronously only if used before start()"""
+        if self._current is None:
+            self._current = read_manifest(self.path)
+        return self._current
+
+    def subscribe(self, callback: ManifestCallback) -> None:
+        """Call callback with the new manifest whenever it changes"""
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback: ManifestCallback) -> None:
+        """Stop calling callback"""
+        if callback in self._callbacks:
+            self._callbacks.remove(callback)
+
+    def swap(self, manifest: Dict[str, Any]) -> None:
+        """Replace the manifest and recompute everything derived from it"""
+        if manifest == self._current:
+            return
+        self._current = manifest
+        self.reloads += 1
+        for callback in self._callbacks:
+            try:
+                callback(manifest)
+            except Exception:  # pylint: disable=broad-exception-caught
+                LOGGER.exception("Manifest subscriber {} failed".format(callback))
+
+    async def reload(self) -> bool:
+        """Read the file in a thread, keeps the old manifest if the new one is not valid"""
+        try:
+            manifest = await asyncio.to_thread(read_manifest, self.path)
+        except (OSError, ValueError) as exc:  # JSONDecodeError is a ValueError
+            self.errors += 1
+            self.last_error = f"Could not load {self.path}: {exc}"
+            LOGGER.error("Could not load manifest from {}, keeping the old one: {}".format(self.path, exc))
+            return False
+        self.last_error = None
+        if manifest != self._current:
+            LOGGER.info("Manifest loaded from {}".format(self.path))
+            self.swap(manifest)
+        return True
+
+    async def start(self) -> None:
+        """Load and start watching"""
+        self._started += 1
+        await self.reload()
+        if self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        """Stop watching once every start() has been matched"""
+        self._started -= 1
+        if self._task is not None and self._started <= 0:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _watch(self) -> None:
+        """inotify (via watchfiles) on the directory, so atomic renames are seen too, stat polling if that fails"""
+        try:
+            from watchfiles import awatch  # pylint: disable=import-outside-toplevel
+
+            name = self.path.name
+            async for _ in awatch(self.path.parent, watch_filter=lambda _change, changed: Path(changed).name == name):
+                await self.reload()
+        except (ImportError, OSError, RuntimeError) as exc:
+            LOGGER.info("Can't watch {} ({}), polling every {}s".format(self.path, exc, self.poll_interval))
+        await self._poll()
+
+    def stat(self) -> Optional[Tuple[int, int, int]]:
+        """What we compare to detect changes, None if there is no file, blocking"""
+        try:
+            stat = self.path.stat()
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    async def _poll(self) -> None:
+        """Fallback watcher"""
+        previous = self.stat()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            current = self.stat()
+            if current != previous:
+                previous = current
+                await self.reload()
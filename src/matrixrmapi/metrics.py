@@ -0,0 +1,312 @@
+"""Prometheus metrics without extra dependencies.
+
+Every worker counts in memory and periodically writes a snapshot to a file in METRICS_DIR,
+the worker that gets the scrape merges the files of the others with its own live numbers.
+The gunicorn master empties the directory when it starts and folds the counters and histograms of a worker that
+exits into an archive file (see gunicorn_conf), so the totals never go backwards. Gauges of workers that are not
+running are dropped."""
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from bisect import bisect_left
+from pathlib import Path
+import asyncio
+import functools
+import json
+import logging
+import os
+import time
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .config import METRICS_DIR, METRICS_FLUSH_INTERVAL, private_directory
+from .health import get_health_monitor
+
+LOGGER = logging.getLogger(__name__)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100.0, 1000.0, 10000.0, 100000.0, 1000000.0, 10000000.0)
+# name -> (type, help)
+METRICS = {
+    "http_requests_total": ("counter", "Requests by route and status"),
+    "http_request_duration_seconds": ("histogram", "Time to send the response by route"),
+    "http_response_size_bytes": ("histogram", "Response body size by route"),
+    "http_requests_in_flight": ("gauge", "Requests being processed"),
+    "event_loop_lag_seconds": ("gauge", "How late the event loop wakes up, per worker"),
+    "admission_rejected_total": ("counter", "Requests rejected by admission control by route class and reason"),
+}
+# Worker snapshot: {"counters": {name: {labels: value}}, "histograms": {name: {labels: [buckets..., sum]}},
+# "gauges": {name: {labels: value}}}
+Snapshot = Dict[str, Dict[str, Dict[str, Any]]]
+# Snapshot of the exited workers, "archived" maps their pids to the mtime_ns of the snapshot files it has absorbed
+ARCHIVE_NAME = "archive.json"
+
+
+def format_labels(**labels: str) -> str:
+    """Prometheus label string"""
+    return ",".join(
+        '{}="{}"'.format(key, value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for key, value in labels.items()
+    )
+
+
+def format_value(value: float) -> str:
+    """Integers without the .0"""
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def pid_alive(pid: int) -> bool:
+    """Is the process still running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def snapshot_path(directory: Path, pid: int) -> Path:
+    """Snapshot file of the worker"""
+    return directory / f"worker-{pid}.json"
+
+
+def merge_snapshot(target: Snapshot, snapshot: Snapshot, gauges: bool = True) -> None:
+    """Add the counters, histograms and optionally the gauges of snapshot to target"""
+    for name, values in snapshot.get("counters", {}).items():
+        merged = target.setdefault("counters", {}).setdefault(name, {})
+        for labels, value in values.items():
+            merged[labels] = merged.get(labels, 0) + value
+    for name, values in snapshot.get("histograms", {}).items():
+        merged = target.setdefault("histograms", {}).setdefault(name, {})
+        for labels, counts in values.items():
+            if labels in merged:
+                merged[labels] = [mine + theirs for mine, theirs in zip(merged[labels], counts)]
+            else:
+                merged[labels] = list(counts)
+    if not gauges:
+        return
+    for name, values in snapshot.get("gauges", {}).items():
+        merged = target.setdefault("gauges", {}).setdefault(name, {})
+        for labels, value in values.items():
+            merged[labels] = merged.get(labels, 0) + value
+
+
+def archive_worker(directory: Path, pid: int) -> None:
+    """Fold the counters and histograms of an exited worker into the archive and remove its snapshot, blocking IO.
+
+    Only the gunicorn master calls this, so there is one writer. The archive is written before the snapshot is
+    removed and it names the snapshot it absorbed, so a scrape in between does not count the worker twice"""
+    path = snapshot_path(directory, pid)
+    try:
+        mtime = path.stat().st_mtime_ns
+        snapshot = json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return
+    archive_path = directory / ARCHIVE_NAME
+    try:
+        archive: Dict[str, Any] = json.loads(archive_path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        archive = {"counters": {}, "histograms": {}, "archived": {}}
+    merge_snapshot(archive, snapshot, gauges=False)
+    # Remember only the snapshots that are still there, a new worker may get the same pid later
+    archived = {key: value for key, value in archive["archived"].items() if snapshot_path(directory, int(key)).exists()}
+    archived[str(pid)] = mtime
+    archive["archived"] = archived
+    tmp = archive_path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(archive), encoding="utf-8")
+    tmp.replace(archive_path)
+    path.unlink()
+
+
+class MetricsStore:  # pylint: disable=too-many-instance-attributes
+    """In-memory metrics of this worker, the hot path is a few dict operations"""
+
+    def __init__(self, directory: Path, flush_interval: float = 5.0) -> None:
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.in_flight = 0
+        self._counters: Dict[str, float] = {}
+        self._rejections: Dict[str, float] = {}
+        # labels -> per-bucket counts (non-cumulative, last is +Inf) followed by the sum
+        self._durations: Dict[str, List[float]] = {}
+        self._sizes: Dict[str, List[float]] = {}
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._started = 0
+
+    @property
+    def pid(self) -> int:
+        """Not stored, gunicorn --preload would fork us with the master's pid"""
+        return os.getpid()
+
+    @property
+    def path(self) -> Path:
+        """Snapshot file of this worker"""
+        return snapshot_path(self.directory, self.pid)
+
+    @staticmethod
+    def _observe(histogram: Dict[str, List[float]], buckets: Sequence[float], labels: str, value: float) -> None:
+        """Add value to histogram"""
+        counts = histogram.get(labels)
+        if counts is None:
+            counts = histogram[labels] = [0.0] * (len(buckets) + 2)
+        counts[bisect_left(buckets, value)] += 1
+        counts[-1] += value
+
+    def observe_request(self, method: str, route: str, status: int, duration: float, size: int) -> None:
+        """Record finished request"""
+        labels = format_labels(method=method, route=route)
+        key = f"{labels},{format_labels(status=str(status))}"
+        self._counters[key] = self._counters.get(key, 0) + 1
+        self._observe(self._durations, LATENCY_BUCKETS, labels, duration)
+        self._observe(self._sizes, SIZE_BUCKETS, labels, float(size))
+
+    def observe_rejection(self, route_class: str, reason: str) -> None:
+        """Record request rejected by admission control"""
+        key = format_labels(route_class=route_class, reason=reason)
+        self._rejections[key] = self._rejections.get(key, 0) + 1
+
+    def snapshot(self) -> Snapshot:
+        """Current values of this worker"""
+        return {
+            "counters": {
+                "http_requests_total": dict(self._counters),
+                "admission_rejected_total": dict(self._rejections),
+            },
+            "histograms": {
+                "http_request_duration_seconds": {key: list(val) for key, val in self._durations.items()},
+                "http_response_size_bytes": {key: list(val) for key, val in self._sizes.items()},
+            },
+            "gauges": {
+                "http_requests_in_flight": {"": self.in_flight},
+                "event_loop_lag_seconds": {format_labels(pid=str(self.pid)): get_health_monitor().lag_monitor.lag},
+            },
+        }
+
+    def flush(self) -> None:
+        """Write snapshot for the other workers, atomically so readers never see half a file"""
+        private_directory(self.directory)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.snapshot()), encoding="utf-8")
+        tmp.replace(self.path)
+
+    def _read_others(self) -> List[Tuple[Snapshot, bool]]:
+        """Snapshots of the other workers and the archive, with whether their gauges count (worker still alive)"""
+        workers: Dict[str, Tuple[Snapshot, int]] = {}
+        for path in self.directory.glob("worker-*.json"):
+            try:
+                pid = int(path.stem.split("-", 1)[1])
+                if pid == self.pid:
+                    continue
+                mtime = path.stat().st_mtime_ns
+                workers[str(pid)] = (json.loads(path.read_text(encoding="utf-8")), mtime)
+            except (OSError, ValueError) as exc:
+                LOGGER.warning("Could not read metrics from {}: {}".format(path, exc))
+        results: List[Tuple[Snapshot, bool]] = []
+        archive_path = self.directory / ARCHIVE_NAME
+        try:
+            # After the workers, a worker archived meanwhile is then in it and skipped below
+            archive: Dict[str, Any] = json.loads(archive_path.read_text(encoding="utf-8"))
+            results.append((archive, False))
+            archived: Dict[str, int] = archive.get("archived", {})
+        except FileNotFoundError:
+            archived = {}
+        except (OSError, ValueError) as exc:
+            LOGGER.warning("Could not read metrics from {}: {}".format(archive_path, exc))
+            archived = {}
+        for key, (snapshot, mtime) in workers.items():
+            if archived.get(key) != mtime:
+                results.append((snapshot, pid_alive(int(key))))
+        return results
+
+    def collect(self) -> Snapshot:
+        """Merge all workers, blocking IO so run it in a thread"""
+        merged = self.snapshot()
+        for snapshot, alive in self._read_others():
+            merge_snapshot(merged, snapshot, gauges=alive)
+        return merged
+
+    def render(self) -> str:
+        """Prometheus text format of all the workers"""
+        merged = self.collect()
+        lines: List[str] = []
+        for name, (kind, description) in METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                buckets = LATENCY_BUCKETS if name == "http_request_duration_seconds" else SIZE_BUCKETS
+                for labels, counts in sorted(merged["histograms"].get(name, {}).items()):
+                    cumulative = 0.0
+                    for bound, count in zip([*map(format_value, buckets), "+Inf"], counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {format_value(cumulative)}')
+                    lines.append(f"{name}_sum{{{labels}}} {format_value(counts[-1])}")
+                    lines.append(f"{name}_count{{{labels}}} {format_value(cumulative)}")
+                continue
+            section = "counters" if kind == "counter" else "gauges"
+            for labels, value in sorted(merged[section].get(name, {}).items()):
+                lines.append(f"{name}{{{labels}}} {format_value(value)}" if labels else f"{name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    async def start(self) -> None:
+        """Flush periodically"""
+        self._started += 1
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop flushing once every start() has been matched, writes the final numbers"""
+        self._started -= 1
+        if self._task is not None and self._started <= 0:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            await asyncio.to_thread(self.flush)
+
+    async def _run(self) -> None:
+        """Flush until cancelled"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except OSError as exc:
+                LOGGER.warning("Could not write metrics to {}: {}".format(self.path, exc))
+
+
+class MetricsMiddleware:  # pylint: disable=too-few-public-methods
+    """Pure ASGI middleware so it adds next to nothing per request"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self.store = get_metrics_store()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        store = self.store
+        started = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def wrapped_send(message: Message) -> None:
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        store.in_flight += 1
+        try:
+            await self.app(scope, receive, wrapped_send)
+        finally:
+            store.in_flight -= 1
+            route = scope.get("route")
+            # Templates, not actual paths, unmatched paths would explode the label cardinality
+            path = getattr(route, "path", "unmatched")
+            store.observe_request(scope["method"], path, status, time.perf_counter() - started, size)
+
+
+@functools.cache
+def get_metrics_store() -> MetricsStore:
+    """Get the metrics of this process"""
+    return MetricsStore(METRICS_DIR, METRICS_FLUSH_INTERVAL)
@@ -0,0 +1,56 @@
+"""OpenAPI document built once and served as precompressed bytes"""
+
+from typing import Any, Dict, Tuple
+import hashlib
+import json
+import logging
+
+from fastapi import FastAPI
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+from .compression import ENCODINGS, compress, negotiate_encoding
+from .httpcache import bytes_response, quote_etag
+
+LOGGER = logging.getLogger(__name__)
+
+
+class OpenAPIDocument:  # pylint: disable=too-few-public-methods
+    """Serialized schema and its compressed variants with ETags"""
+
+    def __init__(self, schema: Dict[str, Any]) -> None:
+        self.body = json.dumps(schema, separators=(",", ":")).encode("utf-8")
+        digest = hashlib.sha256(self.body).hexdigest()[:32]
+        self.etag = quote_etag(digest)
+        # encoding -> (data, etag), compressed with the slowest settings since it's done just once
+        self.variants: Dict[str, Tuple[bytes, str]] = {
+            encoding: (compress(self.body, encoding, best=True), quote_etag(f"{digest}-{encoding}"))
+            for encoding in ENCODINGS
+        }
+        LOGGER.debug(
+            "OpenAPI document {} bytes, {}".format(
+                len(self.body), ", ".join(f"{name} {len(data)}" for name, (data, _) in self.variants.items())
+            )
+        )
+
+    async def endpoint(self, request: Request) -> Response:
+        """Serve compressed if the client takes it"""
+        headers = {"Vary": "Accept-Encoding", "Cache-Control": "public, max-age=300"}
+        encoding = negotiate_encoding(request.headers.get("accept-encoding", ""))
+        if encoding is not None:
+            data, etag = self.variants[encoding]
+            return bytes_response(
+                request, data, etag, media_type="application/json", headers={**headers, "Content-Encoding": encoding}
+            )
+        return bytes_response(request, self.body, self.etag, media_type="application/json", headers=headers)
+
+
+def install_openapi(app: FastAPI) -> OpenAPIDocument:
+    """Build the document now and replace FastAPI's lazy per-worker endpoint with it"""
+    document = OpenAPIDocument(app.openapi())
+    for idx, route in enumerate(app.router.routes):
+        if isinstance(route, Route) and route.path == app.openapi_url:
+            app.router.routes[idx] = Route(app.openapi_url, document.endpoint, include_in_schema=False)
+            break
+    return document
@@ -0,0 +1,232 @@
+"""Slow request logging and on-demand sampling CPU profiles.
+
+Requests slower than TRACE_SLOW_THRESHOLD are logged with their timing spans. Admins can get a profile of one
+request by sending "X-Profile: 1", or of the whole worker for a while through the admin API. The profiler samples
+the stacks of every thread from a background thread that only runs while a profile is being taken, the output is
+the folded format that flamegraph.pl, inferno and speedscope take. The event loop runs other requests at the same
+time so a per-request profile shows them too."""
+
+from typing import Dict, Optional, Set
+from collections import Counter
+from pathlib import Path
+from types import CodeType, FrameType
+import asyncio
+import functools
+import logging
+import re
+import secrets
+import sys
+import threading
+import time
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .auth import DN_HEADER, get_authorizer
+from .config import PROFILE_DIR, PROFILE_INTERVAL, PROFILE_KEEP, TRACE_SLOW_THRESHOLD, private_directory
+from .tracing import CURRENT_TRACE, Trace
+
+LOGGER = logging.getLogger(__name__)
+PROFILE_HEADER = b"x-profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+PROFILE_ID = re.compile(r"^[0-9a-f]{16}$")
+
+
+class Profile:  # pylint: disable=too-few-public-methods
+    """Stack samples of one profiling session"""
+
+    def __init__(self) -> None:
+        self.id = secrets.token_hex(8)
+        self.samples: "Counter[str]" = Counter()
+
+    def folded(self) -> str:
+        """One "root;...;leaf count" line per distinct stack"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class SamplingProfiler:
+    """Samples every thread of this process while there are profiles being taken"""
+
+    def __init__(self, directory: Path, interval: float = 0.005, keep: int = 50) -> None:
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self._profiles: Set[Profile] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._labels: Dict[CodeType, str] = {}
+
+    def start(self) -> Profile:
+        """Start taking a profile"""
+        profile = Profile()
+        with self._lock:
+            self._profiles.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        return profile
+
+    def stop(self, profile: Profile) -> Profile:
+        """Stop taking the profile, the thread exits when there are no more"""
+        with self._lock:
+            self._profiles.discard(profile)
+        return profile
+
+    def _label(self, code: CodeType, frame: FrameType) -> str:
+        """module:function, cached as formatting every frame of every sample would cost more than the sampling"""
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{frame.f_globals.get('__name__', code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+            self._labels[code] = label
+        return label
+
+    def fold(self, frame: Optional[FrameType], thread_name: str) -> str:
+        """Stack as "thread;outermost;...;innermost" """
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code, frame))
+            frame = frame.f_back
+        labels.append(thread_name)
+        labels.reverse()
+        return ";".join(labels)
+
+    def _run(self) -> None:
+        """Sample until there are no profiles left"""
+        own = threading.get_ident()
+        while True:
+            with self._lock:
+                if not self._profiles:
+                    self._thread = None
+                    return
+                profiles = list(self._profiles)
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = [
+                self.fold(frame, names.get(ident, str(ident)))
+                for ident, frame in sys._current_frames().items()  # pylint: disable=protected-access
+                if ident != own
+            ]
+            for profile in profiles:
+                profile.samples.update(stacks)
+            time.sleep(self.interval)
+
+    async def sample(self, seconds: float) -> Profile:
+        """Profile the worker for a while"""
+        profile = self.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.stop(profile)
+        return profile
+
+    def save(self, profile: Profile) -> None:
+        """Write the profile where every worker can read it and drop the oldest ones, blocking IO"""
+        private_directory(self.directory)
+        path = self.directory / f"{profile.id}.folded"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(profile.folded(), encoding="utf-8")
+        tmp.replace(path)
+        saved = sorted(self.directory.glob("*.folded"), key=lambda path: path.stat().st_mtime)
+        for old in saved[: max(0, len(saved) - self.keep)]:
+            old.unlink(missing_ok=True)
+
+    def load(self, profile_id: str) -> Optional[str]:
+        """Saved profile by id, None if there's no such profile, blocking IO"""
+        if not PROFILE_ID.match(profile_id):
+            return None
+        try:
+            return (self.directory / f"{profile_id}.folded").read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+
+
+class TracingMiddleware:  # pylint: disable=too-few-public-methods
+    """Times the request, logs it if it was slow and profiles it if an admin asked for that.
+
+    Without a slow threshold only requests with the profile header are traced."""
+
+    def __init__(self, app: ASGIApp, slow_threshold: float = TRACE_SLOW_THRESHOLD) -> None:
+        self.app = app
+        self.slow_threshold = slow_threshold
+        self.profiler = get_profiler()
+
+    async def _may_profile(self, scope: Scope) -> bool:
+        """Did an admin ask for a profile"""
+        headers = Headers(scope=scope)
+        if headers.get("x-profile") not in ("1", "true"):
+            return False
+        dn = headers.get(DN_HEADER)
+        principal = await get_authorizer().principal(dn) if dn else None
+        if principal is None or not (principal.is_rm or principal.is_admin):
+            LOGGER.debug("Ignoring profile request from {}".format(dn))
+            return False
+        return True
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:  # pylint: disable=too-many-locals
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        profile: Optional[Profile] = None
+        if any(key == PROFILE_HEADER for key, _ in scope["headers"]) and await self._may_profile(scope):
+            profile = self.profiler.start()
+        elif self.slow_threshold <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        trace = Trace(started)
+        token = CURRENT_TRACE.set(trace)
+        body_started: Optional[float] = None
+        body_done = False
+        response_started: Optional[float] = None
+        status = 500
+        streamed = False
+
+        async def traced_receive() -> Message:
+            nonlocal body_started, body_done
+            if body_done:
+                return await receive()
+            body_started = body_started or time.perf_counter()
+            message = await receive()
+            if message["type"] != "http.request" or not message.get("more_body", False):
+                body_done = True
+                trace.add("body", time.perf_counter() - body_started)
+            return message
+
+        async def traced_send(message: Message) -> None:
+            nonlocal profile, response_started, status, streamed
+            if message["type"] == "http.response.start":
+                response_started = time.perf_counter()
+                status = message["status"]
+                if profile is not None:
+                    self.profiler.stop(profile)
+                    await asyncio.to_thread(self.profiler.save, profile)
+                    MutableHeaders(scope=message)[PROFILE_ID_HEADER] = profile.id
+                    profile = None
+            elif message["type"] == "http.response.body" and response_started is not None:
+                if message.get("more_body", False):
+                    streamed = True
+                else:
+                    trace.add("send", time.perf_counter() - response_started)
+            await send(message)
+
+        try:
+            await self.app(scope, traced_receive, traced_send)
+        finally:
+            CURRENT_TRACE.reset(token)
+            if profile is not None:
+                self.profiler.stop(profile)  # Failed before responding
+            total = time.perf_counter() - started
+            # Streamed responses (exports, the change feed) are judged by how long they took to start
+            elapsed = response_started - started if streamed and response_started is not None else total
+            if 0 < self.slow_threshold <= elapsed:
+                LOGGER.warning(
+                    "Slow request {} {} {} took {:.1f}ms: {}".format(
+                        scope["method"], scope["path"], status, total * 1000, trace.breakdown(total)
+                    )
+                )
+
+
+@functools.cache
+def get_profiler() -> SamplingProfiler:
+    """Get the profiler of this process"""
+    return SamplingProfiler(PROFILE_DIR, PROFILE_INTERVAL, PROFILE_KEEP)
@@ -0,0 +1,261 @@
+"""Push user changes to the Matrix homeserver admin API in the background"""
+
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence
+from collections import Counter
+from dataclasses import dataclass
+from urllib.parse import quote
+import asyncio
+import functools
+import logging
+import random
+import zlib
+
+
+from .config import (
+    get_manifest,
+    MATRIX_HOMESERVER_URL,
+    MATRIX_ADMIN_TOKEN,
+    MATRIX_SERVER_NAME,
+    PROVISIONING_WORKERS,
+    PROVISIONING_QUEUE_SIZE,
+    PROVISIONING_RETRIES,
+    PROVISIONING_BACKOFF,
+    PROVISIONING_BACKOFF_MAX,
+    PROVISIONING_TIMEOUT,
+    PROVISIONING_DRAIN_TIMEOUT,
+    HOMESERVER_CONCURRENCY,
+)
+
+if TYPE_CHECKING:
+    import aiohttp  # Imported when the queue is started, it's slow to import
+
+LOGGER = logging.getLogger(__name__)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+@dataclass
+class ProvisioningJob:
+    """Desired change for one user on the homeserver"""
+
+    uuid: str
+    callsign: str
+    create: bool = False
+    admin: Optional[bool] = None
+    deactivate: bool = False
+    attempt: int = 0
+
+    @classmethod
+    def from_event(cls, event: str, uuid: str, callsign: str) -> "ProvisioningJob":
+        """Map lifecycle event to job"""
+        return cls(
+            uuid=uuid,
+            callsign=callsign,
+            create=event == "created",
+            admin={"promoted": True, "demoted": False}.get(event),
+            deactivate=event == "revoked",
+        )
+
+    def merge(self, newer: "ProvisioningJob") -> Optional["ProvisioningJob"]:
+        """Net effect of this job followed by newer one, None if they cancel out"""
+        if newer.deactivate:
+            if self.create:
+                return None  # The homeserver never needs to hear about this user
+            return ProvisioningJob(uuid=newer.uuid, callsign=newer.callsign, deactivate=True)
+        return ProvisioningJob(
+            uuid=newer.uuid,
+            callsign=newer.callsign,
+            create=self.create or newer.create,
+            admin=self.admin if newer.admin is None else newer.admin,
+            deactivate=self.deactivate and not newer.create,
+        )
+
+    def payload(self) -> Dict[str, Any]:
+        """Body for the synapse admin user upsert"""
+        body: Dict[str, Any] = {"displayname": self.callsign}
+        if self.admin is not None:
+            body["admin"] = self.admin
+        if self.deactivate:
+            body["deactivated"] = True
+        elif self.create:
+            body["deactivated"] = False
+        return body
+
+
+class ProvisioningQueue:  # pylint: disable=too-many-instance-attributes
+    """Bounded queues drained by a pool of workers sharing one keep-alive HTTP session.
+
+    Jobs are sharded to workers by UUID and retried in place so changes to one user are never reordered."""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        homeserver_url: str,
+        *,
+        admin_token: str = "",
+        server_name: str = "",
+        workers: int = 4,
+        maxsize: int = 10000,
+        concurrency: int = 8,
+        retries: int = 5,
+        backoff: float = 0.5,
+        backoff_max: float = 30.0,
+        timeout: float = 10.0,
+        drain_timeout: float = 10.0,
+    ) -> None:
+        self.homeserver_url = homeserver_url.rstrip("/")
+        self.admin_token = admin_token
+        self.server_name = server_name
+        self.workers = workers
+        self.maxsize = maxsize
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.drain_timeout = drain_timeout
+        self._queues: List["asyncio.Queue[ProvisioningJob]"] = []
+        self._session: Optional["aiohttp.ClientSession"] = None
+        self._tasks: List["asyncio.Task[None]"] = []
+
+    @property
+    def enabled(self) -> bool:
+        """Is there a homeserver to talk to"""
+        return bool(self.homeserver_url)
+
+    @property
+    def depth(self) -> int:
+        """Jobs waiting to be processed"""
+        return sum(queue.qsize() for queue in self._queues)
+
+    def user_id(self, uuid: str) -> str:
+        """Matrix user id for given RASENMAEHER user, UUID is the only thing that never changes"""
+        return f"@{uuid.lower()}:{self.server_name}"
+
+    async def start(self) -> None:
+        """Create the session and workers"""
+        if not self.enabled or self._queues:
+            return
+        if not self.server_name:
+            self.server_name = get_manifest()["product"]["dns"]
+        import aiohttp  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+        headers = {"Authorization": f"Bearer {self.admin_token}"} if self.admin_token else None
+        # limit_per_host is the per-homeserver concurrency limit
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0, limit_per_host=self.concurrency, keepalive_timeout=60),
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        self._queues = [asyncio.Queue(maxsize=max(1, self.maxsize // self.workers)) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+        LOGGER.info("Provisioning to {} with {} workers".format(self.homeserver_url, self.workers))
+
+    async def stop(self) -> None:
+        """Give the workers drain_timeout to finish the queued jobs, then stop them and close the session"""
+        if self._tasks and self.drain_timeout > 0:
+            try:
+                await asyncio.wait_for(self.join(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                LOGGER.warning("Provisioning queue not drained in {}s".format(self.drain_timeout))
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.depth:
+            LOGGER.warning("Dropping {} unfinished provisioning jobs".format(self.depth))
+        self._queues = []
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def ping(self) -> None:
+        """Check that the homeserver answers, raises if not"""
+        if self._session is None:
+            raise RuntimeError("Provisioning queue not started")
+        async with self._session.get(f"{self.homeserver_url}/_matrix/client/versions") as resp:
+            resp.raise_for_status()
+
+    def _shard(self, uuid: str) -> int:
+        """Index of the worker queue that handles the user"""
+        return zlib.crc32(uuid.encode("utf-8")) % len(self._queues)
+
+    def has_room(self, uuids: Sequence[str]) -> bool:
+        """Would jobs for all of these users fit in the queues right now"""
+        if not self.enabled:
+            return True
+        if not self._queues:
+            return False
+        needed = Counter(self._shard(uuid) for uuid in uuids)
+        return all(
+            self._queues[shard].maxsize - self._queues[shard].qsize() >= count for shard, count in needed.items()
+        )
+
+    def submit(self, job: ProvisioningJob) -> bool:
+        """Queue the job without waiting, returns False if the queue is full"""
+        if not self.enabled:
+            return True
+        if not self._queues:
+            LOGGER.error("Provisioning queue not started, dropping job for {}".format(job.uuid))
+            return False
+        try:
+            self._queues[self._shard(job.uuid)].put_nowait(job)
+        except asyncio.QueueFull:
+            LOGGER.error("Provisioning queue full, dropping job for {}".format(job.uuid))
+            return False
+        return True
+
+    async def join(self) -> None:
+        """Wait until everything submitted so far has been processed"""
+        await asyncio.gather(*(queue.join() for queue in self._queues))
+
+    async def _worker(self, queue: "asyncio.Queue[ProvisioningJob]") -> None:
+        """Process jobs until cancelled"""
+        while True:
+            job = await queue.get()
+            try:
+                while not await self._process(job):
+                    if job.attempt >= self.retries:
+                        LOGGER.error("Giving up provisioning {} after {} attempts".format(job.uuid, job.attempt + 1))
+                        break
+                    delay = min(self.backoff * 2**job.attempt, self.backoff_max)
+                    job.attempt += 1
+                    await asyncio.sleep(delay * random.uniform(0.5, 1.0))  # nosec B311
+            except Exception:  # pylint: disable=broad-exception-caught
+                LOGGER.exception("Unexpected error provisioning {}".format(job.uuid))
+            finally:
+                queue.task_done()
+
+    async def _process(self, job: ProvisioningJob) -> bool:
+        """Send the job to the homeserver, returns False if it should be retried"""
+        import aiohttp  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+        assert self._session is not None
+        url = f"{self.homeserver_url}/_synapse/admin/v2/users/{quote(self.user_id(job.uuid))}"
+        try:
+            async with self._session.put(url, json=job.payload()) as resp:
+                if resp.status in RETRY_STATUSES:
+                    LOGGER.warning("Homeserver returned {} for {}, will retry".format(resp.status, job.uuid))
+                    return False
+                if resp.status >= 400:
+                    LOGGER.error("Homeserver rejected {}: {} {}".format(job.uuid, resp.status, await resp.text()))
+                return True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            LOGGER.warning("Homeserver request for {} failed: {!r}, will retry".format(job.uuid, exc))
+            return False
+
+
+@functools.cache
+def get_provisioning() -> ProvisioningQueue:
+    """Get the provisioning queue for this process"""
+    return ProvisioningQueue(
+        MATRIX_HOMESERVER_URL,
+        admin_token=MATRIX_ADMIN_TOKEN,
+        server_name=MATRIX_SERVER_NAME,
+        workers=PROVISIONING_WORKERS,
+        maxsize=PROVISIONING_QUEUE_SIZE,
+        concurrency=HOMESERVER_CONCURRENCY,
+        retries=PROVISIONING_RETRIES,
+        backoff=PROVISIONING_BACKOFF,
+        backoff_max=PROVISIONING_BACKOFF_MAX,
+        timeout=PROVISIONING_TIMEOUT,
+        drain_timeout=PROVISIONING_DRAIN_TIMEOUT,
+    )
@@ -0,0 +1,100 @@
+"""Bring the local state in line with a full user snapshot from RASENMAEHER"""
+
+from typing import AsyncIterator, List, Optional, Set, Tuple
+import logging
+
+from pydantic import BaseModel, Field, ValidationError
+from libpvarki.schemas.product import UserCRUDRequest
+
+from .config import BATCH_CHUNK_SIZE
+from .lifecycle import EventType, LifecycleEvent, apply_events
+from .registry import get_registry, user_digest
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SnapshotRecord(UserCRUDRequest):  # pylint: disable=too-few-public-methods
+    """User as RASENMAEHER sees it"""
+
+    admin: Optional[bool] = Field(default=None, description="Admin status, leave out to not touch it")
+
+
+class ReconcileResult(BaseModel):  # pylint: disable=too-few-public-methods
+    """What reconciling changed"""
+
+    received: int = Field(default=0, description="Records in the snapshot")
+    invalid: int = Field(default=0, description="Records that could not be parsed")
+    created: int = Field(default=0)
+    updated: int = Field(default=0)
+    promoted: int = Field(default=0)
+    demoted: int = Field(default=0)
+    revoked: int = Field(default=0)
+    failed: int = Field(default=0, description="Events that could not be applied")
+    dry_run: bool = Field(default=False, description="Nothing was actually applied")
+
+
+class Reconciler:  # pylint: disable=too-few-public-methods
+    """Diffs the snapshot against registry state keyed by UUID and applies the deltas in chunks"""
+
+    def __init__(self, dry_run: bool = False, allow_empty: bool = False) -> None:
+        self.result = ReconcileResult(dry_run=dry_run)
+        self.allow_empty = allow_empty
+        self._pending: List[LifecycleEvent] = []
+
+    async def _emit(self, event: EventType, user: UserCRUDRequest) -> None:
+        """Queue one delta"""
+        setattr(self.result, event, getattr(self.result, event) + 1)
+        self._pending.append(LifecycleEvent(event=event, user=user))
+        if len(self._pending) >= BATCH_CHUNK_SIZE:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        """Apply queued deltas"""
+        if self._pending and not self.result.dry_run:
+            results = await apply_events(self._pending)
+            self.result.failed += sum(1 for result in results if not result.success)
+        self._pending = []
+
+    async def run(self, lines: AsyncIterator[Tuple[int, bytes]]) -> ReconcileResult:
+        """Consume the snapshot and apply the deltas"""
+        registry = get_registry()
+        states = await registry.states()
+        active: Set[str] = {uuid for uuid, (_, _, revoked) in states.items() if not revoked}
+        seen: Set[str] = set()
+        async for _, line in lines:
+            self.result.received += 1
+            try:
+                record = SnapshotRecord.model_validate_json(line)
+            except ValidationError:
+                self.result.invalid += 1
+                continue
+            seen.add(record.uuid)
+            user = UserCRUDRequest(uuid=record.uuid, callsign=record.callsign, x509cert=record.x509cert)
+            state = states.get(record.uuid)
+            if state is None or state[2]:
+                await self._emit("created", user)
+            elif state[0] != user_digest(record.callsign, record.x509cert):
+                await self._emit("updated", user)
+            if record.admin is not None and record.admin != (state[1] if state else False):
+                await self._emit("promoted" if record.admin else "demoted", user)
+        # States is not needed anymore and can be big
+        del states
+        await self._flush()
+        if self.result.invalid:
+            # We can't know whose records those were, better not revoke anyone
+            LOGGER.warning("Snapshot had {} invalid records, not revoking anything".format(self.result.invalid))
+            return self.result
+        if not self.result.received and not self.allow_empty:
+            # More likely a truncated upload than a deployment without users
+            LOGGER.warning("Snapshot was empty, not revoking anything unless it is explicitly allowed")
+            return self.result
+        gone = sorted(active - seen)
+        LOGGER.info("Snapshot had {} users, revoking {} missing ones".format(len(seen), len(gone)))
+        for start in range(0, len(gone), BATCH_CHUNK_SIZE):
+            for gone_user in await registry.get_many(gone[start : start + BATCH_CHUNK_SIZE]):
+                await self._emit(
+                    "revoked",
+                    UserCRUDRequest(uuid=gone_user.uuid, callsign=gone_user.callsign, x509cert=gone_user.x509cert),
+                )
+        await self._flush()
+        return self.result
@@ -0,0 +1,347 @@
+"""Local registry of the users RASENMAEHER has told us about, and the log of changes made to it.
+
+SQLite in WAL mode so all the gunicorn workers can read concurrently while one of them writes,
+the queries run in worker threads so they never block the event loop."""
+
+from typing import Any, AsyncIterator, Callable, Dict, List, Literal, Optional, Sequence, Tuple, TypeVar
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from pydantic import BaseModel, Field
+
+from .config import USER_REGISTRY_PATH, FEED_RETENTION
+
+LOGGER = logging.getLogger(__name__)
+T = TypeVar("T")  # pylint: disable=invalid-name
+
+# (event, uuid, callsign, x509cert)
+UserChange = Tuple[str, str, str, str]
+# (idempotency key, response as JSON, expires as unix timestamp)
+ReplayEntry = Tuple[str, str, float]
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS users (
+        uuid TEXT PRIMARY KEY,
+        callsign TEXT NOT NULL,
+        x509cert TEXT NOT NULL,
+        admin INTEGER NOT NULL DEFAULT 0,
+        revoked INTEGER NOT NULL DEFAULT 0,
+        updated REAL NOT NULL
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS users_callsign ON users (callsign)",
+    # AUTOINCREMENT so ids are never reused after trimming, clients resume from them
+    """CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        subject TEXT,
+        data TEXT NOT NULL,
+        created REAL NOT NULL
+    )""",
+    # Response to the latest single event per user, see idempotency
+    """CREATE TABLE IF NOT EXISTS replays (
+        uuid TEXT PRIMARY KEY,
+        key TEXT NOT NULL,
+        response TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        expires REAL NOT NULL
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS replays_expires ON replays (expires)",
+)
+
+UPSERT = """INSERT INTO users (uuid, callsign, x509cert, admin, revoked, updated)
+VALUES (?, ?, ?, {admin}, {revoked}, ?)
+ON CONFLICT (uuid) DO UPDATE SET
+    callsign=excluded.callsign, x509cert=excluded.x509cert, updated=excluded.updated{extra}"""
+STATEMENTS = {
+    "created": UPSERT.format(admin=0, revoked=0, extra=", revoked=0"),
+    "revoked": UPSERT.format(admin=0, revoked=1, extra=", revoked=1"),
+    "promoted": UPSERT.format(admin=1, revoked=0, extra=", admin=1"),
+    "demoted": UPSERT.format(admin=0, revoked=0, extra=", admin=0"),
+    "updated": UPSERT.format(admin=0, revoked=0, extra=""),
+}
+SELECT_USERS = "SELECT uuid, callsign, x509cert, admin, revoked, updated FROM users"
+INSERT_EVENT = "INSERT INTO events (kind, subject, data, created) VALUES (?, ?, ?, ?)"
+# Skipped if the latest event of the kind is the same, so every worker can report the change it noticed
+INSERT_EVENT_ONCE = """INSERT INTO events (kind, subject, data, created) SELECT ?1, ?2, ?3, ?4
+WHERE COALESCE((SELECT data FROM events WHERE kind = ?1 ORDER BY id DESC LIMIT 1), '') != ?3"""
+TRIM_EVENTS = "DELETE FROM events WHERE id <= (SELECT MAX(id) FROM events) - ?"
+SELECT_REPLAY = "SELECT response FROM replays WHERE uuid = ? AND key = ? AND expires > ?"
+DELETE_REPLAY = "DELETE FROM replays WHERE uuid = ?"
+UPSERT_REPLAY = """INSERT INTO replays (uuid, key, response, size, expires)
+VALUES (?1, ?2, ?3, length(?1) + length(?2) + length(?3), ?4)
+ON CONFLICT (uuid) DO UPDATE SET
+    key=excluded.key, response=excluded.response, size=excluded.size, expires=excluded.expires"""
+# SQLite has a limit on number of host parameters
+MAX_PARAMS = 500
+UserFilter = Literal["all", "active", "revoked", "admin"]
+USER_FILTERS: Dict[str, str] = {
+    "all": "1",
+    "active": "revoked = 0",
+    "revoked": "revoked = 1",
+    "admin": "admin = 1 AND revoked = 0",
+}
+# (digest of callsign and cert, admin, revoked)
+UserState = Tuple[bytes, bool, bool]
+# (id, kind, subject, data as JSON)
+EventRow = Tuple[int, str, Optional[str], str]
+
+
+def user_digest(callsign: str, x509cert: str) -> bytes:
+    """Compact fingerprint of the mutable user data"""
+    return hashlib.blake2b(f"{callsign}\0{x509cert}".encode("utf-8"), digest_size=8).digest()
+
+
+class UserRecord(BaseModel):  # pylint: disable=too-few-public-methods
+    """What we know about an user"""
+
+    uuid: str = Field(description="User UUID")
+    callsign: str = Field(description="Current callsign")
+    x509cert: str = Field(description="Current certificate")
+    admin: bool = Field(description="Has admin privileges")
+    revoked: bool = Field(description="Has been revoked")
+    updated: float = Field(description="Unix timestamp of last change")
+
+    @classmethod
+    def from_row(cls, row: Sequence[Any]) -> "UserRecord":
+        """Map a row selected with SELECT_USERS"""
+        return cls(
+            uuid=row[0],
+            callsign=row[1],
+            x509cert=row[2],
+            admin=bool(row[3]),
+            revoked=bool(row[4]),
+            updated=row[5],
+        )
+
+
+class UserRegistry:  # pylint: disable=too-many-instance-attributes
+    """SQLite backed user registry, one writer thread and a small pool of reader threads per process"""
+
+    def __init__(self, path: Path, readers: int = 2, events_retention: int = 10000) -> None:
+        self.path = path
+        self.readers = readers
+        self.events_retention = events_retention
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._reader: Optional[ThreadPoolExecutor] = None
+        self._ready: Optional["Future[None]"] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """Connection for the current thread"""
+        conn: Optional[sqlite3.Connection] = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10.0, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _create_schema(self) -> None:
+        """Create the database if needed, runs in the writer thread"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    async def _run(self, executor: ThreadPoolExecutor, func: Callable[..., T], *args: Any) -> T:
+        """Run func in given executor"""
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args))
+
+    async def open(self) -> None:
+        """Start the threads and make sure the schema exists"""
+        if self._ready is None:
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="registry-writer")
+            self._reader = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="registry-reader")
+            self._ready = self._writer.submit(self._create_schema)
+            LOGGER.info("Opening user registry at {}".format(self.path))
+        await asyncio.wrap_future(self._ready)
+
+    async def close(self) -> None:
+        """Stop the threads and close connections"""
+        if self._writer is None or self._reader is None:
+            return
+        self._writer.shutdown(wait=True)
+        self._reader.shutdown(wait=True)
+        self._writer, self._reader, self._ready = None, None, None
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    async def write(self, func: Callable[..., T], *args: Any) -> T:
+        """Run func(connection, *args) in the writer thread"""
+        await self.open()
+        assert self._writer is not None
+        return await self._run(self._writer, lambda: func(self._connection(), *args))
+
+    async def read(self, func: Callable[..., T], *args: Any) -> T:
+        """Run func(connection, *args) in a reader thread"""
+        await self.open()
+        assert self._reader is not None
+        return await self._run(self._reader, lambda: func(self._connection(), *args))
+
+    async def apply(self, changes: Sequence[UserChange], replay: Optional[ReplayEntry] = None) -> Optional[str]:
+        """Apply lifecycle changes in order in a single transaction, logging them to the events.
+
+        Every change forgets the stored response of its user as it is not the latest event anymore. With replay
+        the changes are of one user: if the stored response has the same key nothing is applied and it is
+        returned, otherwise the response is stored with the changes. Returns None if the changes were applied"""
+
+        def _apply(
+            conn: sqlite3.Connection, changes: Sequence[UserChange], replay: Optional[ReplayEntry]
+        ) -> Optional[str]:
+            if not changes:
+                return None
+            now = time.time()
+            with conn:
+                # Take the write lock before the check so concurrent retries in other workers wait for us
+                conn.execute("BEGIN IMMEDIATE")
+                if replay is not None:
+                    row = conn.execute(SELECT_REPLAY, (changes[0][1], replay[0], now)).fetchone()
+                    if row:
+                        return str(row[0])
+                for event, uuid, callsign, x509cert in changes:
+                    conn.execute(STATEMENTS[event], (uuid, callsign, x509cert, now))
+                    conn.execute(DELETE_REPLAY, (uuid,))
+                    data = json.dumps({"event": event, "uuid": uuid, "callsign": callsign})
+                    conn.execute(INSERT_EVENT, ("user", callsign, data, now))
+                conn.execute(TRIM_EVENTS, (self.events_retention,))
+                if replay is not None:
+                    conn.execute(UPSERT_REPLAY, (changes[0][1], *replay))
+            return None
+
+        return await self.write(_apply, changes, replay)
+
+    async def add_event(self, kind: str, data: str) -> None:
+        """Log an event that is not about a user, unless the latest one of the kind has the same data"""
+
+        def _add(conn: sqlite3.Connection, kind: str, data: str) -> None:
+            with conn:
+                conn.execute(INSERT_EVENT_ONCE, (kind, None, data, time.time()))
+
+        await self.write(_add, kind, data)
+
+    async def events_after(self, after: int, limit: int = 1000) -> List[EventRow]:
+        """Logged events with id greater than after, oldest first"""
+
+        def _events(conn: sqlite3.Connection, after: int, limit: int) -> List[EventRow]:
+            query = "SELECT id, kind, subject, data FROM events WHERE id > ? ORDER BY id LIMIT ?"
+            return [(row[0], row[1], row[2], row[3]) for row in conn.execute(query, (after, limit))]
+
+        return await self.read(_events, after, limit)
+
+    async def last_event_id(self) -> int:
+        """Id of the latest logged event, 0 if there are none"""
+
+        def _last(conn: sqlite3.Connection) -> int:
+            return int(conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0])
+
+        return await self.read(_last)
+
+    async def get_by_uuid(self, uuid: str) -> Optional[UserRecord]:
+        """Look up user by UUID"""
+
+        def _get(conn: sqlite3.Connection, uuid: str) -> Optional[UserRecord]:
+            row = conn.execute(SELECT_USERS + " WHERE uuid = ?", (uuid,)).fetchone()
+            return UserRecord.from_row(row) if row else None
+
+        return await self.read(_get, uuid)
+
+    async def get_by_callsign(self, callsign: str) -> Optional[UserRecord]:
+        """Look up user by callsign, prefers the active and most recently changed one"""
+
+        def _get(conn: sqlite3.Connection, callsign: str) -> Optional[UserRecord]:
+            row = conn.execute(
+                SELECT_USERS + " WHERE callsign = ? ORDER BY revoked, updated DESC LIMIT 1",
+                (callsign,),
+            ).fetchone()
+            return UserRecord.from_row(row) if row else None
+
+        return await self.read(_get, callsign)
+
+    async def get_many(self, uuids: Sequence[str]) -> List[UserRecord]:
+        """Look up multiple users by UUID, unknown ones are skipped"""
+
+        def _get(conn: sqlite3.Connection, uuids: Sequence[str]) -> List[UserRecord]:
+            result: List[UserRecord] = []
+            for start in range(0, len(uuids), MAX_PARAMS):
+                chunk = uuids[start : start + MAX_PARAMS]
+                query = SELECT_USERS + " WHERE uuid IN (" + ",".join("?" * len(chunk)) + ")"  # nosec B608
+                result.extend(UserRecord.from_row(row) for row in conn.execute(query, chunk))
+            return result
+
+        return await self.read(_get, uuids)
+
+    async def states(self) -> Dict[str, UserState]:
+        """State of every user keyed by UUID, for diffing against a full snapshot"""
+
+        def _states(conn: sqlite3.Connection) -> Dict[str, UserState]:
+            return {
+                row[0]: (user_digest(row[1], row[2]), bool(row[3]), bool(row[4]))
+                for row in conn.execute("SELECT uuid, callsign, x509cert, admin, revoked FROM users")
+            }
+
+        return await self.read(_states)
+
+    async def active_users(self) -> Dict[str, Tuple[str, bool]]:
+        """uuid -> (callsign, admin) of users that are not revoked"""
+
+        def _active(conn: sqlite3.Connection) -> Dict[str, Tuple[str, bool]]:
+            cursor = conn.execute("SELECT uuid, callsign, admin FROM users WHERE revoked = 0")
+            return {row[0]: (row[1], bool(row[2])) for row in cursor}
+
+        return await self.read(_active)
+
+    async def page(self, state: UserFilter = "all", after: Optional[str] = None, limit: int = 100) -> List[UserRecord]:
+        """Users in UUID order after the given UUID (keyset pagination, the primary key makes it a range scan)"""
+
+        def _page(conn: sqlite3.Connection, state: UserFilter, after: str, limit: int) -> List[UserRecord]:
+            query = SELECT_USERS + f" WHERE {USER_FILTERS[state]} AND uuid > ? ORDER BY uuid LIMIT ?"  # nosec B608
+            return [UserRecord.from_row(row) for row in conn.execute(query, (after, limit))]
+
+        return await self.read(_page, state, after or "", limit)
+
+    async def iter_pages(self, state: UserFilter = "all", page_size: int = 1000) -> AsyncIterator[List[UserRecord]]:
+        """All matching users a page at a time, so memory use does not depend on the number of users.
+
+        Not a snapshot, changes made while iterating may or may not show up"""
+        after: Optional[str] = None
+        while True:
+            users = await self.page(state, after, page_size)
+            if users:
+                yield users
+            if len(users) < page_size:
+                return
+            after = users[-1].uuid
+
+    async def counts(self) -> Dict[str, int]:
+        """Number of users in total and per state"""
+
+        def _counts(conn: sqlite3.Connection) -> Dict[str, int]:
+            row = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(revoked = 0), 0), COALESCE(SUM(admin = 1 AND revoked = 0), 0) "
+                "FROM users"
+            ).fetchone()
+            return {"total": row[0], "active": row[1], "admin": row[2], "revoked": row[0] - row[1]}
+
+        return await self.read(_counts)
+
+
+@functools.cache
+def get_registry() -> UserRegistry:
+    """Get the registry for this process"""
+    return UserRegistry(USER_REGISTRY_PATH, events_retention=FEED_RETENTION)
@@ -0,0 +1,87 @@
+"""Compiled Jinja templates shared by all the endpoints.
+
+The environment is created once per process, compiled bytecode is cached on disk so the other
+workers (and restarts) can skip compiling, and edited templates are picked up by checking mtimes
+at most every check_interval seconds."""
+
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
+from pathlib import Path
+import functools
+import logging
+import time
+
+from .config import TEMPLATES_PATH, TEMPLATES_CACHE_PATH, TEMPLATES_CHECK_INTERVAL, private_directory
+
+if TYPE_CHECKING:
+    from jinja2 import Template
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TemplateEngine:
+    """Keeps compiled templates and memoizes renders that take no context"""
+
+    def __init__(self, path: Path, cache_path: Optional[Path] = None, check_interval: float = 2.0) -> None:
+        # Imported here so that importing the app (or running CLI commands) does not pay for jinja2
+        # pylint: disable=import-outside-toplevel
+        from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, select_autoescape
+
+        # Without a path Jinja uses a per-user directory in the temp directory
+        bytecode_cache = (
+            FileSystemBytecodeCache()
+            if cache_path is None
+            else FileSystemBytecodeCache(str(private_directory(cache_path)))
+        )
+        self.env = Environment(
+            loader=FileSystemLoader(path),
+            autoescape=select_autoescape(["html"]),
+            bytecode_cache=bytecode_cache,
+        )
+        self.check_interval = check_interval
+        # name -> (template, monotonic time of last mtime check)
+        self._templates: Dict[str, Tuple["Template", float]] = {}
+        # name -> (template the result was rendered with, result)
+        self._static: Dict[str, Tuple["Template", str]] = {}
+
+    def warm(self) -> None:
+        """Compile everything up front"""
+        for name in self.env.list_templates():
+            self.get_template(name)
+        LOGGER.debug("Compiled {} templates".format(len(self._templates)))
+
+    def get_template(self, name: str) -> "Template":
+        """Compiled template, recompiled if the file has changed"""
+        now = time.monotonic()
+        cached = self._templates.get(name)
+        if cached is not None and now - cached[1] < self.check_interval:
+            return cached[0]
+        # Jinja checks the mtime and recompiles (or loads the bytecode) if needed
+        template = self.env.get_template(name)
+        if cached is not None and cached[0] is not template:
+            LOGGER.info("Template {} changed, reloaded".format(name))
+        self._templates[name] = (template, now)
+        return template
+
+    def exists(self, name: str) -> bool:
+        """Is there a template with this name"""
+        if name in self._templates:
+            return True
+        return name in self.env.list_templates()
+
+    def render(self, name: str, **context: Any) -> str:
+        """Render the template, without context the result is memoized until the template changes"""
+        template = self.get_template(name)
+        if context:
+            return template.render(**context)
+        cached = self._static.get(name)
+        if cached is not None and cached[0] is template:
+            return cached[1]
+        result = template.render()
+        self._static[name] = (template, result)
+        return result
+
+
+@functools.cache
+def get_template_engine() -> TemplateEngine:
+    """Get the template engine for this process"""
+    return TemplateEngine(TEMPLATES_PATH, TEMPLATES_CACHE_PATH, TEMPLATES_CHECK_INTERVAL)
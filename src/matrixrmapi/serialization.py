@@ -0,0 +1,109 @@
+"""JSON responses serialized by pydantic-core straight to bytes, without FastAPI's re-validation round trip"""
+
+from typing import Any, Callable, Coroutine, Dict, Optional, Tuple
+import inspect
+import logging
+import time
+
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, TypeAdapter
+from pydantic_core import to_json
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+from .tracing import CURRENT_TRACE, record
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ModelJSONResponse(JSONResponse):
+    """JSON encoded by pydantic-core, bytes are taken to be already serialized JSON"""
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return to_json(content)
+
+
+class SerializingField:
+    """Stands in for the route response field in the request handler.
+
+    Model instances of the declared type were validated when they were created so they are passed through,
+    anything else is validated by the original field. Serializing goes through the declared type so subclasses
+    do not leak extra fields, same as FastAPI does."""
+
+    def __init__(self, field: Any, response_model: Any) -> None:
+        self.field = field
+        self.adapter: TypeAdapter[Any] = TypeAdapter(response_model)
+        self.model_type = response_model if inspect.isclass(response_model) else None
+        if self.model_type is not None and not issubclass(self.model_type, BaseModel):
+            self.model_type = None
+
+    def validate(self, value: Any, values: Dict[str, Any], *, loc: Tuple[Any, ...] = ()) -> Tuple[Any, Any]:
+        """Validate unless it's an instance of the response model already"""
+        if self.model_type is not None and isinstance(value, self.model_type):
+            return value, None
+        started = time.perf_counter()
+        validated: Tuple[Any, Any] = self.field.validate(value, values, loc=loc)
+        record("serialize", started)
+        return validated
+
+    def serialize(  # pylint: disable=too-many-arguments
+        self,
+        value: Any,
+        *,
+        include: Any = None,
+        exclude: Any = None,
+        by_alias: bool = True,
+        exclude_unset: bool = False,
+        exclude_defaults: bool = False,
+        exclude_none: bool = False,
+    ) -> bytes:
+        """The final JSON bytes, ModelJSONResponse sends them as is"""
+        started = time.perf_counter()
+        data = self.adapter.dump_json(
+            value,
+            include=include,
+            exclude=exclude,
+            by_alias=by_alias,
+            exclude_unset=exclude_unset,
+            exclude_defaults=exclude_defaults,
+            exclude_none=exclude_none,
+        )
+        record("serialize", started)
+        return data
+
+
+class ModelJSONRoute(APIRoute):
+    """Route that serializes its response model in one pass when the response class is ModelJSONResponse,
+    and times its request handler for the request trace"""
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        field: Optional[Any] = self.secure_cloned_response_field
+        response_class = self.response_class
+        if isinstance(response_class, DefaultPlaceholder):
+            response_class = response_class.value
+        if (
+            field is not None
+            and not isinstance(field, SerializingField)
+            and inspect.isclass(response_class)
+            and issubclass(response_class, ModelJSONResponse)
+        ):
+            self.secure_cloned_response_field = SerializingField(field, self.response_model)  # type: ignore[assignment]
+        handler = super().get_route_handler()
+
+        async def traced_handler(request: Request) -> Response:
+            """The time of the handler minus the spans recorded within it (body, auth, serialize)"""
+            trace = CURRENT_TRACE.get()
+            if trace is None:
+                return await handler(request)
+            started = time.perf_counter()
+            nested = sum(trace.spans.values())
+            try:
+                return await handler(request)
+            finally:
+                nested = sum(trace.spans.values()) - nested
+                trace.add("handler", max(0.0, time.perf_counter() - started - nested))
+
+        return traced_handler
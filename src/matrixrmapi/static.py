@@ -0,0 +1,178 @@
+"""Built UI files served from an index made at startup, with precompressed variants and immutable caching"""
+
+from typing import Dict, Optional
+from dataclasses import dataclass, field
+from pathlib import Path
+import functools
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+
+from .compression import COMPRESSIBLE_TYPES, ENCODINGS, accepted_encodings, compress
+from .config import COMPRESSION_MIN_SIZE, UI_PATH
+from .httpcache import etag_matches, quote_etag
+
+LOGGER = logging.getLogger(__name__)
+VARIANT_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+# Vite puts an 8 character base64url content hash in the names it generates (index-BQw3Yc_2.js), plain words
+# like "-integration" must not match so require a digit, capital or underscore in it
+HASHED_NAME = re.compile(r"-(?=[\w-]{0,7}[A-Z0-9_])[\w-]{8}\.\w+$")
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "public, no-cache"
+
+
+def media_type(path: Path) -> str:
+    """Content type by file name"""
+    guessed, _ = mimetypes.guess_type(path.name)
+    return guessed or "application/octet-stream"
+
+
+def file_digest(path: Path) -> str:
+    """Content hash, shortened as it only has to tell versions of one file apart"""
+    digest = hashlib.sha256()
+    with path.open("rb") as fpl:
+        for chunk in iter(lambda: fpl.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:32]
+
+
+@dataclass(frozen=True)
+class StaticFile:
+    """File on disk with the stat we took when indexing"""
+
+    path: Path
+    stat: os.stat_result
+
+
+@dataclass(frozen=True)
+class StaticAsset:
+    """One servable asset and its precompressed variants"""
+
+    name: str
+    media_type: str
+    digest: str
+    immutable: bool
+    file: StaticFile
+    variants: Dict[str, StaticFile] = field(default_factory=dict, hash=False)
+
+    def etag(self, encoding: Optional[str] = None) -> str:
+        """Strong ETag per representation"""
+        return quote_etag(f"{self.digest}-{encoding}" if encoding else self.digest)
+
+    @property
+    def size(self) -> int:
+        """Uncompressed size"""
+        return self.file.stat.st_size
+
+
+def index_asset(root: Path, path: Path) -> StaticAsset:
+    """Hash and stat the file and find its fresh precompressed variants"""
+    stat = path.stat()
+    variants: Dict[str, StaticFile] = {}
+    for encoding, suffix in VARIANT_SUFFIXES.items():
+        variant = path.with_name(path.name + suffix)
+        try:
+            variant_stat = variant.stat()
+        except FileNotFoundError:
+            continue
+        # Older than the file means it's from some previous build
+        if variant_stat.st_mtime >= stat.st_mtime and variant_stat.st_size < stat.st_size:
+            variants[encoding] = StaticFile(variant, variant_stat)
+    return StaticAsset(
+        name=path.relative_to(root).as_posix(),
+        media_type=media_type(path),
+        digest=file_digest(path),
+        immutable=bool(HASHED_NAME.search(path.name)),
+        file=StaticFile(path, stat),
+        variants=variants,
+    )
+
+
+class AssetIndex:
+    """Everything under root, indexed once so requests never touch the disk for metadata"""
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.assets: Dict[str, StaticAsset] = {}
+
+    def build(self) -> None:
+        """(Re)index the directory, blocking so run it in a thread"""
+        assets: Dict[str, StaticAsset] = {}
+        if self.root.is_dir():
+            for path in sorted(self.root.rglob("*")):
+                if not path.is_file() or (path.suffix in VARIANT_SUFFIXES.values() and path.with_suffix("").is_file()):
+                    continue
+                asset = index_asset(self.root, path)
+                assets[asset.name] = asset
+        self.assets = assets
+        LOGGER.info(
+            "Indexed {} UI assets ({} bytes) from {}".format(
+                len(assets), sum(asset.size for asset in assets.values()), self.root
+            )
+        )
+
+    async def endpoint(self, request: Request) -> Response:
+        """Serve the asset, best precompressed variant the client takes, 304 straight from the index"""
+        asset = self.assets.get(request.path_params.get("path") or "index.html")
+        if asset is None:
+            raise HTTPException(status_code=404)
+        headers = {"Cache-Control": CACHE_IMMUTABLE if asset.immutable else CACHE_REVALIDATE}
+        encoding: Optional[str] = None
+        if asset.variants:
+            headers["Vary"] = "Accept-Encoding"
+            # Ranges of a compressed variant would confuse more clients than they help
+            if "range" not in request.headers:
+                for candidate in accepted_encodings(request.headers.get("accept-encoding", "")):
+                    if candidate in asset.variants:
+                        encoding = candidate
+                        break
+        headers["ETag"] = asset.etag(encoding)
+        if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        served = asset.file
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+            served = asset.variants[encoding]
+        # Uses http.response.pathsend when the server has it, so the server can sendfile
+        return FileResponse(served.path, stat_result=served.stat, headers=headers, media_type=asset.media_type)
+
+
+def precompress(root: Path, minimum_size: int = COMPRESSION_MIN_SIZE) -> int:
+    """Write .br and .gz next to compressible files that lack fresh ones, returns how many were written"""
+    written = 0
+    for path in sorted(root.rglob("*")):
+        if not path.is_file() or path.suffix in VARIANT_SUFFIXES.values():
+            continue
+        stat = path.stat()
+        if stat.st_size < minimum_size or not media_type(path).startswith(COMPRESSIBLE_TYPES):
+            continue
+        data = b""
+        for encoding in ENCODINGS:
+            target = path.with_name(path.name + VARIANT_SUFFIXES[encoding])
+            if target.exists() and target.stat().st_mtime >= stat.st_mtime:
+                continue
+            data = data or path.read_bytes()
+            compressed = compress(data, encoding, best=True)
+            if len(compressed) >= len(data):
+                continue
+            # Atomic so workers indexing at the same time never see half a file
+            with tempfile.NamedTemporaryFile(dir=path.parent, prefix=".", delete=False) as tmp:
+                tmp.write(compressed)
+            # Temporary files are 0600, the web server may run as another user and has to read these too
+            os.chmod(tmp.name, stat.st_mode & 0o777)
+            os.replace(tmp.name, target)
+            written += 1
+    return written
+
+
+@functools.cache
+def get_asset_index() -> AssetIndex:
+    """Get the UI asset index for this process"""
+    return AssetIndex(UI_PATH)
@@ -0,0 +1,80 @@
+"""Minimal stand-in for the Synapse admin API, for tests and benchmarks"""
+
+from typing import Any, Dict, Optional
+import asyncio
+import logging
+
+from aiohttp import web
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StubHomeserver:
+    """Keeps users in a dict, can be made slow or flaky"""
+
+    def __init__(self, *, delay: float = 0.0, fail_first: int = 0, admin_token: str = "") -> None:
+        self.delay = delay
+        self.fail_first = fail_first
+        self.admin_token = admin_token
+        self.users: Dict[str, Dict[str, Any]] = {}
+        self.requests = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    def make_app(self) -> web.Application:
+        """The aiohttp application"""
+        app = web.Application()
+        app.router.add_get("/_matrix/client/versions", self.versions)
+        app.router.add_put("/_synapse/admin/v2/users/{user_id}", self.put_user)
+        app.router.add_get("/_synapse/admin/v2/users/{user_id}", self.get_user)
+        return app
+
+    async def _preamble(self, request: web.Request) -> None:
+        """Count, delay, fail and check auth as configured"""
+        self.requests += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.fail_first > 0:
+            self.fail_first -= 1
+            raise web.HTTPServiceUnavailable()
+        if self.admin_token and request.headers.get("Authorization") != f"Bearer {self.admin_token}":
+            raise web.HTTPUnauthorized()
+
+    async def versions(self, request: web.Request) -> web.Response:
+        """Client API versions, used as liveness probe"""
+        _ = request
+        return web.json_response({"versions": ["v1.11"]})
+
+    async def put_user(self, request: web.Request) -> web.Response:
+        """Create or modify user"""
+        await self._preamble(request)
+        user_id = request.match_info["user_id"]
+        body = await request.json()
+        created = user_id not in self.users
+        user = self.users.setdefault(user_id, {"name": user_id, "admin": False, "deactivated": False})
+        user.update(body)
+        return web.json_response(user, status=201 if created else 200)
+
+    async def get_user(self, request: web.Request) -> web.Response:
+        """Get user"""
+        await self._preamble(request)
+        user_id = request.match_info["user_id"]
+        if user_id not in self.users:
+            raise web.HTTPNotFound()
+        return web.json_response(self.users[user_id])
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Start serving, returns the base url"""
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        sockets = self._runner.addresses
+        url = f"http://{host}:{sockets[0][1]}"
+        LOGGER.info("Stub homeserver listening on {}".format(url))
+        return url
+
+    async def stop(self) -> None:
+        """Stop serving"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
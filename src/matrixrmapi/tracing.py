@@ -0,0 +1,38 @@
+"""Per-request timing spans, filled in by the auth dependency, the route handler and the serializer"""
+
+from typing import Dict, Optional
+from contextvars import ContextVar
+import time
+
+# In the order they happen, whatever is not covered by them shows up as "other"
+SPANS = ("body", "auth", "handler", "serialize", "send")
+
+
+class Trace:
+    """Where the time of one request went"""
+
+    __slots__ = ("started", "spans")
+
+    def __init__(self, started: float) -> None:
+        self.started = started
+        self.spans: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        """Add time to the span, a span can be entered many times"""
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def breakdown(self, total: float) -> str:
+        """Spans in milliseconds for logging"""
+        parts = [f"{name}={self.spans[name] * 1000:.1f}ms" for name in SPANS if name in self.spans]
+        parts.append(f"other={max(0.0, total - sum(self.spans.values())) * 1000:.1f}ms")
+        return " ".join(parts)
+
+
+CURRENT_TRACE: ContextVar[Optional[Trace]] = ContextVar("matrixrmapi_trace", default=None)
+
+
+def record(name: str, started: float) -> None:
+    """Add the time since started (time.perf_counter) to the span of the current request, if it's traced"""
+    trace = CURRENT_TRACE.get()
+    if trace is not None:
+        trace.add(name, time.perf_counter() - started)
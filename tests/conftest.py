@@ -3,8 +3,16 @@
 from typing import Generator, Dict
 import logging
 import os
+import tempfile
 import uuid
 
+# Must be set before importing the app as config reads environment on import
+TMPDIR = tempfile.mkdtemp(prefix="matrixrmapi_tests_")
+os.environ["USER_REGISTRY_PATH"] = os.path.join(TMPDIR, "users.db")
+# Spawning process pools for every test client is slow, test_certs covers the process pool
+os.environ["CERT_POOL_KIND"] = "thread"
+
+# pylint: disable=wrong-import-position
 from libpvarki.logging import init_logging
 import pytest
 from fastapi.testclient import TestClient
@@ -22,13 +30,13 @@ APP = get_app()
 @pytest.fixture
 def mtlsclient() -> Generator[TestClient, None, None]:
     """Fake the NGinx header"""
-    client = TestClient(
+    with TestClient(
         APP,
         headers={
             "X-ClientCert-DN": "CN=harjoitus1.pvarki.fi,O=harjoitus1.pvarki.fi,L=KeskiSuomi,ST=Jyvaskyla,C=FI",
         },
-    )
-    yield client
+    ) as client:
+        yield client
 
 
 @pytest.fixture
@@ -36,13 +44,13 @@ def rm_mtlsclient() -> Generator[TestClient, None, None]:
     """Fake the NGinx header"""
     manifest = get_manifest()
     rm_cn = manifest["rasenmaeher"]["certcn"]
-    client = TestClient(
+    with TestClient(
         APP,
         headers={
             "X-ClientCert-DN": f"CN={rm_cn},O=harjoitus1.pvarki.fi,L=KeskiSuomi,ST=Jyvaskyla,C=FI",
         },
-    )
-    yield client
+    ) as client:
+        yield client
 
 
 def create_user_dict(callsign: str) -> Dict[str, str]:
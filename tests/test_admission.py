@@ -0,0 +1,158 @@
+"""Test admission control"""
+
+from typing import Dict, List
+import asyncio
+import logging
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from matrixrmapi.admission import (
+    AdmissionController,
+    AdmissionMiddleware,
+    ConcurrencyLimiter,
+    RateLimiter,
+    TokenBucket,
+    route_class,
+)
+from matrixrmapi.config import get_manifest
+from matrixrmapi.health import get_health_monitor
+
+LOGGER = logging.getLogger(__name__)
+USER_DN = "CN=harjoitus1.pvarki.fi,O=harjoitus1.pvarki.fi,L=KeskiSuomi,ST=Jyvaskyla,C=FI"
+
+
+def test_route_class() -> None:
+    """Check the classification"""
+    assert route_class("/api/v1/users/created") == "lifecycle"
+    assert route_class("/api/v2/clients/data") == "heavy"
+    assert route_class("/api/v1/clients/fragment") == "heavy"
+    assert route_class("/api/v1/admins/users") == "default"
+    assert route_class("/api/v1/healthcheck") is None
+    assert route_class("/api/v1/changes/poll") is None
+    assert route_class("/api/metrics") is None
+    assert route_class("/ui/matrix/remoteEntry.js") is None
+
+
+def test_token_bucket() -> None:
+    """Check burst and refill"""
+    bucket = TokenBucket(2, now=0.0)
+    assert bucket.take(1.0, 2, now=0.0) == 0
+    assert bucket.take(1.0, 2, now=0.0) == 0
+    assert bucket.take(1.0, 2, now=0.0) == pytest.approx(1.0)
+    assert bucket.take(1.0, 2, now=0.5) == pytest.approx(0.5)
+    assert bucket.take(1.0, 2, now=1.0) == 0
+    assert bucket.take(1.0, 2, now=100.0) == 0  # Never more than burst
+    assert bucket.take(1.0, 2, now=100.0) == 0
+    assert bucket.take(1.0, 2, now=100.0) > 0
+
+    limiter = RateLimiter(1.0, 1, max_clients=2)
+    assert limiter.take("a") == 0
+    assert limiter.take("a") > 0
+    assert limiter.take("b") == 0
+    assert limiter.take("c") == 0  # Forgets a
+    assert limiter.take("a") == 0
+    assert RateLimiter(0, 1).take("a") == 0
+
+
+@pytest.mark.asyncio
+async def test_concurrency_priority() -> None:
+    """Check that priority waiters get the slot first and the queue is bounded"""
+    limiter = ConcurrencyLimiter(1, max_queue=2)
+    assert await limiter.acquire()
+    order: List[str] = []
+
+    async def waiter(name: str, priority: bool) -> None:
+        if await limiter.acquire(priority=priority, timeout=5):
+            order.append(name)
+            limiter.release()
+
+    tasks = [asyncio.create_task(waiter("user1", False)), asyncio.create_task(waiter("user2", False))]
+    await asyncio.sleep(0)
+    assert limiter.depth == 2
+    assert not await limiter.acquire(timeout=5)  # Queue full
+    tasks.append(asyncio.create_task(waiter("rm", True)))  # RM goes past the limit
+    await asyncio.sleep(0)
+    limiter.release()
+    await asyncio.gather(*tasks)
+    assert order == ["rm", "user1", "user2"]
+    assert limiter.active == 0
+
+    assert await limiter.acquire()
+    assert not await limiter.acquire(timeout=0.01)
+    assert limiter.depth == 0
+    limiter.release()
+    assert limiter.active == 0
+
+
+@pytest.mark.asyncio
+async def test_concurrency_timeout_race(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Check that a slot handed over as the wait times out is not lost"""
+    limiter = ConcurrencyLimiter(1)
+    assert await limiter.acquire()
+
+    async def expired(waiter: "asyncio.Future[None]", timeout: float) -> None:
+        assert timeout == 5
+        limiter.release()  # Resolves the waiter...
+        assert waiter.done()
+        raise asyncio.TimeoutError()  # ...in the iteration the timeout expires
+
+    monkeypatch.setattr(asyncio, "wait_for", expired)
+    assert not await limiter.acquire(timeout=5)
+    monkeypatch.undo()
+    assert (limiter.active, limiter.depth) == (0, 0)
+    assert await limiter.acquire(timeout=0.01)
+
+
+def make_client(controller: AdmissionController) -> TestClient:
+    """App that answers everything"""
+
+    async def endpoint(request: Request) -> PlainTextResponse:
+        return PlainTextResponse(request.url.path)
+
+    app = Starlette(routes=[Route("/api/v1/{path:path}", endpoint, methods=["GET", "POST"])])
+    app.add_middleware(AdmissionMiddleware, controller=controller)
+    return TestClient(app)
+
+
+def test_middleware() -> None:
+    """Check rate limiting, the RM exemption and shedding on event loop lag"""
+    controller = AdmissionController(
+        RateLimiter(0.001, 2),
+        {name: ConcurrencyLimiter(4) for name in ("lifecycle", "heavy", "default")},
+        max_loop_lag=0.5,
+        retry_after=3,
+    )
+    user: Dict[str, str] = {"X-ClientCert-DN": USER_DN}
+    rm_cn = get_manifest()["rasenmaeher"]["certcn"]
+    rm: Dict[str, str] = {"X-ClientCert-DN": f"CN={rm_cn},O=harjoitus1.pvarki.fi"}
+    with make_client(controller) as client:
+        assert client.get("/api/v1/clients/fragment", headers=user).status_code == 200
+        assert client.get("/api/v1/admins/users", headers=user).status_code == 200
+        resp = client.get("/api/v1/clients/fragment", headers=user)
+        assert resp.status_code == 429
+        assert int(resp.headers["retry-after"]) > 1
+        assert client.get("/api/v1/healthcheck", headers=user).status_code == 200
+        for _ in range(5):
+            assert client.post("/api/v1/users/created", headers=rm).status_code == 200
+
+        lag_monitor = get_health_monitor().lag_monitor
+        lag = lag_monitor.lag
+        lag_monitor.lag = 1.0
+        try:
+            resp = client.get("/api/v1/admins/users", headers={"X-ClientCert-DN": "CN=someone"})
+            assert resp.status_code == 503
+            assert resp.headers["retry-after"] == "3"
+            assert client.post("/api/v1/users/created", headers=rm).status_code == 200
+        finally:
+            lag_monitor.lag = lag
+    assert controller.rejected == {("heavy", "rate"): 1, ("default", "lag"): 1}
+
+
+def test_app(mtlsclient: TestClient) -> None:
+    """Check that the app has it"""
+    assert any(middleware.cls is AdmissionMiddleware for middleware in mtlsclient.app.user_middleware)  # type: ignore
@@ -0,0 +1,87 @@
+"""Test DN parsing and role checks"""
+
+import json
+import logging
+
+import pytest
+
+from matrixrmapi.auth import Authorizer, parse_dn
+from matrixrmapi.changes import ChangeEvent
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.mark.asyncio
+async def test_parse_dn() -> None:
+    """Check DN parsing"""
+    assert await parse_dn("CN=KOIRA01a,O=harjoitus1.pvarki.fi") == {"CN": "KOIRA01a", "O": "harjoitus1.pvarki.fi"}
+    assert await parse_dn("garbage") == {}
+
+
+@pytest.mark.asyncio
+async def test_principal_cache() -> None:
+    """Check LRU and RM CN changes"""
+    authorizer = Authorizer("rasenmaeher", cache_size=2)
+    rm_principal = await authorizer.principal("CN=rasenmaeher,O=test")
+    assert rm_principal.is_rm
+    assert await authorizer.principal("CN=rasenmaeher,O=test") is rm_principal
+    assert (authorizer.hits, authorizer.misses) == (1, 1)
+    assert not (await authorizer.principal("CN=KOIRA01a,O=test")).is_rm
+    await authorizer.principal("CN=KISSA01a,O=test")
+    await authorizer.principal("CN=rasenmaeher,O=test")
+    assert authorizer.misses == 4
+
+    authorizer.set_rm_cn("rasenmaeher2")
+    assert not (await authorizer.principal("CN=rasenmaeher,O=test")).is_rm
+    assert (await authorizer.principal("CN=rasenmaeher2,O=test")).is_rm
+
+
+def test_roles() -> None:
+    """Check user and admin role tracking"""
+    authorizer = Authorizer("rasenmaeher")
+    authorizer.load({"1": ("KOIRA01a", True), "2": ("KISSA01a", False)})
+    assert authorizer.is_admin("KOIRA01a")
+    assert authorizer.is_user("KISSA01a")
+    assert not authorizer.is_admin("KISSA01a")
+    authorizer.update("2", "KISSA01a", True)
+    assert authorizer.is_admin("KISSA01a")
+    authorizer.update("2", "KISSA02a")
+    assert authorizer.is_admin("KISSA02a")
+    assert not authorizer.is_user("KISSA01a")
+    authorizer.update("1", None)
+    assert not authorizer.is_user("KOIRA01a")
+    assert not authorizer.is_admin("KOIRA01a")
+    authorizer.update("3", "NORPPA01a")
+    assert authorizer.is_user("NORPPA01a")
+    assert not authorizer.is_admin("NORPPA01a")
+
+
+def test_stale_load() -> None:
+    """Check that role data read before an update does not undo it"""
+    authorizer = Authorizer("rasenmaeher")
+    generation = authorizer.generation
+    authorizer.update("1", "KOIRA01a", True)
+    assert not authorizer.load({}, generation)
+    assert authorizer.is_admin("KOIRA01a")
+    assert authorizer.load({}, authorizer.generation)
+    assert not authorizer.is_user("KOIRA01a")
+
+
+def test_apply_changes() -> None:
+    """Check that role changes from the change feed take effect"""
+    authorizer = Authorizer("rasenmaeher")
+
+    def user(event_id: int, event: str) -> ChangeEvent:
+        return ChangeEvent(
+            event_id, "user", "KOIRA01a", json.dumps({"event": event, "uuid": "1", "callsign": "KOIRA01a"})
+        )
+
+    authorizer.apply_changes([user(1, "created"), user(2, "promoted"), ChangeEvent(3, "manifest", None, "{}")])
+    assert authorizer.is_admin("KOIRA01a")
+    authorizer.apply_changes([user(2, "promoted")])  # Already applied by this worker
+    authorizer.apply_changes([user(4, "updated")])
+    assert authorizer.is_admin("KOIRA01a")
+    authorizer.apply_changes([user(5, "demoted")])
+    assert authorizer.is_user("KOIRA01a") and not authorizer.is_admin("KOIRA01a")
+    authorizer.apply_changes([user(6, "revoked")])
+    assert not authorizer.is_user("KOIRA01a")
@@ -0,0 +1,58 @@
+"""Test the benchmark runner"""
+
+import logging
+
+import pytest
+
+from matrixrmapi.bench import SCENARIOS, bench_app, bench_isolated, parse_importtime, percentile
+from .conftest import APP
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_percentile() -> None:
+    """Check nearest-rank percentiles"""
+    values = [float(value) for value in range(1, 101)]
+    assert percentile(values, 0.5) == 50.0
+    assert percentile(values, 0.95) == 95.0
+    assert percentile(values, 0.99) == 99.0
+    assert percentile([1.0], 0.99) == 1.0
+    assert percentile([], 0.5) == 0.0
+
+
+@pytest.mark.asyncio
+async def test_bench_app() -> None:
+    """Run every scenario in-process"""
+    results = await bench_app(APP, iterations=6, concurrency=3, users=3)
+    assert results["target"] == "asgi"
+    assert set(results["scenarios"]) == set(SCENARIOS)
+    for scenario in results["scenarios"].values():
+        assert scenario["errors"] == 0
+        assert scenario["requests"] >= 6
+        for endpoint in scenario["endpoints"].values():
+            assert endpoint["p50_ms"] <= endpoint["p95_ms"] <= endpoint["p99_ms"]
+
+
+@pytest.mark.asyncio
+async def test_bench_isolated() -> None:
+    """Run a scenario in a fresh interpreter"""
+    results = await bench_isolated(scenarios=["crud"], iterations=2, concurrency=1, users=1)
+    assert results["target"] == "asgi"
+    assert results["scenarios"]["crud"]["errors"] == 0
+
+
+def test_parse_importtime() -> None:
+    """Check grouping the importtime output by package"""
+    output = "\n".join(
+        [
+            "import time: self [us] | cumulative | imported package",
+            "import time:       100 |        100 |     jinja2.utils",
+            "import time:       300 |        400 |   jinja2",
+            "import time:      1000 |       1000 | fastapi",
+        ]
+    )
+    assert parse_importtime(output) == [
+        {"package": "fastapi", "ms": 1.0, "modules": 1},
+        {"package": "jinja2", "ms": 0.4, "modules": 2},
+    ]
+    assert len(parse_importtime(output, top=1)) == 1
@@ -0,0 +1,78 @@
+"""Test the client bundle cache"""
+
+import asyncio
+import io
+import logging
+import zipfile
+
+import pytest
+
+from matrixrmapi.bundles import BundleCache, build_bundle
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_deterministic() -> None:
+    """Check that same input gives same bytes"""
+    first = build_bundle("KOIRA01a", "PEM")
+    second = build_bundle("KOIRA01a", "PEM")
+    assert first.files == second.files
+    assert first.key == second.key
+    assert build_bundle("KOIRA01b", "PEM").key != first.key
+    item = first.file("KOIRA01a_2.zip")
+    assert item
+    with zipfile.ZipFile(io.BytesIO(item.data)) as zip_file:
+        assert zip_file.read("KOIRA01a_2.pem") == b"PEM"
+
+
+@pytest.mark.asyncio
+async def test_cache() -> None:
+    """Check hits, shared builds and the byte budget"""
+    cache = BundleCache()
+    results = await asyncio.gather(*(cache.get("KOIRA01a", "PEM") for _ in range(5)))
+    assert all(result is results[0] for result in results)
+    assert cache.misses == 1
+    assert cache.hits == 4
+    assert cache.total_bytes == results[0].size
+
+    small = BundleCache(max_bytes=results[0].size * 2)
+    for idx in range(3):
+        await small.get(f"KOIRA{idx}", "PEM")
+    assert small.total_bytes <= small.max_bytes
+    assert small.lookup(build_bundle("KOIRA0", "PEM").key) is None
+    assert small.lookup(build_bundle("KOIRA2", "PEM").key) is not None
+
+
+@pytest.mark.asyncio
+async def test_prewarm() -> None:
+    """Check that prewarmed bundles are hits"""
+    cache = BundleCache()
+    cache.prewarm([("KOIRA01a", "PEM")])
+    await asyncio.sleep(0.1)
+    await cache.get("KOIRA01a", "PEM")
+    assert cache.hits == 1
+    await cache.close()
+
+
+@pytest.mark.asyncio
+async def test_cancelled_leader() -> None:
+    """Check that cancelling the first caller does not fail the ones sharing its build"""
+    cache = BundleCache()
+    leader = asyncio.create_task(cache.get("KOIRA01a", "PEM"))
+    await asyncio.sleep(0)
+    follower = asyncio.create_task(cache.get("KOIRA01a", "PEM"))
+    await asyncio.sleep(0)
+    leader.cancel()
+    bundle = await follower
+    assert bundle.callsign == "KOIRA01a"
+    assert leader.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_prewarm_bulk() -> None:
+    """Check that big batches are not prewarmed"""
+    cache = BundleCache(prewarm_max=2)
+    cache.prewarm([(f"KOIRA{idx}", "PEM") for idx in range(3)])
+    await asyncio.sleep(0.1)
+    assert cache.total_bytes == 0
+    await cache.close()
@@ -0,0 +1,61 @@
+"""Test the message catalog"""
+
+from pathlib import Path
+import logging
+
+from matrixrmapi.catalog import MessageCatalog
+from matrixrmapi.rendering import TemplateEngine
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_catalog(tmp_path: Path) -> MessageCatalog:
+    """Catalog with a few languages"""
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "info.en.md").write_text("Hello {{ callsign }} on {{ deployment }}")
+    (templates / "info.fi.md").write_text("Terve {{ callsign }} ({{ deployment }})")
+    (templates / "unrelated.html").write_text("<p>Nope</p>")
+    return MessageCatalog(TemplateEngine(templates, tmp_path / "cache", check_interval=0), cache_size=3)
+
+
+def test_render(tmp_path: Path) -> None:
+    """Check language resolution and caching"""
+    catalog = get_catalog(tmp_path)
+    assert catalog.languages("info") == ["en", "fi"]
+    assert catalog.render("info", "fi", "KOIRA", "test") == "Terve KOIRA (test)"
+    assert catalog.render("info", "fi-FI", "KOIRA", "test") == "Terve KOIRA (test)"
+    assert catalog.render("info", "de", "KOIRA", "test") == "Hello KOIRA on test"
+    assert catalog.misses == 2
+    assert catalog.hits == 1
+    catalog.render("info", "en", "KISSA", "test")
+    catalog.render("info", "en", "NORPPA", "test")
+    assert catalog.misses == 4
+    catalog.render("info", "fi", "KOIRA", "test")
+    assert catalog.misses == 5
+
+
+def test_invalidate(tmp_path: Path) -> None:
+    """Check that renders for the old callsign are dropped"""
+    catalog = get_catalog(tmp_path)
+    catalog.render("info", "en", "KOIRA", "test", uuid="1")
+    catalog.render("info", "fi", "KOIRA", "test", uuid="1")
+    catalog.invalidate("1", "KOIRA")
+    catalog.render("info", "fi", "KOIRA", "test", uuid="1")
+    assert catalog.hits == 1
+    catalog.invalidate("1", "KISSA")
+    catalog.render("info", "fi", "KOIRA", "test")
+    assert catalog.misses == 3
+
+
+def test_callsigns_bounded(tmp_path: Path) -> None:
+    """Check that the users seen in renders are not remembered forever"""
+    catalog = get_catalog(tmp_path)
+    for idx in range(10):
+        catalog.render("info", "en", f"KOIRA{idx}", "test", uuid=str(idx))
+    catalog.invalidate("0", "KISSA")
+    catalog.invalidate("9", "KISSA")
+    assert catalog.render("info", "en", "KOIRA8", "test") == "Hello KOIRA8 on test"
+    assert catalog.hits == 1
+    catalog.render("info", "en", "KOIRA9", "test")
+    assert catalog.hits == 1
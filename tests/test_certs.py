@@ -0,0 +1,88 @@
+"""Test certificate parsing and validation"""
+
+from typing import Optional, Tuple
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import logging
+
+import pytest
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from matrixrmapi.certs import CertificateService
+
+LOGGER = logging.getLogger(__name__)
+
+
+def make_cert(
+    name: str, issuer: Optional[Tuple[x509.Certificate, ec.EllipticCurvePrivateKey]] = None, days: int = 30
+) -> Tuple[x509.Certificate, ec.EllipticCurvePrivateKey]:
+    """Create certificate, self-signed if no issuer is given"""
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+    issuer_cert, issuer_key = issuer if issuer else (None, key)
+    now = datetime.now(timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(issuer_cert.subject if issuer_cert else subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=days))
+        .sign(issuer_key, hashes.SHA256())
+    )
+    return cert, key
+
+
+def to_pem(cert: x509.Certificate) -> str:
+    """PEM string"""
+    return cert.public_bytes(serialization.Encoding.PEM).decode("ascii")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("kind", ["thread", "process"])
+async def test_inspect(tmp_path: Path, kind: str) -> None:
+    """Check validation results and caching"""
+    ca = make_cert("Test CA")
+    ca_path = tmp_path / "ca.pem"
+    ca_path.write_text(to_pem(ca[0]))
+    good = to_pem(make_cert("KOIRA01a", ca)[0])
+    expired = to_pem(make_cert("KOIRA02a", ca, days=-1)[0])
+    selfsigned = to_pem(make_cert("KISSA01a")[0])
+
+    service = CertificateService(kind, 2, ca_path=ca_path)
+    try:
+        infos = await service.inspect_many([good, expired, selfsigned, "garbage", good])
+        assert service.misses == 4
+        assert infos[0].is_valid()
+        assert infos[0].subject == "CN=KOIRA01a"
+        assert len(infos[0].fingerprint) == 64
+        assert infos[4] == infos[0]
+        assert not infos[1].is_valid()
+        assert infos[1].signature_ok
+        assert not infos[2].is_valid()
+        assert not infos[2].signature_ok
+        assert not infos[3].is_valid()
+        assert infos[3].error
+
+        assert (await service.inspect(good)).is_valid()
+        assert service.hits == 1
+        assert service.cached(selfsigned) == infos[2]
+    finally:
+        service.close()
+
+
+@pytest.mark.asyncio
+async def test_lru() -> None:
+    """Check that the cache is bounded"""
+    service = CertificateService("thread", 1, cache_size=2)
+    try:
+        pems = [to_pem(make_cert(f"KOIRA{idx}")[0]) for idx in range(3)]
+        await service.inspect_many(pems)
+        assert service.cached(pems[0]) is None
+        assert service.cached(pems[2]) is not None
+    finally:
+        service.close()
@@ -0,0 +1,178 @@
+"""Test the change feed"""
+
+from typing import Any, Dict, List
+from pathlib import Path
+import asyncio
+import json
+import logging
+import secrets
+import signal
+import socket
+import sys
+
+import aiohttp
+import pytest
+from fastapi.testclient import TestClient
+
+from matrixrmapi.bench import isolated_env
+from matrixrmapi.changes import ChangeEvent, ChangeFeed
+from matrixrmapi.registry import get_registry
+
+from .conftest import create_user_dict
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_event_encode() -> None:
+    """Check the server-sent event framing"""
+    event = ChangeEvent(7, "user", "KOIRA01a", '{"event": "created"}')
+    assert event.encode() == b'id: 7\nevent: user\ndata: {"event": "created"}\n\n'
+    assert event.to_dict() == {"id": 7, "kind": "user", "data": {"event": "created"}}
+
+
+@pytest.mark.asyncio
+async def test_buffer() -> None:
+    """Check resuming from the ring buffer and the reset when events were dropped from it"""
+    feed = ChangeFeed(buffer_size=3)
+    for idx in range(1, 6):
+        feed.buffer.append(ChangeEvent(idx, "user", None, "{}"))
+    feed.last_id = 5
+    assert feed.can_resume(2) and not feed.can_resume(1)
+    assert [event.id for event in feed.since(3)] == [4, 5]
+    events, next_id, reset = await feed.wait(1, 0)
+    assert (events, next_id, reset) == ([], 5, True)
+
+    chunks: List[bytes] = []
+    stream = feed.stream(3, lambda event: event.id != 4)
+    chunks.append(await stream.__anext__())
+    chunks.append(await asyncio.wait_for(stream.__anext__(), 1))
+    await stream.aclose()
+    assert chunks[0].startswith(b"retry: ")
+    assert chunks[1] == ChangeEvent(5, "user", None, "{}").encode()
+
+
+@pytest.mark.asyncio
+async def test_stop_ends_streams() -> None:
+    """Check that stopping the feed ends the waits and streams instead of holding up the shutdown"""
+    feed = ChangeFeed(keepalive=60)
+    await feed.start()
+    stream = feed.stream(None, lambda event: True)
+    assert (await stream.__anext__()).startswith(b"retry: ")
+
+    async def rest() -> List[bytes]:
+        return [chunk async for chunk in stream]
+
+    pending = asyncio.ensure_future(rest())
+    waiting = asyncio.ensure_future(feed.wait(None, 60))
+    await asyncio.sleep(0.05)
+    assert not pending.done() and not waiting.done()
+    await feed.stop()
+    events, _, reset = await asyncio.wait_for(waiting, 1)
+    assert not events and not reset
+    assert set(await asyncio.wait_for(pending, 1)) <= {b": keepalive\n\n"}
+
+
+@pytest.mark.asyncio
+async def test_subscribe() -> None:
+    """Check that subscribers get the events read from the log"""
+    feed = ChangeFeed()
+    seen: List[ChangeEvent] = []
+    feed.subscribe(seen.extend)
+    await feed.start()
+    try:
+        seen.clear()
+        await get_registry().add_event("manifest", json.dumps({"digest": secrets.token_hex(8)}))
+        await feed.poll()
+        assert [event.kind for event in seen] == ["manifest"]
+        assert seen[0].id == feed.last_id
+    finally:
+        await feed.stop()
+
+
+async def _collect(stream: Any) -> List[bytes]:
+    return [chunk async for chunk in stream]
+
+
+@pytest.mark.asyncio
+async def test_stream_max_age() -> None:
+    """Check that streams end after max_age so clients reconnect"""
+    feed = ChangeFeed(keepalive=60, max_age=0.1)
+    chunks = await asyncio.wait_for(_collect(feed.stream(None, lambda event: True)), 1)
+    assert chunks[0].startswith(b"retry: ")
+    assert set(chunks[1:]) <= {b": keepalive\n\n"}
+
+
+@pytest.mark.asyncio
+async def test_sigterm_ends_streams(tmp_path: Path) -> None:
+    """Check that a real server with an open stream exits on SIGTERM and runs the lifespan shutdown"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "--factory",
+        "matrixrmapi.app:get_app",
+        "--port",
+        str(port),
+        env=isolated_env(tmp_path),
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        async with aiohttp.ClientSession(headers={"X-ClientCert-DN": "CN=KOIRA01a"}) as session:
+            for _ in range(100):
+                try:
+                    resp = await session.get(f"http://127.0.0.1:{port}/api/v1/changes")
+                    break
+                except aiohttp.ClientConnectionError:
+                    await asyncio.sleep(0.1)
+            else:
+                assert False, "server did not start"
+            async with resp:
+                assert resp.status == 200
+                assert (await resp.content.readuntil(b"\n\n")).startswith(b"retry: ")
+                proc.send_signal(signal.SIGTERM)
+                await asyncio.wait_for(resp.read(), 10)
+        # Uvicorn raises the signal again once it has shut down
+        assert await asyncio.wait_for(proc.wait(), 10) in (0, -signal.SIGTERM)
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    assert proc.stderr
+    assert b"Application shutdown complete" in await proc.stderr.read()
+
+
+def test_poll(rm_mtlsclient: TestClient, mtlsclient: TestClient) -> None:
+    """Check long-polling user changes and who gets to see them"""
+    start = rm_mtlsclient.get("/api/v1/changes/poll", params={"timeout": "0"})
+    assert start.status_code == 200
+    last_event_id = start.json()["last_event_id"]
+    user = create_user_dict("harjoitus1.pvarki.fi")
+    other = create_user_dict("CHANGES01a")
+    for created in (user, other):
+        assert rm_mtlsclient.post("/api/v1/users/created", json=created).json()["success"]
+
+    # The events may show up in this worker one poll at a time
+    events: List[Dict[str, Any]] = []
+    after = last_event_id
+    while len(events) < 2:
+        page = rm_mtlsclient.get("/api/v1/changes/poll", params={"after": str(after), "timeout": "5"}).json()
+        assert not page["reset"] and page["events"]
+        events += page["events"]
+        after = page["last_event_id"]
+    assert [(event["kind"], event["data"]["callsign"]) for event in events] == [
+        ("user", user["callsign"]),
+        ("user", other["callsign"]),
+    ]
+    assert events[0]["data"]["event"] == "created"
+    assert page["last_event_id"] == events[-1]["id"]
+
+    # Plain users only see their own
+    page = mtlsclient.get("/api/v1/changes/poll", params={"after": str(last_event_id), "timeout": "0"}).json()
+    assert [event["data"]["uuid"] for event in page["events"]] == [user["uuid"]]
+
+    page = rm_mtlsclient.get("/api/v1/changes/poll", params={"after": str(page["last_event_id"]), "timeout": "0"})
+    assert page.json()["events"] == []
+    assert rm_mtlsclient.get("/api/v1/changes/poll", params={"timeout": "61"}).status_code == 422
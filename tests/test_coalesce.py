@@ -0,0 +1,102 @@
+"""Test coalescing lifecycle events"""
+
+import asyncio
+import logging
+
+import pytest
+
+from matrixrmapi.coalesce import EventCoalescer
+from matrixrmapi.provisioning import ProvisioningJob, ProvisioningQueue
+from matrixrmapi.stubhomeserver import StubHomeserver
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_merge() -> None:
+    """Check the net effect of job pairs"""
+    created = ProvisioningJob.from_event("created", "uuid1", "KOIRA01a")
+    promoted = ProvisioningJob.from_event("promoted", "uuid1", "KOIRA01a")
+    updated = ProvisioningJob.from_event("updated", "uuid1", "KOIRA02a")
+    revoked = ProvisioningJob.from_event("revoked", "uuid1", "KOIRA02a")
+
+    merged = created.merge(updated)
+    assert merged
+    merged = merged.merge(promoted)
+    assert merged
+    assert merged.create
+    assert merged.admin
+    assert merged.callsign == "KOIRA01a"
+    assert merged.merge(revoked) is None
+
+    merged = promoted.merge(revoked)
+    assert merged
+    assert merged.deactivate
+    assert merged.admin is None
+    merged = merged.merge(created)
+    assert merged
+    assert merged.create
+    assert not merged.deactivate
+
+
+@pytest.mark.asyncio
+async def test_burst() -> None:
+    """Check that a burst becomes one call per user"""
+    stub = StubHomeserver()
+    url = await stub.start()
+    queue = ProvisioningQueue(url, server_name="example.com")
+    coalescer = EventCoalescer(queue, window=0.05)
+    await queue.start()
+    try:
+        for idx in range(20):
+            uuid = f"uuid{idx}"
+            for event in ("created", "updated", "promoted"):
+                assert coalescer.submit(ProvisioningJob.from_event(event, uuid, f"KOIRA{idx}"))
+        for event in ("created", "revoked"):
+            assert coalescer.submit(ProvisioningJob.from_event(event, "shortlived", "KISSA"))
+        assert coalescer.pending == 20
+        await asyncio.sleep(0.1)
+        assert coalescer.pending == 0
+        await queue.join()
+    finally:
+        await queue.stop()
+        await stub.stop()
+    assert coalescer.received == 62
+    assert coalescer.emitted == 20
+    assert stub.requests == 20
+    assert "@shortlived:example.com" not in stub.users
+    assert stub.users["@uuid3:example.com"]["admin"]
+
+
+@pytest.mark.asyncio
+async def test_flush_all() -> None:
+    """Check that flushing on shutdown emits right away"""
+    queue = ProvisioningQueue("http://127.0.0.1:9", server_name="example.com", drain_timeout=0)
+    coalescer = EventCoalescer(queue, window=60)
+    await queue.start()
+    try:
+        assert coalescer.submit(ProvisioningJob.from_event("created", "uuid1", "KOIRA01a"))
+        assert coalescer.flush_all() == 0
+        assert coalescer.pending == 0
+        assert coalescer.emitted == 1
+    finally:
+        await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_queue_full() -> None:
+    """Check that changes are kept while the queue is full and counted if dropped on shutdown"""
+    queue = ProvisioningQueue("http://127.0.0.1:9", server_name="example.com", workers=1, maxsize=1, drain_timeout=0)
+    coalescer = EventCoalescer(queue, window=0.01)
+    await queue.start()
+    try:
+        for idx in range(3):
+            assert coalescer.submit(ProvisioningJob.from_event("created", f"uuid{idx}", "KOIRA01a"))
+        await asyncio.sleep(0.05)
+        # The worker holds one job retrying it, one fits in the queue and the last waits
+        assert coalescer.emitted == 2
+        assert coalescer.pending == 1
+        await coalescer.close(0.05)
+        assert coalescer.pending == 0
+        assert coalescer.dropped == 1
+    finally:
+        await queue.stop()
@@ -0,0 +1,108 @@
+"""Test response compression"""
+
+from typing import Dict
+import gzip
+import logging
+
+import brotli  # type: ignore[import-untyped]
+import pytest
+from fastapi.testclient import TestClient
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+from matrixrmapi.compression import (
+    CompressionCache,
+    CompressionMiddleware,
+    get_compression_cache,
+    negotiate_encoding,
+    weak_etag,
+)
+from matrixrmapi.httpcache import bytes_response
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.mark.parametrize(
+    "header,expected",
+    [
+        ("", None),
+        ("identity", None),
+        ("gzip", "gzip"),
+        ("gzip, deflate, br", "br"),
+        ("br;q=0.5, gzip", "gzip"),
+        ("br;q=0, gzip;q=0", None),
+        ("*", "br"),
+        ("*;q=0.1, gzip;q=0.2", "gzip"),
+        ("gzip;q=bogus", None),
+        ("gzip; q=0, br ; q=0.5", "br"),
+        ("gzip;level=1;q=0", None),
+    ],
+)
+def test_negotiate(header: str, expected: str) -> None:
+    """Check Accept-Encoding parsing"""
+    assert negotiate_encoding(header) == expected
+
+
+@pytest.mark.asyncio
+async def test_cache() -> None:
+    """Check that the same ETag is compressed only once and that the cache is bounded"""
+    cache = CompressionCache(max_bytes=100, thread_size=4000)
+    data = b"koira " * 1000  # Compressed in a thread
+    first = await cache.get('"a"', "gzip", data)
+    assert gzip.decompress(first) == data
+    assert await cache.get('"a"', "gzip", data) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert brotli.decompress(await cache.get('"a"', "br", data)) == data
+    await cache.get('"b"', "gzip", b"kissa " * 100)
+    assert cache.total_bytes <= 100
+    assert weak_etag('"a"') == 'W/"a"'
+    assert weak_etag('W/"a"') == 'W/"a"'
+
+
+def test_fragment(norppa11: Dict[str, str], mtlsclient: TestClient) -> None:
+    """Check that JSON gets compressed and that clients that don't ask get identity"""
+    resp = mtlsclient.post("/api/v1/clients/fragment", json=norppa11, headers={"Accept-Encoding": "br"})
+    assert resp.status_code == 200
+    assert resp.headers["content-encoding"] == "br"
+    assert "accept-encoding" in resp.headers["vary"].lower()
+    compressed = resp.json()
+    etag = resp.headers["etag"]
+    hits = get_compression_cache().hits
+    resp = mtlsclient.post("/api/v1/clients/fragment", json=norppa11, headers={"Accept-Encoding": "br"})
+    assert resp.headers["etag"] == etag
+    assert get_compression_cache().hits == hits + 1
+    resp = mtlsclient.post("/api/v1/clients/fragment?inline=false", json=norppa11, headers={"Accept-Encoding": "br"})
+    assert resp.headers["etag"] != etag
+
+    resp = mtlsclient.post("/api/v1/clients/fragment", json=norppa11, headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in resp.headers
+    assert resp.json() == compressed
+
+
+def test_etag_variants(mtlsclient: TestClient) -> None:
+    """Check that compressed variants get weak ETags that still give 304s"""
+    resp = mtlsclient.get("/api/nope", headers={"Accept-Encoding": "gzip"})
+    assert resp.status_code == 404
+    assert "content-encoding" not in resp.headers  # Too small to bother
+
+    data = b"koira " * 1000
+
+    async def endpoint(request: Request) -> Response:
+        return bytes_response(request, data, '"koira"', media_type="text/plain", ranges=True)
+
+    app = CompressionMiddleware(Starlette(routes=[Route("/", endpoint)]))
+    with TestClient(app) as client:
+        resp = client.get("/", headers={"Accept-Encoding": "gzip"})
+        assert resp.headers["content-encoding"] == "gzip"
+        assert resp.headers["etag"] == 'W/"koira"'
+        assert resp.content == data
+        hits = app.cache.hits
+        assert client.get("/", headers={"Accept-Encoding": "gzip"}).content == data
+        assert app.cache.hits == hits + 1
+        resp = client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": resp.headers["etag"]})
+        assert resp.status_code == 304
+        resp = client.get("/", headers={"Accept-Encoding": "gzip", "Range": "bytes=0-9"})
+        assert resp.status_code == 206
+        assert "content-encoding" not in resp.headers
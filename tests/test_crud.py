@@ -1,10 +1,20 @@
 """Test the CRUD operations"""
 
-from typing import Dict
+from typing import Any, Dict, List
 import logging
+import json
+import asyncio
+import sqlite3
+import tempfile
+
+import pytest
 from fastapi.testclient import TestClient
 
-from .conftest import APP
+from matrixrmapi.api import usercrud
+from matrixrmapi.certs import get_certificate_service
+from matrixrmapi.coalesce import get_coalescer
+from matrixrmapi.registry import get_registry
+from .conftest import APP, create_user_dict
 
 LOGGER = logging.getLogger(__name__)
 
@@ -62,3 +72,194 @@ def test_demote(norppa11: Dict[str, str], rm_mtlsclient: TestClient) -> None:
     payload = resp.json()
     assert "success" in payload
     assert payload["success"]
+
+
+def test_batch(rm_mtlsclient: TestClient) -> None:
+    """Check that batch applies events in order and reports per item"""
+    user = create_user_dict("BATCH01a")
+    lines = [
+        json.dumps({"event": "created", "user": user}),
+        json.dumps({"event": "promoted", "user": user}),
+        "{not json",
+        json.dumps({"event": "exploded", "user": user}),
+        json.dumps({"event": "revoked", "user": user}),
+    ]
+    resp = rm_mtlsclient.post(
+        "/api/v1/users/batch",
+        content="\n".join(lines).encode("utf-8"),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert resp.status_code == 200
+    assert resp.headers["X-Batch-Total"] == "5"
+    assert resp.headers["X-Batch-Failed"] == "2"
+    results = [json.loads(line) for line in resp.text.splitlines()]
+    assert [result["index"] for result in results] == [0, 1, 2, 3, 4]
+    assert [result["success"] for result in results] == [True, True, False, False, True]
+    assert results[1]["event"] == "promoted"
+    assert results[4]["uuid"] == user["uuid"]
+    record = asyncio.run(get_registry().get_by_uuid(user["uuid"]))
+    assert record
+    assert record.revoked
+    assert record.admin
+
+
+def test_backlog_full(rm_mtlsclient: TestClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Check that nothing is stored when provisioning can't take the events"""
+    monkeypatch.setattr(get_coalescer(), "has_room", lambda uuids: False)
+    user = create_user_dict("BACKLOG01a")
+    payload = rm_mtlsclient.post("/api/v1/users/created", json=user).json()
+    assert not payload["success"]
+    assert "backlog" in payload["error"]
+    assert not asyncio.run(get_registry().get_by_uuid(user["uuid"]))
+
+
+def test_batch_blank_lines(rm_mtlsclient: TestClient) -> None:
+    """Check that blank lines are counted so results map back to the input lines"""
+    user = create_user_dict("BATCH02a")
+    body = "\n".join(["", json.dumps({"event": "created", "user": user}), "  ", "{not json", ""])
+    resp = rm_mtlsclient.post(
+        "/api/v1/users/batch", content=body.encode("utf-8"), headers={"Content-Type": "application/x-ndjson"}
+    )
+    assert resp.status_code == 200
+    results = [json.loads(line) for line in resp.text.splitlines()]
+    assert [(result["index"], result["success"]) for result in results] == [(1, True), (3, False)]
+
+
+def test_batch_failure_closes_spool(rm_mtlsclient: TestClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Check that the result spool is closed when applying fails partway"""
+    spools: List[Any] = []
+    spooled = tempfile.SpooledTemporaryFile
+
+    def recording_spool(**kwargs: Any) -> Any:
+        spools.append(spooled(**kwargs))  # pylint: disable=consider-using-with
+        return spools[-1]
+
+    async def broken(chunk: Any) -> Any:
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(tempfile, "SpooledTemporaryFile", recording_spool)
+    monkeypatch.setattr(usercrud, "_apply_chunk", broken)
+    user = create_user_dict("BATCH03a")
+    with pytest.raises(sqlite3.OperationalError):
+        rm_mtlsclient.post("/api/v1/users/batch", content=json.dumps({"event": "created", "user": user}).encode())
+    assert len(spools) == 1 and spools[0].closed
+
+
+def test_batch_wrongcaller(mtlsclient: TestClient) -> None:
+    """Check that batch is only for RASENMAEHER"""
+    resp = mtlsclient.post("/api/v1/users/batch", content=b"")
+    assert resp.status_code == 403
+
+
+def test_replay(rm_mtlsclient: TestClient) -> None:
+    """Check that retries are answered from the replay cache"""
+    user = create_user_dict("REPLAY01a")
+    resp = rm_mtlsclient.post("/api/v1/users/created", json=user, headers={"Idempotency-Key": "create-1"})
+    assert resp.status_code == 200
+    assert "Idempotent-Replayed" not in resp.headers
+    resp = rm_mtlsclient.post("/api/v1/users/created", json=user, headers={"Idempotency-Key": "create-1"})
+    assert resp.status_code == 200
+    assert resp.headers["Idempotent-Replayed"] == "true"
+    assert resp.json()["success"]
+
+
+def test_repeat_is_not_replay(rm_mtlsclient: TestClient) -> None:
+    """Check that the same event after another one is applied again"""
+    user = create_user_dict("REPLAY02a")
+    for path in ("promoted", "demoted", "promoted"):
+        resp = rm_mtlsclient.post(f"/api/v1/users/{path}", json=user)
+        assert resp.status_code == 200
+        assert "Idempotent-Replayed" not in resp.headers
+    resp = rm_mtlsclient.post("/api/v1/users/promoted", json=user)
+    assert resp.headers["Idempotent-Replayed"] == "true"
+    record = asyncio.run(get_registry().get_by_uuid(user["uuid"]))
+    assert record
+    assert record.admin
+
+
+def test_no_validation_unless_enforced(rm_mtlsclient: TestClient) -> None:
+    """Check that certificates are not parsed when invalid ones would not be rejected"""
+    service = get_certificate_service()
+    before = service.hits + service.misses
+    resp = rm_mtlsclient.post("/api/v1/users/created", json=create_user_dict("NOCERT1a"))
+    assert resp.json()["success"]
+    assert service.hits + service.misses == before
+
+
+def test_batch_clears_replay(rm_mtlsclient: TestClient) -> None:
+    """Check that a retry after the user was changed by a batch is applied again"""
+    user = create_user_dict("REPLAY03a")
+    headers = {"Idempotency-Key": "create-3"}
+    resp = rm_mtlsclient.post("/api/v1/users/created", json=user, headers=headers)
+    assert "Idempotent-Replayed" not in resp.headers
+    body = json.dumps({"event": "revoked", "user": user}) + "\n"
+    resp = rm_mtlsclient.post(
+        "/api/v1/users/batch", content=body.encode("utf-8"), headers={"Content-Type": "application/x-ndjson"}
+    )
+    assert resp.status_code == 200
+    resp = rm_mtlsclient.post("/api/v1/users/created", json=user, headers=headers)
+    assert resp.json()["success"]
+    assert "Idempotent-Replayed" not in resp.headers
+    record = asyncio.run(get_registry().get_by_uuid(user["uuid"]))
+    assert record
+    assert not record.revoked
+
+
+def test_reconcile(rm_mtlsclient: TestClient) -> None:
+    """Check that reconcile applies only the differences"""
+    keep = create_user_dict("RECON01a")
+    change = create_user_dict("RECON02a")
+    drop = create_user_dict("RECON03a")
+    for user in (keep, change, drop):
+        assert rm_mtlsclient.post("/api/v1/users/created", json=user).status_code == 200
+    new = create_user_dict("RECON04a")
+    # Other tests have created users too, include everyone still active so they are not revoked
+    states = asyncio.run(get_registry().states())
+    others = asyncio.run(
+        get_registry().get_many(
+            [
+                uuid
+                for uuid, state in states.items()
+                if not state[2] and uuid not in (keep["uuid"], change["uuid"], drop["uuid"])
+            ]
+        )
+    )
+    snapshot = [keep, {**change, "callsign": "RECON02b", "admin": True}, {**new, "admin": False}] + [
+        {"uuid": other.uuid, "callsign": other.callsign, "x509cert": other.x509cert} for other in others
+    ]
+    body = "\n".join(json.dumps(record) for record in snapshot).encode("utf-8")
+
+    resp = rm_mtlsclient.post("/api/v1/users/reconcile?dry_run=true", content=body)
+    assert resp.status_code == 200
+    payload = resp.json()
+    assert payload["dry_run"]
+    assert (payload["created"], payload["updated"], payload["promoted"], payload["revoked"]) == (1, 1, 1, 1)
+    assert not asyncio.run(get_registry().get_by_uuid(new["uuid"]))
+
+    resp = rm_mtlsclient.post("/api/v1/users/reconcile", content=body)
+    assert resp.status_code == 200
+    payload = resp.json()
+    assert payload["received"] == len(snapshot)
+    assert (payload["created"], payload["updated"], payload["promoted"], payload["revoked"]) == (1, 1, 1, 1)
+    assert payload["failed"] == 0
+    dropped = asyncio.run(get_registry().get_by_uuid(drop["uuid"]))
+    assert dropped and dropped.revoked
+    changed = asyncio.run(get_registry().get_by_uuid(change["uuid"]))
+    assert changed and changed.admin and changed.callsign == "RECON02b"
+
+    resp = rm_mtlsclient.post("/api/v1/users/reconcile", content=body)
+    payload = resp.json()
+    assert (payload["created"], payload["updated"], payload["promoted"], payload["revoked"]) == (0, 0, 0, 0)
+
+
+def test_reconcile_empty(rm_mtlsclient: TestClient) -> None:
+    """Check that an empty snapshot revokes no one unless that is explicitly allowed"""
+    user = create_user_dict("RECON05a")
+    assert rm_mtlsclient.post("/api/v1/users/created", json=user).status_code == 200
+    for body in (b"", b"\n \n\n"):
+        payload = rm_mtlsclient.post("/api/v1/users/reconcile", content=body).json()
+        assert (payload["received"], payload["revoked"]) == (0, 0)
+    payload = rm_mtlsclient.post("/api/v1/users/reconcile?dry_run=true&allow_empty=true", content=b"").json()
+    assert payload["revoked"] >= 1
+    kept = asyncio.run(get_registry().get_by_uuid(user["uuid"]))
+    assert kept and not kept.revoked
@@ -16,3 +16,29 @@ def test_get_description(mtlsclient: TestClient, lang: str) -> None:
     payload = resp.json()
     assert payload["shortname"] == "matrix"
     assert payload["language"] == lang
+
+
+@pytest.mark.parametrize("lang", ["en", "fi", "sv"])
+def test_get_v2_description(mtlsclient: TestClient, lang: str) -> None:
+    """Check getting the extended description and conditional requests"""
+    resp = mtlsclient.get(f"/api/v2/description/{lang}")
+    assert resp.status_code == 200
+    payload = resp.json()
+    assert payload["shortname"] == "matrix"
+    assert payload["language"] == lang
+    assert payload["component"]["type"] == "component"
+    assert resp.headers["content-language"] == lang
+    etag = resp.headers["etag"]
+    resp = mtlsclient.get(f"/api/v2/description/{lang}", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.headers["etag"] == etag
+
+
+def test_description_negotiation(mtlsclient: TestClient) -> None:
+    """Check Accept-Language negotiation for unknown languages"""
+    headers = {"Accept-Language": "de-DE,de;q=0.9,sv;q=0.8,fi;q=0.7"}
+    assert mtlsclient.get("/api/v2/description/de", headers=headers).json()["language"] == "sv"
+    assert mtlsclient.get("/api/v1/description/de", headers=headers).json()["language"] == "fi"
+    assert mtlsclient.get("/api/v2/description/de").json()["language"] == "en"
+    assert mtlsclient.get("/api/v1/description/de").status_code == 404
+    assert mtlsclient.get("/api/v2/description/fi-FI").json()["language"] == "fi"
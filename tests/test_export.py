@@ -0,0 +1,69 @@
+"""Test the admin user listing and export"""
+
+from typing import Dict, List
+import csv
+import io
+import json
+import logging
+
+from fastapi.testclient import TestClient
+
+from .conftest import create_user_dict
+
+LOGGER = logging.getLogger(__name__)
+
+
+def create_users(client: TestClient, count: int) -> List[Dict[str, str]]:
+    """Create users through the API, the first one is promoted and the last one revoked"""
+    users = [create_user_dict(f"EXPORT{idx:02d}a") for idx in range(count)]
+    for user in users:
+        assert client.post("/api/v1/users/created", json=user).json()["success"]
+    assert client.post("/api/v1/users/promoted", json=users[0]).json()["success"]
+    assert client.post("/api/v1/users/revoked", json=users[-1]).json()["success"]
+    return users
+
+
+def test_list_users(rm_mtlsclient: TestClient, mtlsclient: TestClient) -> None:
+    """Check paging through everyone with the cursor"""
+    users = create_users(rm_mtlsclient, 5)
+    seen: List[Dict[str, str]] = []
+    cursor = None
+    while True:
+        params = {"limit": "2", **({"cursor": cursor} if cursor else {})}
+        resp = rm_mtlsclient.get("/api/v1/admins/users", params=params)
+        assert resp.status_code == 200
+        page = resp.json()
+        assert len(page["users"]) <= 2
+        seen.extend(page["users"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    uuids = [user["uuid"] for user in seen]
+    assert uuids == sorted(set(uuids))
+    assert {user["uuid"] for user in users} <= set(uuids)
+
+    admins = rm_mtlsclient.get("/api/v1/admins/users", params={"state": "admin", "limit": "1000"}).json()
+    assert users[0]["uuid"] in {user["uuid"] for user in admins["users"]}
+    assert rm_mtlsclient.get("/api/v1/admins/users", params={"state": "nope"}).status_code == 422
+    assert mtlsclient.get("/api/v1/admins/users").status_code == 403
+
+
+def test_export(rm_mtlsclient: TestClient, mtlsclient: TestClient) -> None:
+    """Check both formats and the state filter"""
+    users = create_users(rm_mtlsclient, 3)
+    resp = rm_mtlsclient.get("/api/v1/admins/users/export", params={"state": "active"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "application/x-ndjson"
+    assert "users-active.ndjson" in resp.headers["content-disposition"]
+    records = {record["uuid"]: record for record in map(json.loads, resp.text.splitlines())}
+    assert records[users[0]["uuid"]]["admin"] is True
+    assert records[users[1]["uuid"]]["callsign"] == users[1]["callsign"]
+    assert users[-1]["uuid"] not in records
+
+    resp = rm_mtlsclient.get("/api/v1/admins/users/export", params={"state": "revoked", "format": "csv"})
+    assert resp.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(resp.text)))
+    assert users[-1]["uuid"] in {row["uuid"] for row in rows}
+    assert all(row["revoked"] == "true" for row in rows)
+
+    assert mtlsclient.get("/api/v1/admins/users/export").status_code == 403
@@ -8,7 +8,7 @@ from fastapi.testclient import TestClient
 import pytest
 
 from matrixrmapi.config import get_manifest
-from .conftest import APP
+from .conftest import APP, create_user_dict
 
 LOGGER = logging.getLogger(__name__)
 
@@ -60,3 +60,53 @@ def test_get_v2_user_markdown_wrongcaller(norppa11: Dict[str, str], mtlsclient:
     """Check that getting v2 user markdown fails if not coming from RASENMAEHER"""
     resp = mtlsclient.post(f"/api/v2/clients/{lang}/info.md", json=norppa11)
     assert resp.status_code == 403
+
+
+def test_download_bundle(rm_mtlsclient: TestClient, mtlsclient: TestClient) -> None:
+    """Check downloading the zips with conditional and range requests"""
+    user = create_user_dict("NORPPA12a")
+    assert rm_mtlsclient.post("/api/v1/users/created", json=user).json()["success"]
+    resp = rm_mtlsclient.post("/api/v1/clients/fragment", params={"inline": "false"}, json=user)
+    assert resp.status_code == 200
+    for fpl in resp.json():
+        assert fpl["data"] == fpl["url"]
+        assert fpl["url"].endswith(fpl["filename"])
+        resp = rm_mtlsclient.get(fpl["url"])
+        assert resp.status_code == 200
+        assert resp.headers["content-type"] == "application/zip"
+        assert fpl["filename"] in resp.headers["content-disposition"]
+        etag = resp.headers["etag"]
+        data = resp.content
+        assert data.startswith(b"PK")
+
+        resp = rm_mtlsclient.get(fpl["url"], headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert not resp.content
+        resp = rm_mtlsclient.get(fpl["url"], headers={"Range": "bytes=10-19"})
+        assert resp.status_code == 206
+        assert resp.content == data[10:20]
+        assert resp.headers["content-range"] == f"bytes 10-19/{len(data)}"
+        resp = rm_mtlsclient.get(fpl["url"], headers={"Range": f"bytes={len(data)}-"})
+        assert resp.status_code == 416
+
+        # Somebody else
+        assert mtlsclient.get(fpl["url"]).status_code == 403
+
+    assert rm_mtlsclient.get(f"/api/v1/clients/bundle/{user['uuid']}/nope.zip").status_code == 404
+    assert rm_mtlsclient.get("/api/v1/clients/bundle/nosuchuser/nope.zip").status_code == 404
+
+
+def test_get_html_fragment(rm_mtlsclient: TestClient) -> None:
+    """Check that the HTML fragment has the download links"""
+    user = create_user_dict("NORPPA13a")
+    resp = rm_mtlsclient.post("/api/v2/clients/fragment", json=user)
+    assert resp.status_code == 200
+    html = resp.json()["html"]
+    assert html.startswith("<p>Hello NORPPA13a!</p>")
+    assert f"/api/v1/clients/bundle/{user['uuid']}/NORPPA13a_1.zip" in html
+
+
+def test_html_fragment_wrongcaller(mtlsclient: TestClient) -> None:
+    """Check that the HTML fragment is only for RASENMAEHER"""
+    resp = mtlsclient.post("/api/v2/clients/fragment", json=create_user_dict("NORPPA14a"))
+    assert resp.status_code == 403
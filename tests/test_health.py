@@ -0,0 +1,55 @@
+"""Test the health monitor"""
+
+from typing import Optional
+import asyncio
+import logging
+
+import pytest
+
+from matrixrmapi.health import HealthMonitor
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.mark.asyncio
+async def test_verdict() -> None:
+    """Check that failing and slow probes make us unhealthy and the verdict is cached"""
+    monitor = HealthMonitor(interval=3600, timeout=0.1)
+    calls = {"ok": 0}
+    broken = {"value": False}
+
+    async def good() -> Optional[str]:
+        calls["ok"] += 1
+        return "fine"
+
+    async def flaky() -> Optional[str]:
+        if broken["value"]:
+            raise RuntimeError("broken")
+        return None
+
+    async def slow() -> Optional[str]:
+        await asyncio.sleep(1.0 if broken["value"] else 0)
+        return None
+
+    monitor.add_probe("good", good)
+    monitor.add_probe("flaky", flaky)
+    monitor.add_probe("slow", slow)
+    await monitor.start()
+    try:
+        assert monitor.response.healthy
+        assert monitor.verdict.components["good"].detail == "fine"
+        assert calls["ok"] == 1
+        # Reading the verdict does not run probes
+        assert monitor.response.healthy
+        assert calls["ok"] == 1
+
+        broken["value"] = True
+        verdict = await monitor.check()
+        assert not verdict.healthy
+        assert verdict.components["good"].healthy
+        assert "broken" in str(verdict.components["flaky"].error)
+        assert "Timed out" in str(verdict.components["slow"].error)
+        assert verdict.components["slow"].latency_ms >= 100
+        assert not monitor.response.healthy
+    finally:
+        await monitor.stop()
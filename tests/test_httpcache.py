@@ -0,0 +1,55 @@
+"""Test conditional and range request helpers"""
+
+from typing import Optional, Tuple
+import logging
+
+import pytest
+
+from matrixrmapi.httpcache import content_disposition, etag_matches, parse_range
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.mark.parametrize(
+    "header,expected",
+    [
+        (None, None),
+        ("bytes=0-9", (0, 9)),
+        ("bytes=90-", (90, 99)),
+        ("bytes=-10", (90, 99)),
+        ("bytes=-1000", (0, 99)),
+        ("bytes=50-1000", (50, 99)),
+        ("bytes=0-1,5-6", None),
+        ("bytes=x-y", None),
+        ("bytes=9-5", None),
+        ("bytes=105-3", None),
+        ("items=0-9", None),
+    ],
+)
+def test_parse_range(header: Optional[str], expected: Optional[Tuple[int, int]]) -> None:
+    """Check range parsing"""
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=100-", "bytes=100-200", "bytes=-0"])
+def test_unsatisfiable_range(header: str) -> None:
+    """Check ranges we can't serve"""
+    with pytest.raises(ValueError):
+        parse_range(header, 100)
+
+
+def test_etag_matches() -> None:
+    """Check If-None-Match handling"""
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('W/"abc", "def"', '"abc"')
+    assert etag_matches("*", '"abc"')
+    assert not etag_matches('"abcd"', '"abc"')
+    assert not etag_matches(None, '"abc"')
+
+
+def test_content_disposition() -> None:
+    """Check non-ascii filenames"""
+    assert content_disposition("NORPPA11a_1.zip") == (
+        "attachment; filename=\"NORPPA11a_1.zip\"; filename*=UTF-8''NORPPA11a_1.zip"
+    )
+    assert "filename*=UTF-8''%C3%84MP%C3%84.zip" in content_disposition("ÄMPÄ.zip")
@@ -0,0 +1,74 @@
+"""Test the replay cache"""
+
+from pathlib import Path
+import asyncio
+import logging
+
+import pytest
+from libpvarki.schemas.generic import OperationResultResponse
+
+from matrixrmapi.idempotency import ReplayCache
+from matrixrmapi.registry import UserRegistry
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.mark.asyncio
+async def test_latest_only(tmp_path: Path) -> None:
+    """Check that only the latest key per user is remembered and other changes forget it"""
+    registry = UserRegistry(tmp_path / "users.db")
+    cache = ReplayCache(registry)
+    change = ("created", "uuid1", "CALL01a", "cert")
+    try:
+        first = cache.entry("key1", OperationResultResponse(success=True, extra="first"))
+        assert await registry.apply([change], first) is None
+        cached = await cache.get("uuid1", "key1")
+        assert cached
+        assert cached.extra == "first"
+        assert await registry.apply([change], first)
+        await registry.apply([change], cache.entry("key2", OperationResultResponse(success=True)))
+        assert not await cache.get("uuid1", "key1")
+        assert await cache.get("uuid1", "key2")
+        assert not await cache.get("uuid2", "key2")
+        await registry.apply([("revoked", "uuid1", "CALL01a", "cert")])
+        assert not await cache.get("uuid1", "key2")
+        assert cache.hits == 2
+        assert cache.misses == 3
+    finally:
+        await registry.close()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_retries(tmp_path: Path) -> None:
+    """Check that of concurrent retries only one is applied"""
+    registry = UserRegistry(tmp_path / "users.db")
+    other = UserRegistry(tmp_path / "users.db")  # Like another worker
+    cache = ReplayCache(registry)
+    entry = cache.entry("key1", OperationResultResponse(success=True))
+    change = ("promoted", "uuid1", "CALL01a", "cert")
+    try:
+        stored = await asyncio.gather(*(reg.apply([change], entry) for reg in (registry, other, registry, other)))
+        assert stored.count(None) == 1
+        assert len(await registry.events_after(0)) == 1
+    finally:
+        await registry.close()
+        await other.close()
+
+
+@pytest.mark.asyncio
+async def test_expiry_and_budget(tmp_path: Path) -> None:
+    """Check that expired and over budget entries go away"""
+    registry = UserRegistry(tmp_path / "users.db")
+    expired = ReplayCache(registry, ttl=-1)
+    cache = ReplayCache(registry, max_bytes=2000)
+    result = OperationResultResponse(success=True)
+    try:
+        await registry.apply([("created", "uuid1", "CALL01a", "cert")], expired.entry("key1", result))
+        assert not await expired.get("uuid1", "key1")
+        for idx in range(200):
+            await registry.apply([("created", f"uuid{idx}", "CALL01a", "cert")], cache.entry("key", result))
+            await cache.recorded()
+        assert await cache.get("uuid199", "key")
+        assert not await cache.get("uuid0", "key")
+    finally:
+        await registry.close()
@@ -0,0 +1,23 @@
+"""Test the instructions endpoint"""
+
+from typing import Dict
+import logging
+
+import pytest
+from fastapi.testclient import TestClient
+
+from matrixrmapi.config import get_manifest
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.mark.parametrize("lang,expected", [("en", "en"), ("fi", "fi"), ("sv", "sv"), ("de", "en")])
+def test_get_instructions(norppa11: Dict[str, str], mtlsclient: TestClient, lang: str, expected: str) -> None:
+    """Check that instructions are localized"""
+    resp = mtlsclient.post(f"/api/v1/instructions/{lang}", json=norppa11)
+    assert resp.status_code == 200
+    payload = resp.json()
+    assert payload["callsign"] == norppa11["callsign"]
+    assert payload["language"] == expected
+    assert norppa11["callsign"] in payload["instructions"]
+    assert get_manifest()["deployment"] in payload["instructions"]
@@ -0,0 +1,93 @@
+"""Test manifest loading and reloading"""
+
+from typing import Any, Dict, List
+from pathlib import Path
+import asyncio
+import copy
+import json
+import logging
+
+import pytest
+
+from matrixrmapi.manifest import DEFAULT_MANIFEST, ManifestProvider, validate_manifest
+
+LOGGER = logging.getLogger(__name__)
+
+
+def write_manifest(path: Path, certcn: str) -> None:
+    """Write manifest with given RM CN atomically like deployment tools do"""
+    manifest = copy.deepcopy(DEFAULT_MANIFEST)
+    manifest["rasenmaeher"]["certcn"] = certcn
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest))
+    tmp.replace(path)
+
+
+async def wait_for(seen: List[Dict[str, Any]], count: int) -> None:
+    """Wait for the subscriber to be called"""
+    for _ in range(100):
+        if len(seen) >= count:
+            return
+        await asyncio.sleep(0.05)
+    raise TimeoutError(f"Got only {len(seen)} manifests")
+
+
+def test_validate() -> None:
+    """Check validation"""
+    assert validate_manifest(DEFAULT_MANIFEST) == DEFAULT_MANIFEST
+    broken = copy.deepcopy(DEFAULT_MANIFEST)
+    del broken["rasenmaeher"]["certcn"]
+    with pytest.raises(ValueError):
+        validate_manifest(broken)
+    with pytest.raises(ValueError):
+        validate_manifest([])
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("subdir", [False, True])
+async def test_reload(tmp_path: Path, subdir: bool) -> None:
+    """Check that changes are picked up, with inotify or polling if the directory does not exist yet"""
+    path = (tmp_path / "sub" if subdir else tmp_path) / "kraftwerk-init.json"
+    if not subdir:
+        write_manifest(path, "rm1")
+    provider = ManifestProvider(path, poll_interval=0.05)
+    seen: List[Dict[str, Any]] = []
+    provider.subscribe(seen.append)
+    await provider.start()
+    try:
+        assert provider.current["rasenmaeher"]["certcn"] == ("rasenmaeher" if subdir else "rm1")
+        await asyncio.sleep(0.1)  # Let the watcher start
+        path.parent.mkdir(exist_ok=True)
+        write_manifest(path, "rm2")
+        await wait_for(seen, 2)
+        assert provider.current["rasenmaeher"]["certcn"] == "rm2"
+
+        # Broken file keeps the old manifest
+        path.write_text("{broken")
+        for _ in range(100):
+            if provider.errors:
+                break
+            await asyncio.sleep(0.05)
+        assert provider.errors
+        assert provider.last_error
+        assert provider.current["rasenmaeher"]["certcn"] == "rm2"
+    finally:
+        await provider.stop()
+
+
+def test_cors_follows_manifest() -> None:
+    """Check that CORS uses the deployment domain and unsubscribes when the app stops"""
+    # pylint: disable=import-outside-toplevel,protected-access
+    from fastapi.testclient import TestClient
+
+    from matrixrmapi.app import get_app
+    from matrixrmapi.config import get_manifest_provider
+
+    provider = get_manifest_provider()
+    subscribers = len(provider._callbacks)
+    with TestClient(get_app()) as client:
+        origin = "https://mtls.localmaeher.dev.pvarki.fi:4439/"  # The pattern is made from base_uri as is
+        resp = client.options("/api/v1/healthcheck", headers={"Origin": origin, "Access-Control-Request-Method": "GET"})
+        assert resp.headers["Access-Control-Allow-Origin"] == origin
+        assert len(provider._callbacks) == subscribers + 1
+    assert len(provider._callbacks) == subscribers
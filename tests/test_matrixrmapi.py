@@ -1,5 +1,7 @@
 """Package level tests"""
 
+import json
+
 from fastapi.testclient import TestClient
 from matrixrmapi import __version__
 
@@ -15,3 +17,6 @@ def test_healthcheck(mtlsclient: TestClient) -> None:
     assert resp.status_code == 200
     payload = resp.json()
     assert payload["healthy"] is True
+    components = json.loads(payload["extra"])["components"]
+    assert set(components) == {"manifest", "registry", "homeserver", "queue", "event_loop"}
+    assert all(component["healthy"] for component in components.values())
@@ -0,0 +1,100 @@
+"""Test metrics collection and aggregation"""
+
+from pathlib import Path
+from types import SimpleNamespace
+import json
+import logging
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+from matrixrmapi import config, gunicorn_conf
+from matrixrmapi.metrics import MetricsStore, archive_worker, format_labels, snapshot_path
+
+LOGGER = logging.getLogger(__name__)
+DEAD_PID = 4194304  # Above the default pid_max
+
+
+def test_aggregate(tmp_path: Path) -> None:
+    """Check that other workers are merged and gauges of dead ones dropped"""
+    store = MetricsStore(tmp_path)
+    store.observe_request("GET", "/api/v1/healthcheck", 200, 0.003, 120)
+    store.observe_request("GET", "/api/v1/healthcheck", 200, 0.2, 120)
+    store.flush()
+    assert store.path.exists()
+    labels = format_labels(method="GET", route="/api/v1/healthcheck")
+    other = store.snapshot()
+    other["gauges"]["http_requests_in_flight"] = {"": 3}
+    (tmp_path / f"worker-{os.getppid()}.json").write_text(json.dumps(other))
+    (tmp_path / f"worker-{DEAD_PID}.json").write_text(
+        json.dumps({**other, "gauges": {"http_requests_in_flight": {"": 5}}})
+    )
+    (tmp_path / "worker-garbage.json").write_text("{")
+
+    text = store.render()
+    assert f'http_requests_total{{{labels},status="200"}} 6' in text
+    assert f'http_request_duration_seconds_bucket{{{labels},le="0.005"}} 3' in text
+    assert f'http_request_duration_seconds_bucket{{{labels},le="0.25"}} 6' in text
+    assert f"http_request_duration_seconds_count{{{labels}}} 6" in text
+    assert f"http_response_size_bytes_sum{{{labels}}} 720" in text
+    assert "http_requests_in_flight 3" in text
+    assert f'event_loop_lag_seconds{{pid="{os.getpid()}"}}' in text
+
+
+def test_endpoint(mtlsclient: TestClient) -> None:
+    """Check that the routes show up"""
+    assert mtlsclient.get("/api/v1/description/en").status_code == 200
+    assert mtlsclient.get("/api/nosuchthing").status_code == 404
+    resp = mtlsclient.get("/api/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'http_requests_total{method="GET",route="/api/v1/description/{language}",status="200"}' in resp.text
+    assert 'http_requests_total{method="GET",route="unmatched",status="404"}' in resp.text
+    assert "# TYPE http_request_duration_seconds histogram" in resp.text
+
+
+def test_gunicorn_hooks(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Check that the master starts from empty directories and archives the metrics of exited workers"""
+    monkeypatch.setattr(config, "METRICS_DIR", tmp_path / "metrics")
+    monkeypatch.setattr(config, "PROFILE_DIR", tmp_path / "profiles")
+    (tmp_path / "profiles").mkdir()
+    (tmp_path / "profiles" / "old.folded").touch()
+    server = SimpleNamespace(log=logging.getLogger("gunicorn"))
+    store = MetricsStore(config.METRICS_DIR)
+    store.flush()
+    gunicorn_conf.on_starting(server)
+    assert not store.path.exists()
+    assert not any(config.PROFILE_DIR.iterdir())
+
+    store.observe_request("GET", "/api/v1/healthcheck", 200, 0.003, 120)
+    labels = format_labels(method="GET", route="/api/v1/healthcheck")
+    dead = store.snapshot()
+    dead["gauges"]["http_requests_in_flight"] = {"": 5}
+    for pid in (DEAD_PID, DEAD_PID + 1):
+        snapshot_path(config.METRICS_DIR, pid).write_text(json.dumps(dead))
+    before = store.render()
+    assert f'http_requests_total{{{labels},status="200"}} 3' in before
+    gunicorn_conf.child_exit(server, SimpleNamespace(pid=DEAD_PID))
+    gunicorn_conf.child_exit(server, SimpleNamespace(pid=DEAD_PID + 1))
+    gunicorn_conf.child_exit(server, SimpleNamespace(pid=DEAD_PID + 2))  # Never flushed
+    assert not snapshot_path(config.METRICS_DIR, DEAD_PID).exists()
+    assert store.render() == before
+
+
+def test_archive_race(tmp_path: Path) -> None:
+    """Check that a worker is not counted twice when it is scraped between archiving and removing its snapshot"""
+    store = MetricsStore(tmp_path)
+    store.observe_request("GET", "/api/v1/healthcheck", 200, 0.003, 120)
+    labels = format_labels(method="GET", route="/api/v1/healthcheck")
+    path = snapshot_path(tmp_path, DEAD_PID)
+    path.write_text(json.dumps(store.snapshot()))
+    content = path.read_bytes()
+    mtime = path.stat().st_mtime_ns
+    archive_worker(tmp_path, DEAD_PID)
+    path.write_bytes(content)
+    os.utime(path, ns=(mtime, mtime))
+    assert f'http_requests_total{{{labels},status="200"}} 2' in store.render()
+    path.write_text(json.dumps(store.snapshot()))  # A new worker with the same pid
+    os.utime(path, ns=(mtime + 1, mtime + 1))
+    assert f'http_requests_total{{{labels},status="200"}} 3' in store.render()
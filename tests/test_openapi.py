@@ -17,3 +17,30 @@ def test_get_openapi_docs(mtlsclient: TestClient) -> None:
     """Check that getting openapi.json works"""
     resp = mtlsclient.get("/api/docs")
     assert resp.status_code == 200
+
+
+def test_openapi_precompressed(mtlsclient: TestClient) -> None:
+    """Check the compressed variants and ETags"""
+    plain = mtlsclient.get("/api/openapi.json", headers={"Accept-Encoding": "identity"})
+    assert plain.status_code == 200
+    assert "content-encoding" not in plain.headers
+    assert plain.json()["paths"]
+
+    resp = mtlsclient.get("/api/openapi.json", headers={"Accept-Encoding": "gzip"})
+    assert resp.status_code == 200
+    assert resp.headers["content-encoding"] == "gzip"
+    assert resp.headers["vary"] == "Accept-Encoding"
+    assert resp.json() == plain.json()
+    assert resp.headers["etag"] != plain.headers["etag"]
+
+    resp = mtlsclient.get(
+        "/api/openapi.json", headers={"Accept-Encoding": "gzip", "If-None-Match": resp.headers["etag"]}
+    )
+    assert resp.status_code == 304
+
+    resp = mtlsclient.get("/api/openapi.json", headers={"Accept-Encoding": "gzip;q=0"})
+    assert "content-encoding" not in resp.headers
+
+    resp = mtlsclient.get("/api/openapi.json", headers={"Accept-Encoding": "br, gzip"})
+    assert resp.headers["content-encoding"] == "br"
+    assert resp.json() == plain.json()
@@ -0,0 +1,84 @@
+"""Test request tracing and profiling"""
+
+import asyncio
+import logging
+import re
+
+import pytest
+from fastapi import APIRouter, Depends, FastAPI
+from fastapi.testclient import TestClient
+from libpvarki.schemas.product import UserCRUDRequest
+
+from matrixrmapi.auth import MTLSAuth
+from matrixrmapi.profiling import TracingMiddleware
+from matrixrmapi.serialization import ModelJSONResponse, ModelJSONRoute
+from matrixrmapi.tracing import Trace
+
+LOGGER = logging.getLogger(__name__)
+FOLDED_LINE = re.compile(r"^\S.* \d+$")
+
+
+def test_breakdown() -> None:
+    """Check the log format"""
+    trace = Trace(0.0)
+    trace.add("handler", 0.5)
+    trace.add("auth", 0.001)
+    trace.add("handler", 0.25)
+    assert trace.breakdown(1.0) == "auth=1.0ms handler=750.0ms other=249.0ms"
+
+
+def test_slow_request(caplog: pytest.LogCaptureFixture) -> None:
+    """Check that slow requests get logged with their spans"""
+    router = APIRouter(route_class=ModelJSONRoute, dependencies=[Depends(MTLSAuth(auto_error=True))])
+
+    @router.post("/slow")
+    async def slow(user: UserCRUDRequest) -> UserCRUDRequest:
+        await asyncio.sleep(0.02)
+        return user
+
+    app = FastAPI(default_response_class=ModelJSONResponse)
+    app.include_router(router)
+    app.add_middleware(TracingMiddleware, slow_threshold=0.01)
+    user = {"uuid": "koira", "callsign": "KOIRA01a", "x509cert": "cert"}
+    with caplog.at_level(logging.WARNING, logger="matrixrmapi.profiling"):
+        with TestClient(app, headers={"X-ClientCert-DN": "CN=KOIRA01a"}) as client:
+            assert client.post("/slow", json=user).json() == user
+    messages = [record.getMessage() for record in caplog.records if "Slow request" in record.getMessage()]
+    assert len(messages) == 1
+    assert messages[0].startswith("Slow request POST /slow 200 took ")
+    for span in ("body=", "auth=", "handler=", "serialize=", "send=", "other="):
+        assert span in messages[0]
+    handler = float(messages[0].split("handler=")[1].split("ms")[0])
+    assert handler >= 20.0
+
+
+def test_profile_request(rm_mtlsclient: TestClient, mtlsclient: TestClient) -> None:
+    """Check profiling a request with the header and fetching the result"""
+    resp = rm_mtlsclient.get("/api/v1/description/fi", headers={"X-Profile": "1"})
+    assert resp.status_code == 200
+    profile_id = resp.headers["x-profile-id"]
+    resp = rm_mtlsclient.get(f"/api/v1/admins/profiles/{profile_id}")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    assert all(FOLDED_LINE.match(line) for line in resp.text.splitlines())
+
+    assert rm_mtlsclient.get("/api/v1/admins/profiles/0123456789abcdef").status_code == 404
+    assert rm_mtlsclient.get("/api/v1/admins/profiles/..%2Fkoira").status_code == 404
+    # Only admins
+    resp = mtlsclient.get("/api/v1/description/fi", headers={"X-Profile": "1"})
+    assert resp.status_code == 200
+    assert "x-profile-id" not in resp.headers
+    assert mtlsclient.get(f"/api/v1/admins/profiles/{profile_id}").status_code == 403
+
+
+def test_profile_window(rm_mtlsclient: TestClient, mtlsclient: TestClient) -> None:
+    """Check profiling the worker for a while"""
+    resp = rm_mtlsclient.post("/api/v1/admins/profiles", params={"seconds": "0.1"})
+    assert resp.status_code == 200
+    lines = resp.text.splitlines()
+    assert lines
+    assert all(FOLDED_LINE.match(line) for line in lines)
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) > 1
+    assert rm_mtlsclient.get(f"/api/v1/admins/profiles/{resp.headers['x-profile-id']}").text == resp.text
+    assert rm_mtlsclient.post("/api/v1/admins/profiles", params={"seconds": "3600"}).status_code == 422
+    assert mtlsclient.post("/api/v1/admins/profiles", params={"seconds": "0.1"}).status_code == 403
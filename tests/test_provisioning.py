@@ -0,0 +1,93 @@
+"""Test homeserver provisioning against the stub"""
+
+from typing import AsyncGenerator, Tuple
+import logging
+
+import pytest
+import pytest_asyncio
+
+from matrixrmapi.provisioning import ProvisioningJob, ProvisioningQueue
+from matrixrmapi.stubhomeserver import StubHomeserver
+
+LOGGER = logging.getLogger(__name__)
+ADMIN_TOKEN = "sekrit"  # pragma: allowlist secret
+
+
+@pytest_asyncio.fixture(name="stub_homeserver")
+async def fixture_stub_homeserver() -> AsyncGenerator[Tuple[StubHomeserver, str], None]:
+    """Running stub homeserver and its url"""
+    stub = StubHomeserver(admin_token=ADMIN_TOKEN)
+    url = await stub.start()
+    yield stub, url
+    await stub.stop()
+
+
+@pytest.mark.asyncio
+async def test_provision(stub_homeserver: Tuple[StubHomeserver, str]) -> None:
+    """Check that jobs end up on the homeserver in order"""
+    stub, url = stub_homeserver
+    queue = ProvisioningQueue(url, admin_token=ADMIN_TOKEN, server_name="example.com")
+    await queue.start()
+    try:
+        for event in ("created", "promoted", "updated", "demoted", "revoked"):
+            assert queue.submit(ProvisioningJob.from_event(event, "UUID1", f"KOIRA{event}"))
+        assert queue.submit(ProvisioningJob.from_event("created", "uuid2", "KISSA01a"))
+        await queue.join()
+    finally:
+        await queue.stop()
+    assert stub.users["@uuid1:example.com"] == {
+        "name": "@uuid1:example.com",
+        "displayname": "KOIRArevoked",
+        "admin": False,
+        "deactivated": True,
+    }
+    assert not stub.users["@uuid2:example.com"]["deactivated"]
+
+
+@pytest.mark.asyncio
+async def test_drain_on_stop(stub_homeserver: Tuple[StubHomeserver, str]) -> None:
+    """Check that stopping finishes the queued jobs first"""
+    stub, url = stub_homeserver
+    queue = ProvisioningQueue(url, admin_token=ADMIN_TOKEN, server_name="example.com", drain_timeout=5)
+    await queue.start()
+    for idx in range(10):
+        assert queue.submit(ProvisioningJob.from_event("created", f"uuid{idx}", "KOIRA01a"))
+    await queue.stop()
+    assert len(stub.users) == 10
+
+
+@pytest.mark.asyncio
+async def test_retry(stub_homeserver: Tuple[StubHomeserver, str]) -> None:
+    """Check that temporary failures are retried"""
+    stub, url = stub_homeserver
+    stub.fail_first = 2
+    queue = ProvisioningQueue(url, admin_token=ADMIN_TOKEN, server_name="example.com", backoff=0.01)
+    await queue.start()
+    try:
+        assert queue.submit(ProvisioningJob.from_event("promoted", "uuid1", "KOIRA01a"))
+        await queue.join()
+    finally:
+        await queue.stop()
+    assert stub.requests == 3
+    assert stub.users["@uuid1:example.com"]["admin"]
+
+
+@pytest.mark.asyncio
+async def test_queue_full() -> None:
+    """Check that full queue does not block"""
+    queue = ProvisioningQueue("http://127.0.0.1:9", server_name="example.com", workers=1, maxsize=1, drain_timeout=0)
+    await queue.start()
+    try:
+        assert queue.has_room(["uuid0"])
+        assert not queue.has_room(["uuid0", "uuid1"])
+        results = [queue.submit(ProvisioningJob.from_event("created", f"uuid{idx}", "KOIRA")) for idx in range(5)]
+        assert not queue.has_room(["uuid0"])
+    finally:
+        await queue.stop()
+    assert not all(results)
+
+
+def test_disabled() -> None:
+    """Check that without homeserver everything is accepted"""
+    queue = ProvisioningQueue("")
+    assert queue.submit(ProvisioningJob.from_event("created", "uuid1", "KOIRA01a"))
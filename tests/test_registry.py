@@ -0,0 +1,101 @@
+"""Test the user registry"""
+
+from pathlib import Path
+import json
+import logging
+
+import pytest
+
+from matrixrmapi.registry import UserRegistry
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.mark.asyncio
+async def test_lifecycle(tmp_path: Path) -> None:
+    """Check that the events change state as expected"""
+    registry = UserRegistry(tmp_path / "sub" / "users.db")
+    try:
+        await registry.apply(
+            [
+                ("created", "uuid1", "KOIRA01a", "cert1"),
+                ("created", "uuid2", "KISSA01a", "cert2"),
+                ("promoted", "uuid1", "KOIRA01a", "cert1"),
+                ("updated", "uuid2", "KISSA02a", "cert2"),
+                ("revoked", "uuid2", "KISSA02a", "cert2"),
+            ]
+        )
+        koira = await registry.get_by_uuid("uuid1")
+        assert koira
+        assert koira.admin
+        assert not koira.revoked
+        kissa = await registry.get_by_callsign("KISSA02a")
+        assert kissa
+        assert kissa.uuid == "uuid2"
+        assert kissa.revoked
+        assert not await registry.get_by_callsign("KISSA01a")
+        assert await registry.counts() == {"total": 2, "active": 1, "admin": 1, "revoked": 1}
+
+        await registry.apply([("demoted", "uuid1", "KOIRA01a", "cert1"), ("created", "uuid2", "KISSA02a", "cert3")])
+        koira = await registry.get_by_uuid("uuid1")
+        assert koira and not koira.admin
+        kissa = await registry.get_by_uuid("uuid2")
+        assert kissa and not kissa.revoked
+        assert kissa.x509cert == "cert3"
+    finally:
+        await registry.close()
+
+
+@pytest.mark.asyncio
+async def test_shared(tmp_path: Path) -> None:
+    """Check that separate registries on same file see each others changes"""
+    writer = UserRegistry(tmp_path / "users.db")
+    reader = UserRegistry(tmp_path / "users.db")
+    try:
+        await reader.open()
+        await writer.apply([("created", "uuid1", "KOIRA01a", "cert1")])
+        assert await reader.get_by_uuid("uuid1")
+        assert not await reader.get_by_uuid("uuid2")
+    finally:
+        await writer.close()
+        await reader.close()
+
+
+@pytest.mark.asyncio
+async def test_pages(tmp_path: Path) -> None:
+    """Check keyset pagination and state filters"""
+    registry = UserRegistry(tmp_path / "users.db")
+    try:
+        await registry.apply([("created", f"uuid{idx}", f"KOIRA{idx}", "cert") for idx in range(7)])
+        await registry.apply([("promoted", "uuid1", "KOIRA1", "cert"), ("revoked", "uuid2", "KOIRA2", "cert")])
+        page = await registry.page(limit=3)
+        assert [user.uuid for user in page] == ["uuid0", "uuid1", "uuid2"]
+        page = await registry.page(after="uuid2", limit=3)
+        assert [user.uuid for user in page] == ["uuid3", "uuid4", "uuid5"]
+        assert [user.uuid for user in await registry.page("admin")] == ["uuid1"]
+        assert [user.uuid for user in await registry.page("revoked")] == ["uuid2"]
+        pages = [[user.uuid for user in users] async for users in registry.iter_pages("active", page_size=3)]
+        assert pages == [["uuid0", "uuid1", "uuid3"], ["uuid4", "uuid5", "uuid6"]]
+    finally:
+        await registry.close()
+
+
+@pytest.mark.asyncio
+async def test_events(tmp_path: Path) -> None:
+    """Check the change log, its retention and deduplication"""
+    registry = UserRegistry(tmp_path / "users.db", events_retention=3)
+    try:
+        assert await registry.last_event_id() == 0
+        await registry.apply([("created", f"uuid{idx}", f"KOIRA{idx}", "cert") for idx in range(5)])
+        events = await registry.events_after(0)
+        assert [event[0] for event in events] == [3, 4, 5]
+        assert events[-1][1:3] == ("user", "KOIRA4")
+        assert json.loads(events[-1][3]) == {"event": "created", "uuid": "uuid4", "callsign": "KOIRA4"}
+        await registry.add_event("manifest", '{"digest": "a"}')
+        await registry.add_event("manifest", '{"digest": "a"}')
+        assert await registry.last_event_id() == 6
+        await registry.add_event("manifest", '{"digest": "b"}')
+        events = await registry.events_after(5)
+        assert [(event[0], event[1], event[2]) for event in events] == [(6, "manifest", None), (7, "manifest", None)]
+    finally:
+        await registry.close()
@@ -0,0 +1,63 @@
+"""Test the template engine"""
+
+from pathlib import Path
+import logging
+import os
+
+import pytest
+
+from matrixrmapi.rendering import TemplateEngine
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_render(tmp_path: Path) -> None:
+    """Check rendering, memoization and reloading"""
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "static.html").write_text("<p>Static</p>")
+    (templates / "hello.html").write_text("<p>Hello {{ callsign }}!</p>")
+    (templates / "hello.md").write_text("Hello {{ callsign }}!")
+    engine = TemplateEngine(templates, tmp_path / "cache", check_interval=0)
+    engine.warm()
+    assert list((tmp_path / "cache").iterdir())
+
+    assert engine.render("hello.html", callsign="<b>") == "<p>Hello &lt;b&gt;!</p>"
+    assert engine.render("hello.md", callsign="<b>") == "Hello <b>!"
+    first = engine.render("static.html")
+    assert first == "<p>Static</p>"
+    assert engine.render("static.html") is first
+    assert engine.exists("static.html")
+    assert not engine.exists("nope.html")
+
+    path = templates / "static.html"
+    path.write_text("<p>Changed</p>")
+    stat = path.stat()
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    assert engine.render("static.html") == "<p>Changed</p>"
+
+    # Another worker gets the same template from the bytecode cache
+    other = TemplateEngine(templates, tmp_path / "cache")
+    assert other.render("hello.html", callsign="KOIRA") == "<p>Hello KOIRA!</p>"
+
+
+def test_check_interval(tmp_path: Path) -> None:
+    """Check that files are not checked on every render"""
+    (tmp_path / "static.html").write_text("<p>Static</p>")
+    engine = TemplateEngine(tmp_path, tmp_path / "cache", check_interval=3600)
+    assert engine.render("static.html") == "<p>Static</p>"
+    (tmp_path / "static.html").write_text("<p>Changed</p>")
+    assert engine.render("static.html") == "<p>Static</p>"
+
+
+def test_cache_directory(tmp_path: Path) -> None:
+    """Check that the bytecode cache is private and a directory others can write to is refused"""
+    (tmp_path / "static.html").write_text("<p>Static</p>")
+    TemplateEngine(tmp_path, tmp_path / "cache").warm()
+    assert (tmp_path / "cache").stat().st_mode & 0o777 == 0o700
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    shared.chmod(0o777)
+    with pytest.raises(RuntimeError):
+        TemplateEngine(tmp_path, shared)
+    assert TemplateEngine(tmp_path).render("static.html") == "<p>Static</p>"  # Jinja's own per-user directory
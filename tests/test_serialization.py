@@ -0,0 +1,123 @@
+"""Test the single pass JSON serialization"""
+
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+
+import pytest
+from fastapi import APIRouter, FastAPI, Response
+from fastapi.exceptions import ResponseValidationError
+from fastapi.routing import APIRoute, serialize_response
+from fastapi.testclient import TestClient
+from pydantic import BaseModel
+
+from matrixrmapi.serialization import ModelJSONResponse, ModelJSONRoute, SerializingField
+from .conftest import APP
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Item(BaseModel):
+    """Declared response model"""
+
+    name: str
+    note: Optional[str] = None
+
+
+class SecretItem(Item):
+    """Has a field that must not end up in the response"""
+
+    secret: str
+
+
+def make_app() -> FastAPI:
+    """Small app using the route class"""
+    router = APIRouter(route_class=ModelJSONRoute)
+
+    @router.get("/item")
+    async def get_item(response: Response) -> Item:
+        response.headers["X-Test"] = "yes"
+        response.status_code = 201
+        return SecretItem(name="koira", secret="hunter2")  # pragma: allowlist secret
+
+    @router.get("/items", response_model_exclude_none=True)
+    async def get_items() -> List[Item]:
+        return [Item(name="koira"), Item(name="kissa", note="miau")]
+
+    @router.get("/dicts")
+    async def get_dicts(bad: bool = False) -> List[Dict[str, str]]:
+        return [{"name": 1}] if bad else [{"name": "koira"}]  # type: ignore[dict-item]
+
+    app = FastAPI(default_response_class=ModelJSONResponse)
+    app.include_router(router)
+    return app
+
+
+def test_response() -> None:
+    """Check that the output matches what FastAPI would send"""
+    with TestClient(make_app()) as client:
+        resp = client.get("/item")
+        assert resp.status_code == 201
+        assert resp.headers["x-test"] == "yes"
+        assert resp.headers["content-type"] == "application/json"
+        assert resp.json() == {"name": "koira", "note": None}
+
+        resp = client.get("/items")
+        assert resp.content == b'[{"name":"koira"},{"name":"kissa","note":"miau"}]'
+
+        assert client.get("/dicts").json() == [{"name": "koira"}]
+        with pytest.raises(ResponseValidationError):
+            client.get("/dicts", params={"bad": "true"})
+
+
+def test_app_routes() -> None:
+    """Check that every JSON API route got the fast path"""
+    routes = [route for route in APP.routes if isinstance(route, APIRoute) and route.response_field is not None]
+    assert routes
+    for route in routes:
+        assert isinstance(route, ModelJSONRoute)
+        if route.response_class is ModelJSONResponse:
+            assert isinstance(route.secure_cloned_response_field, SerializingField)
+    assert sum(1 for route in routes if route.response_class is ModelJSONResponse) > 10
+
+
+class RecordingField(SerializingField):
+    """Remembers how FastAPI calls it"""
+
+    calls: List[Tuple[str, Tuple[Any, ...], Dict[str, Any]]] = []
+
+    def validate(self, value: Any, values: Dict[str, Any], *, loc: Tuple[Any, ...] = ()) -> Tuple[Any, Any]:
+        self.calls.append(("validate", (value, values), {"loc": loc}))
+        return super().validate(value, values, loc=loc)
+
+    def serialize(self, value: Any, **kwargs: Any) -> bytes:
+        self.calls.append(("serialize", (value,), kwargs))
+        return super().serialize(value, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_fastapi_contract() -> None:
+    """Fails if FastAPI changes how serialize_response uses the field or where the route keeps it, which
+    ModelJSONRoute relies on"""
+    app = make_app()
+    route = next(route for route in app.routes if isinstance(route, APIRoute) and route.path == "/items")
+    # The app default response class is a DefaultPlaceholder on the route
+    assert isinstance(route.secure_cloned_response_field, SerializingField)
+    field = RecordingField(route.secure_cloned_response_field.field, route.response_model)
+    items = [Item(name="koira")]
+    result = await serialize_response(field=field, response_content=items, exclude_none=True)
+    assert result == b'[{"name":"koira"}]'
+    assert field.calls == [
+        ("validate", (items, {}), {"loc": ("response",)}),
+        (
+            "serialize",
+            (items,),
+            {
+                "include": None,
+                "exclude": None,
+                "by_alias": True,
+                "exclude_unset": False,
+                "exclude_defaults": False,
+                "exclude_none": True,
+            },
+        ),
+    ]
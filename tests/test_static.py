@@ -0,0 +1,87 @@
+"""Test serving the UI files"""
+
+from pathlib import Path
+import gzip
+import logging
+
+from fastapi.testclient import TestClient
+from starlette.applications import Starlette
+from starlette.routing import Route
+
+from matrixrmapi.static import CACHE_IMMUTABLE, CACHE_REVALIDATE, AssetIndex, precompress
+
+LOGGER = logging.getLogger(__name__)
+SCRIPT = b"export const koira = 'hau';\n" * 100
+
+
+def make_client(root: Path) -> TestClient:
+    """Index the directory and serve it"""
+    index = AssetIndex(root)
+    index.build()
+    return TestClient(Starlette(routes=[Route("/ui/matrix/{path:path}", index.endpoint)]))
+
+
+def test_index(tmp_path: Path) -> None:
+    """Check what gets indexed and how"""
+    (tmp_path / "assets").mkdir()
+    (tmp_path / "remoteEntry.js").write_bytes(SCRIPT)
+    (tmp_path / "assets" / "index-BQw3Yc_2.js").write_bytes(SCRIPT)
+    (tmp_path / "assets" / "matrix-integration.js").write_bytes(SCRIPT)
+    (tmp_path / "remoteEntry.js").chmod(0o644)
+    assert precompress(tmp_path) in (2 * 3, 3)  # Without brotli there is just gzip
+    assert precompress(tmp_path) == 0
+    assert (tmp_path / "remoteEntry.js.gz").stat().st_mode & 0o777 == 0o644
+    index = AssetIndex(tmp_path)
+    index.build()
+    assert set(index.assets) == {"remoteEntry.js", "assets/index-BQw3Yc_2.js", "assets/matrix-integration.js"}
+    assert index.assets["assets/index-BQw3Yc_2.js"].immutable
+    assert not index.assets["assets/matrix-integration.js"].immutable
+    assert not index.assets["remoteEntry.js"].immutable
+    assert "gzip" in index.assets["remoteEntry.js"].variants
+    assert index.assets["remoteEntry.js"].size == len(SCRIPT)
+
+
+def test_serve(tmp_path: Path) -> None:
+    """Check variants, caching headers and conditional requests"""
+    (tmp_path / "remoteEntry.js").write_bytes(SCRIPT)
+    (tmp_path / "index-BQw3Yc_2.js").write_bytes(SCRIPT)
+    (tmp_path / "matrixlogo.svg").write_bytes(b"<svg/>")
+    precompress(tmp_path)
+    with make_client(tmp_path) as client:
+        resp = client.get("/ui/matrix/remoteEntry.js", headers={"Accept-Encoding": "gzip"})
+        assert resp.status_code == 200
+        assert resp.headers["content-encoding"] == "gzip"
+        assert resp.headers["cache-control"] == CACHE_REVALIDATE
+        assert resp.headers["content-type"].startswith("text/javascript")
+        assert int(resp.headers["content-length"]) == len(gzip.compress(SCRIPT, compresslevel=9, mtime=0))
+        assert resp.content == SCRIPT
+        etag = resp.headers["etag"]
+
+        resp = client.get("/ui/matrix/remoteEntry.js", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.headers["etag"] == etag
+
+        resp = client.get("/ui/matrix/remoteEntry.js", headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in resp.headers
+        assert resp.headers["etag"] != etag
+        assert resp.content == SCRIPT
+
+        resp = client.get("/ui/matrix/remoteEntry.js", headers={"Accept-Encoding": "gzip", "Range": "bytes=0-5"})
+        assert resp.status_code == 206
+        assert resp.content == SCRIPT[:6]
+
+        resp = client.get("/ui/matrix/index-BQw3Yc_2.js")
+        assert resp.headers["cache-control"] == CACHE_IMMUTABLE
+
+        resp = client.get("/ui/matrix/matrixlogo.svg")
+        assert resp.headers["content-type"] == "image/svg+xml"
+        assert "vary" not in resp.headers
+        assert resp.content == b"<svg/>"
+
+        assert client.get("/ui/matrix/nope.js").status_code == 404
+        assert client.get("/ui/matrix/remoteEntry.js.gz").status_code == 404
+
+
+def test_app_route(mtlsclient: TestClient) -> None:
+    """Check that the app has the route, the test UI dir does not exist"""
+    assert mtlsclient.get("/ui/matrix/remoteEntry.js").status_code == 404